@@ -0,0 +1,111 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+"""Benchmark of database archive extraction with different gzip backends.
+
+Extracts a synthetic Kraken 2 collection archive (.tar.gz) using Python's
+gzip module and every external decompressor available (igzip, pigz and
+the igzip implementation of python-isal). Usage:
+
+    python benchmarks/gzip_decompression.py [--size-gb 2] [--threads 4]
+"""
+import argparse
+import importlib.util
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+import numpy as np
+
+from q2_moshpit.kraken2.database import _extract_db_files
+
+BLOCK_SIZE = 2**26
+
+
+class _SyntheticFile:
+    """Compressible, file-like object of the requested size."""
+    def __init__(self, size: int, seed: int = 42):
+        rng = np.random.default_rng(seed)
+        self.block = rng.integers(0, 16, BLOCK_SIZE, dtype=np.uint8).tobytes()
+        self.remaining = size
+
+    def read(self, size: int = -1) -> bytes:
+        size = min(self.remaining if size < 0 else size, self.remaining)
+        size = min(size, BLOCK_SIZE)
+        self.remaining -= size
+        return self.block[:size]
+
+
+def _create_archive(fp: str, size: int):
+    members = {
+        'k2_synthetic/hash.k2d': size * 9 // 10,
+        'k2_synthetic/database150mers.kmer_distrib': size // 20,
+        'k2_synthetic/library_report.tsv': size - size * 9 // 10 - size // 20
+    }
+    with tarfile.open(fp, 'w:gz', compresslevel=1) as tar:
+        for name, member_size in members.items():
+            tarinfo = tarfile.TarInfo(name=name)
+            tarinfo.size = member_size
+            tar.addfile(tarinfo, _SyntheticFile(member_size))
+
+
+def _find_backends(threads: int) -> dict:
+    backends = {'python': None}
+    if shutil.which('igzip'):
+        backends['igzip'] = ['igzip', '-d', '-c']
+    if shutil.which('pigz'):
+        backends['pigz'] = ['pigz', '-d', '-c', '-p', str(threads)]
+    if importlib.util.find_spec('isal'):
+        backends['python-isal'] = [sys.executable, '-m', 'isal.igzip', '-dc']
+    return backends
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size-gb', type=float, default=2.0)
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--tmp-dir', default=None)
+    args = parser.parse_args()
+
+    size = int(args.size_gb * 2**30)
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp:
+        archive = os.path.join(tmp, 'k2_synthetic.tar.gz')
+        start = time.perf_counter()
+        _create_archive(archive, size)
+        print(f'Created a {size / 2**30:.1f} GiB archive '
+              f'({os.path.getsize(archive) / 2**30:.2f} GiB compressed) '
+              f'in {time.perf_counter() - start:.1f} s')
+
+        results = {}
+        for label, cmd in _find_backends(args.threads).items():
+            kraken2_dir = os.path.join(tmp, 'kraken2')
+            bracken_dir = os.path.join(tmp, 'bracken')
+            os.makedirs(kraken2_dir)
+            os.makedirs(bracken_dir)
+            start = time.perf_counter()
+            with open(archive, 'rb') as fh:
+                _extract_db_files(
+                    fh, {'k2d': kraken2_dir, 'kmer_distrib': bracken_dir},
+                    decompress_cmd=cmd
+                )
+            results[label] = time.perf_counter() - start
+            print(f'{label:>12}: {results[label]:.1f} s '
+                  f'({size / 2**20 / results[label]:.0f} MiB/s)')
+            shutil.rmtree(kraken2_dir)
+            shutil.rmtree(bracken_dir)
+
+        for label, duration in results.items():
+            if label != 'python':
+                print(f'{label:>12}: {results["python"] / duration:.1f}x '
+                      f'faster than python')
+
+
+if __name__ == '__main__':
+    main()
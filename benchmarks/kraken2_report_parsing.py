@@ -0,0 +1,121 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+"""Benchmark of Kraken 2 report parsing into NCBI trees.
+
+Compares the vectorized report parser used by `kraken2_to_features` with
+the previous, row-by-row (`df.iterrows()`) implementation on a synthetic
+report. Usage:
+
+    python benchmarks/kraken2_report_parsing.py [--lines 50000]
+"""
+import argparse
+import random
+import timeit
+from collections import deque
+
+import pandas as pd
+
+from q2_moshpit.kraken2.select import _kraken_to_ncbi_tree
+from q2_moshpit.kraken2.tree import NCBITree
+
+RANKS = ['D', 'P', 'C', 'O', 'F', 'G', 'G1', 'S', 'S1']
+
+
+def _generate_report(n_lines: int, seed: int = 42) -> pd.DataFrame:
+    rng = random.Random(seed)
+    rows = [(100.0, n_lines, 0, 'R', 1, 'root')]
+    taxid = 2
+    stack = [(0, 1)]  # (rank index, indentation level)
+    while len(rows) < n_lines:
+        if not stack:
+            stack.append((0, 1))
+        rank_idx, level = stack.pop()
+        rank = RANKS[rank_idx]
+        rows.append((
+            round(rng.random(), 2), rng.randint(1, 1000),
+            rng.randint(0, 100), rank, taxid,
+            f"{'  ' * level}{rank} taxon {taxid}"
+        ))
+        taxid += 1
+        if rank_idx + 1 < len(RANKS):
+            n_children = rng.randint(1, 4)
+            stack.extend([(rank_idx + 1, level + 1)] * n_children)
+    return pd.DataFrame(rows, columns=[
+        'perc_frags_covered', 'n_frags_covered', 'n_frags_assigned',
+        'rank', 'ncbi_tax_id', 'name'
+    ])
+
+
+def _kraken_to_ncbi_tree_iterrows(df):
+    """Previous, row-by-row implementation of the report parser."""
+    tree = NCBITree()
+    stack = deque([(0, tree.ROOT)])
+    last_taxid_node = None
+    for _, row in df.iterrows():
+        r = row['rank']
+        label = row['name']
+        otu = str(row['ncbi_tax_id'])
+
+        if r in ('U', 'R'):
+            continue
+
+        indent = (len(label) - len(label.lstrip(' '))) // 2
+        name = f"{r.lower()}__{label.strip()}"
+
+        parent_indent, parent_node = stack[-1]
+        if parent_indent >= indent and last_taxid_node is not None:
+            tree.mark_actual_tip(last_taxid_node)
+
+        while parent_indent >= indent:
+            stack.pop()
+            parent_indent, parent_node = stack[-1]
+
+        if len(r) == 1 or r.startswith('S'):
+            node = tree.add_node(parent_node, name, length=1.0)
+            last_taxid_node = tree.add_node(node, otu, length=0.0)
+        else:
+            node = tree.add_node(parent_node, name, length=0.0)
+            last_taxid_node = None
+
+        stack.append((indent, node))
+
+    if last_taxid_node is not None:
+        tree.mark_actual_tip(last_taxid_node)
+
+    return tree
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--lines', type=int, default=50000)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    report = _generate_report(args.lines)
+
+    old = _kraken_to_ncbi_tree_iterrows(report)
+    new = _kraken_to_ncbi_tree(report)
+    assert old.names == new.names
+    assert list(old.parents) == list(new.parents)
+    assert old.actual_tips == new.actual_tips
+
+    results = {}
+    for label, func in (
+        ('iterrows', _kraken_to_ncbi_tree_iterrows),
+        ('vectorized', _kraken_to_ncbi_tree)
+    ):
+        results[label] = min(timeit.repeat(
+            lambda: func(report), number=1, repeat=args.repeats
+        ))
+        print(f'{label:>10}: {results[label]:.3f} s')
+    print(f'   speedup: {results["iterrows"] / results["vectorized"]:.1f}x '
+          f'({len(report)} report lines)')
+
+
+if __name__ == '__main__':
+    main()
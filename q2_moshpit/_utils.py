@@ -5,8 +5,16 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import hashlib
+import json
+import os
+import shutil
 import subprocess
-from typing import List
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import List, Callable, Optional
+
+DIGESTS_FN = 'digests.json'
 
 
 def run_command(cmd, env=None, verbose=True):
@@ -58,3 +66,208 @@ def _process_common_input_params(processing_func, params: dict) -> List[str]:
         else:
             processed_args.extend(processing_func(arg_key, arg_val))
     return processed_args
+
+
+def _get_cache_size(size_var: str, default_size: int) -> int:
+    """Find the maximum size of a cache.
+
+    Args:
+        size_var (str): Name of the environment variable which can be used
+            to set the size of the cache in GB.
+        default_size (int): Size of the cache in bytes, if the variable
+            is not set.
+
+    Returns:
+        size (int): Maximum size of the cache in bytes.
+
+    """
+    size_gb = os.environ.get(size_var)
+    if size_gb is None:
+        return default_size
+    try:
+        return int(float(size_gb) * 2**30)
+    except (ValueError, OverflowError):
+        raise ValueError(
+            f'The value of the {size_var} environment variable '
+            f'("{size_gb}") is not a valid size. Please set it to the '
+            'maximum size of the cache in GB (e.g., 100) or to 0 to '
+            'disable the cache.'
+        )
+
+
+def _get_cache_dir(
+        dir_var: str, size_var: str, default_size: int
+) -> Optional[str]:
+    """Find (and create, if needed) the directory of a persistent cache.
+
+    Caches are opt-in: a cache is only used when its location is set
+    using the given environment variable and its size is not set to 0.
+
+    Args:
+        dir_var (str): Name of the environment variable holding the path
+            to the cache directory.
+        size_var (str): Name of the environment variable which can be used
+            to set the size of the cache in GB.
+        default_size (int): Size of the cache in bytes, if not set.
+
+    Returns:
+        cache_dir (str): Path to the cache directory or None, if caching is
+            disabled or the cache directory cannot be used.
+
+    """
+    cache_dir = os.environ.get(dir_var)
+    if not cache_dir or _get_cache_size(size_var, default_size) <= 0:
+        return None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError as e:
+        print(f'The cache in "{cache_dir}" cannot be used: {e}.')
+        return None
+    return cache_dir
+
+
+def _hash_file(fp: str, chunk_size: int = 2**23) -> str:
+    """Calculate a digest of the file's contents."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(fp, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _get_file_digest(fp: str, cache_dir: str) -> str:
+    """Find a digest of the file's contents, hashing every file only once.
+
+    Digests are stored in the cache directory, together with the size and
+    the modification time of every file (identified by its real path).
+    A file is only hashed again when its size or modification time change.
+    Entries of files which do not exist anymore are removed.
+
+    Args:
+        fp (str): Path to the file.
+        cache_dir (str): Path to the cache directory.
+
+    Returns:
+        digest (str): Hex digest of the file.
+
+    """
+    fp = os.path.realpath(fp)
+    stat = os.stat(fp)
+    key = [stat.st_size, stat.st_mtime_ns]
+
+    digests_fp = os.path.join(cache_dir, DIGESTS_FN)
+    try:
+        with open(digests_fp) as fh:
+            digests = json.load(fh)
+    except (OSError, ValueError):
+        digests = {}
+    if digests.get(fp, [])[:2] == key:
+        return digests[fp][2]
+
+    digest = _hash_file(fp)
+    digests = {
+        path: entry for path, entry in digests.items()
+        if os.path.exists(path)
+    }
+    digests[fp] = [*key, digest]
+    # the digests are replaced at once, so that they are never read
+    # while only partially written
+    tmp_fp = f'{digests_fp}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_fp, 'w') as fh:
+            json.dump(digests, fh)
+        os.replace(tmp_fp, digests_fp)
+    except OSError:
+        # the file only gets hashed again the next time
+        if os.path.exists(tmp_fp):
+            os.remove(tmp_fp)
+    return digest
+
+
+def _get_dir_size(path: str) -> int:
+    return sum(
+        entry.stat().st_size for entry in os.scandir(path) if entry.is_file()
+    )
+
+
+def _evict_cache_entries(cache_dir: str, max_size: int, keep: str = None):
+    """Removes the least recently used entries from a cache, until its size
+    does not exceed the limit.
+
+    Every entry is a directory directly under the cache directory - its
+    modification time is taken as the time of its last use. Hidden
+    directories (entries being created) are never removed.
+
+    Args:
+        cache_dir (str): Path to the cache.
+        max_size (int): Maximum size of the cache in bytes.
+        keep (str): Path to an entry which should not be removed.
+
+    """
+    entries = [
+        (entry.stat().st_mtime, _get_dir_size(entry.path), entry.path)
+        for entry in os.scandir(cache_dir)
+        if entry.is_dir() and not entry.name.startswith('.')
+    ]
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        if path == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+
+
+def _return_exception(func: Callable, **kwargs):
+    try:
+        return func(**kwargs)
+    except Exception as e:
+        return e
+
+
+def _run_concurrently(
+        func: Callable, kwargs_list: List[dict], n_jobs: int = 1,
+        use_processes: bool = False, return_exceptions: bool = False
+) -> list:
+    """Calls a function once for every set of provided keyword arguments.
+
+    Calls are distributed over a pool of at most 'n_jobs' threads, which
+    is well suited for functions spending most of their time waiting for
+    external processes. CPU-bound functions should rather be run in a pool
+    of processes - in that case the function, its arguments and results
+    need to be picklable. When only one job is requested, all the calls
+    are made sequentially in the calling thread.
+
+    Args:
+        func: Function to be called.
+        kwargs_list (list): List of dictionaries with keyword arguments,
+            one per function call.
+        n_jobs (int): Maximum number of concurrent calls.
+        use_processes (bool): Use a pool of processes instead of threads.
+        return_exceptions (bool): Return exceptions raised by the calls
+            in place of their results instead of re-raising the first one.
+            All the calls are made, even if some of them fail.
+
+    Returns:
+        results (list): Values returned by every call, in the same order
+            as the provided keyword arguments.
+
+    """
+    if return_exceptions:
+        func = partial(_return_exception, func)
+
+    if n_jobs <= 1 or len(kwargs_list) <= 1:
+        return [func(**kwargs) for kwargs in kwargs_list]
+
+    executor_class = ProcessPoolExecutor if use_processes \
+        else ThreadPoolExecutor
+    with executor_class(max_workers=n_jobs) as executor:
+        futures = [executor.submit(func, **kwargs) for kwargs in kwargs_list]
+        try:
+            return [future.result() for future in futures]
+        except Exception:
+            # do not start any of the calls which are still queued
+            for future in futures:
+                future.cancel()
+            raise
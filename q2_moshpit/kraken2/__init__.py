@@ -6,10 +6,23 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+from ._format import (
+    Kraken2LibraryDirectoryFormat, Kraken2LibraryFileFormat,
+    Kraken2LibraryManifestFormat, Kraken2LibrarySequencesFormat,
+    Kraken2TaxonomyDumpFormat, Kraken2CompressedOutputFormat,
+    Kraken2CompressedOutputDirectoryFormat
+)
+from ._type import Kraken2Library, Kraken2CompressedOutputs
 from .bracken import estimate_bracken
-from .database import build_kraken_db
-from .classification import classify_kraken2
+from .database import build_kraken_db, update_kraken_db
+from .classification import classify_kraken2, classify_kraken2_compressed
 from .select import kraken2_to_features, kraken2_to_mag_features
 
-__all__ = ['build_kraken_db', 'classify_kraken2', 'estimate_bracken',
-           'kraken2_to_features', 'kraken2_to_mag_features']
+__all__ = ['build_kraken_db', 'update_kraken_db', 'classify_kraken2',
+           'classify_kraken2_compressed', 'estimate_bracken',
+           'kraken2_to_features', 'kraken2_to_mag_features',
+           'Kraken2Library', 'Kraken2LibraryDirectoryFormat',
+           'Kraken2LibraryFileFormat', 'Kraken2LibraryManifestFormat',
+           'Kraken2LibrarySequencesFormat', 'Kraken2TaxonomyDumpFormat',
+           'Kraken2CompressedOutputs', 'Kraken2CompressedOutputFormat',
+           'Kraken2CompressedOutputDirectoryFormat']
@@ -0,0 +1,141 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import gzip
+import json
+
+from qiime2.plugin import model, ValidationError
+
+
+class Kraken2LibraryManifestFormat(model.TextFileFormat):
+    """Sequences added to a Kraken 2 library (digests of their files)
+    and the masking setting they were added with."""
+    def _validate_(self, level):
+        try:
+            with self.open() as fh:
+                manifest = json.load(fh)
+        except ValueError as e:
+            raise ValidationError(
+                f'The library manifest is not a valid JSON file: {e}.'
+            )
+        if not isinstance(manifest, dict) or \
+                not isinstance(manifest.get('seqs'), list) or \
+                not isinstance(manifest.get('no_masking'), bool):
+            raise ValidationError(
+                'The library manifest needs to list the added sequences '
+                '("seqs") and the masking setting ("no_masking").'
+            )
+
+
+class Kraken2LibraryFileFormat(model.BinaryFileFormat):
+    """Any other file of the library, e.g. accession to taxid maps."""
+    def _validate_(self, level):
+        pass
+
+
+class Kraken2TaxonomyDumpFormat(model.TextFileFormat):
+    """NCBI taxonomy dump (e.g. nodes.dmp or names.dmp)."""
+    def _validate_(self, level):
+        n_lines = {'min': 10, 'max': None}[level]
+        with self.open() as fh:
+            for i, line in enumerate(fh):
+                if n_lines is not None and i >= n_lines:
+                    break
+                if not line.rstrip('\n').endswith('\t|'):
+                    raise ValidationError(
+                        f'Line {i + 1} is not a valid NCBI taxonomy dump '
+                        f'record: {line!r}.'
+                    )
+
+
+class Kraken2LibrarySequencesFormat(model.TextFileFormat):
+    """(Masked) sequences added to the library, in FASTA format."""
+    def _validate_(self, level):
+        n_lines = {'min': 100, 'max': None}[level]
+        with self.open() as fh:
+            for i, line in enumerate(fh):
+                if n_lines is not None and i >= n_lines:
+                    break
+                line = line.rstrip('\n')
+                if i == 0 and not line.startswith('>'):
+                    raise ValidationError(
+                        'The library sequences need to start with a FASTA '
+                        f'header, found {line!r} instead.'
+                    )
+                if line and not line.startswith('>') \
+                        and not line.isalpha():
+                    raise ValidationError(
+                        f'Line {i + 1} is neither a FASTA header nor a '
+                        f'sequence: {line!r}.'
+                    )
+
+
+class Kraken2LibraryDirectoryFormat(model.DirectoryFormat):
+    """Taxonomy and (masked) sequence library of a custom Kraken 2
+    database, as created by kraken2-build."""
+    manifest = model.File(
+        r'manifest.json', format=Kraken2LibraryManifestFormat
+    )
+    taxonomy_dumps = model.FileCollection(
+        r'taxonomy/.+\.dmp$', format=Kraken2TaxonomyDumpFormat
+    )
+    taxonomy = model.FileCollection(
+        r'taxonomy/.+(?<!\.dmp)$', format=Kraken2LibraryFileFormat
+    )
+    sequences = model.FileCollection(
+        r'library/.+\.fna$', format=Kraken2LibrarySequencesFormat
+    )
+    library = model.FileCollection(
+        r'library/.+(?<!\.fna)$', format=Kraken2LibraryFileFormat
+    )
+
+    @taxonomy.set_path_maker
+    def taxonomy_path_maker(self, name):
+        return f'taxonomy/{name}'
+
+    @library.set_path_maker
+    def library_path_maker(self, name):
+        return f'library/{name}'
+
+    def _validate_(self, level):
+        for fn in ('nodes.dmp', 'names.dmp'):
+            if not (self.path / 'taxonomy' / fn).is_file():
+                raise ValidationError(
+                    f'The taxonomy file "{fn}" is missing from the library.'
+                )
+
+
+class Kraken2CompressedOutputFormat(model.BinaryFileFormat):
+    """Per-read Kraken 2 classification results (hits) compressed
+    with gzip."""
+    def _validate_(self, level):
+        n_lines = {'min': 10, 'max': None}[level]
+        try:
+            with gzip.open(str(self), 'rt') as fh:
+                for i, line in enumerate(fh):
+                    if n_lines is not None and i >= n_lines:
+                        break
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 5 or fields[0] not in ('C', 'U'):
+                        raise ValidationError(
+                            f'Line {i + 1} is not a valid Kraken 2 '
+                            f'classification result: {line!r}.'
+                        )
+        except (OSError, EOFError) as e:
+            raise ValidationError(
+                f'The Kraken 2 output is not a valid gzip file: {e}.'
+            )
+
+
+class Kraken2CompressedOutputDirectoryFormat(model.DirectoryFormat):
+    outputs = model.FileCollection(
+        r'.+output\.txt\.gz$', format=Kraken2CompressedOutputFormat
+    )
+
+    @outputs.set_path_maker
+    def outputs_path_maker(self, sample_id):
+        return f'{sample_id}.output.txt.gz'
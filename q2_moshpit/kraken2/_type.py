@@ -0,0 +1,16 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+from q2_types.feature_data import FeatureData
+from q2_types.sample_data import SampleData
+from qiime2.plugin import SemanticType
+
+Kraken2Library = SemanticType('Kraken2Library')
+Kraken2CompressedOutputs = SemanticType(
+    'Kraken2CompressedOutputs',
+    variant_of=[SampleData.field['type'], FeatureData.field['type']]
+)
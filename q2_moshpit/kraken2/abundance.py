@@ -0,0 +1,484 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import os
+import shutil
+import tempfile
+from typing import Dict, List, NamedTuple, Tuple
+
+import biom
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix, csr_matrix
+
+from q2_moshpit._utils import (
+    _get_cache_dir, _get_cache_size, _get_file_digest, _evict_cache_entries
+)
+from q2_moshpit.kraken2.select import _find_parents
+from q2_moshpit.kraken2.utils import _counts_to_table
+from q2_types_genomics.kraken2 import (
+    Kraken2ReportDirectoryFormat, Kraken2ReportFormat,
+    BrackenDBDirectoryFormat
+)
+
+
+KMER_DISTRIB_ARRAYS = (
+    'mapped_taxids', 'genome_taxids', 'indptr', 'indices', 'data'
+)
+KMER_DISTRIB_CACHE_DIR_VAR = 'Q2_MOSHPIT_BRACKEN_CACHE_DIR'
+KMER_DISTRIB_CACHE_SIZE = 2**33
+KMER_DISTRIB_CACHE_SIZE_VAR = 'Q2_MOSHPIT_BRACKEN_CACHE_GB'
+
+
+class KmerDistribution(NamedTuple):
+    """K-mer distribution of a Bracken database.
+
+    Attributes:
+        mapped_taxids (np.ndarray): Taxids to which Kraken 2 classifies
+            reads originating from the database genomes.
+        genome_taxids (np.ndarray): Taxids of the database genomes.
+        fractions (csr_matrix): Fraction of reads of every genome (columns)
+            expected to be classified to every mapped taxid (rows).
+    """
+    mapped_taxids: np.ndarray
+    genome_taxids: np.ndarray
+    fractions: csr_matrix
+
+
+def _read_kmer_distrib(fp: str) -> KmerDistribution:
+    """Parse a database{N}mers.kmer_distrib file of a Bracken database.
+
+    Every line of the file lists a mapped taxid followed by all the genomes
+    with reads classified to that taxid, as space-separated
+    genome_taxid:mapped_kmers:total_kmers triplets.
+
+    Args:
+        fp (str): Path to the k-mer distribution file.
+
+    Returns:
+        KmerDistribution: The parsed k-mer distribution.
+    """
+    mapped_taxids, distributions = [], []
+    with open(fp) as fh:
+        fh.readline()  # header
+        for line in fh:
+            if not line.strip():
+                continue
+            taxid, distribution = line.split('\t', 1)
+            mapped_taxids.append(int(taxid))
+            distributions.append(distribution.strip())
+
+    n_genomes = np.array(
+        [d.count(':') // 2 for d in distributions], dtype=np.int64
+    )
+    # parse all the triplets at once instead of line by line
+    triplets = np.fromstring(
+        ' '.join(distributions).replace(':', ' '), dtype=np.int64, sep=' '
+    ).reshape(-1, 3)
+    genome_taxids, genomes = np.unique(triplets[:, 0], return_inverse=True)
+    fractions = csr_matrix(
+        (
+            triplets[:, 1] / triplets[:, 2],
+            (np.repeat(np.arange(len(mapped_taxids)), n_genomes), genomes)
+        ),
+        shape=(len(mapped_taxids), len(genome_taxids))
+    )
+    return KmerDistribution(
+        np.array(mapped_taxids, dtype=np.int64), genome_taxids, fractions
+    )
+
+
+def _save_kmer_distrib_index(distribution: KmerDistribution, index_dir: str):
+    """Save a k-mer distribution as a set of binary (.npy) arrays.
+
+    The arrays are written into a temporary directory first, which is then
+    renamed, so that an incomplete index can never be loaded.
+    """
+    fractions = distribution.fractions
+    arrays = {
+        'mapped_taxids': distribution.mapped_taxids,
+        'genome_taxids': distribution.genome_taxids,
+        'indptr': fractions.indptr,
+        'indices': fractions.indices,
+        'data': fractions.data
+    }
+    # hidden, so that it is never evicted while being written
+    tmp_dir = tempfile.mkdtemp(prefix='.', dir=os.path.dirname(index_dir))
+    try:
+        for name in KMER_DISTRIB_ARRAYS:
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), arrays[name])
+        os.rename(tmp_dir, index_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def _load_kmer_distrib_index(index_dir: str) -> KmerDistribution:
+    """Memory-map a k-mer distribution saved as binary arrays."""
+    arrays = {
+        name: np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r')
+        for name in KMER_DISTRIB_ARRAYS
+    }
+    fractions = csr_matrix(
+        (arrays['data'], arrays['indices'], arrays['indptr']),
+        shape=(len(arrays['mapped_taxids']), len(arrays['genome_taxids'])),
+        copy=False
+    )
+    return KmerDistribution(
+        arrays['mapped_taxids'], arrays['genome_taxids'], fractions
+    )
+
+
+def _load_kmer_distrib(fp: str) -> KmerDistribution:
+    """Load a k-mer distribution, using its binary index if available.
+
+    When the cache of k-mer distributions is enabled (by setting its
+    location using the Q2_MOSHPIT_BRACKEN_CACHE_DIR environment variable),
+    the first time a k-mer distribution file is loaded it gets parsed and
+    converted into a binary index, stored in the cache (artifacts are
+    read-only). The index is identified by a digest of the whole file,
+    so that it can be found again even when the same database is extracted
+    to a different location. All the following loads only memory-map the
+    index instead of parsing the file again. The least recently used
+    indices are removed once the cache exceeds its size (8 GB, unless set
+    using the Q2_MOSHPIT_BRACKEN_CACHE_GB environment variable).
+
+    Args:
+        fp (str): Path to the k-mer distribution file.
+
+    Returns:
+        KmerDistribution: The k-mer distribution.
+    """
+    cache_dir = _get_cache_dir(
+        KMER_DISTRIB_CACHE_DIR_VAR, KMER_DISTRIB_CACHE_SIZE_VAR,
+        KMER_DISTRIB_CACHE_SIZE
+    )
+    if cache_dir is None:
+        return _read_kmer_distrib(fp)
+    try:
+        index_dir = os.path.join(cache_dir, _get_file_digest(fp, cache_dir))
+    except OSError:
+        return _read_kmer_distrib(fp)
+
+    if os.path.isdir(index_dir):
+        try:
+            distribution = _load_kmer_distrib_index(index_dir)
+            os.utime(index_dir)  # mark as recently used
+            return distribution
+        except (OSError, ValueError):
+            shutil.rmtree(index_dir, ignore_errors=True)  # corrupted index
+
+    distribution = _read_kmer_distrib(fp)
+    try:
+        _save_kmer_distrib_index(distribution, index_dir)
+        _evict_cache_entries(
+            cache_dir,
+            _get_cache_size(
+                KMER_DISTRIB_CACHE_SIZE_VAR, KMER_DISTRIB_CACHE_SIZE
+            ),
+            keep=index_dir
+        )
+    except OSError:
+        pass  # e.g. another process saved the same index in the meantime
+    return distribution
+
+
+def _stack_reports(reports: List[pd.DataFrame], indent: int = 2) \
+        -> pd.DataFrame:
+    """Concatenate Kraken 2 reports of all the samples.
+
+    Args:
+        reports (list): Kraken 2 reports, one per sample.
+        indent (int): Number of spaces used to indent every level
+            of the report.
+
+    Returns:
+        pd.DataFrame: All the report entries with two additional columns:
+            'sample' (position of the report in the list) and 'parent'
+            (row of the parent entry or -1 if the entry has no parent).
+    """
+    stacked, offset = [], 0
+    for sample, report in enumerate(reports):
+        report = report[
+            ['n_frags_covered', 'n_frags_assigned', 'rank',
+             'ncbi_tax_id', 'name']
+        ].reset_index(drop=True)
+        labels = report['name'].astype(str)
+        indents = (
+            (labels.str.len() - labels.str.lstrip(' ').str.len()) // indent
+        ).to_numpy()
+        parents = _find_parents(indents)
+        report['sample'] = sample
+        report['parent'] = np.where(parents >= 0, parents + offset, -1)
+        stacked.append(report)
+        offset += len(report)
+    if not stacked:
+        return pd.DataFrame(
+            columns=['n_frags_covered', 'n_frags_assigned', 'rank',
+                     'ncbi_tax_id', 'name', 'sample', 'parent']
+        )
+    return pd.concat(stacked, ignore_index=True)
+
+
+def _find_level_ancestors(parents: np.ndarray, is_level: np.ndarray) \
+        -> np.ndarray:
+    """Find the closest ancestor of every entry at the estimation level.
+
+    Args:
+        parents (np.ndarray): Row of the parent of every entry.
+        is_level (np.ndarray): Whether the entry is at the estimation level.
+
+    Returns:
+        np.ndarray: Row of the closest ancestor at the estimation level
+            (the entry itself, if it is at that level) or -1, if the entry
+            is above the estimation level.
+    """
+    ancestors = np.where(is_level, np.arange(len(parents)), parents)
+    # move all the entries up one level at a time - only as many
+    # iterations as the depth of the taxonomy are needed
+    pending = np.flatnonzero(ancestors >= 0)
+    pending = pending[~is_level[ancestors[pending]]]
+    while len(pending):
+        ancestors[pending] = parents[ancestors[pending]]
+        pending = pending[ancestors[pending] >= 0]
+        pending = pending[~is_level[ancestors[pending]]]
+    return ancestors
+
+
+def _lookup(matrix, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    """Look up values of the given elements of a sparse matrix."""
+    if not len(rows):
+        return np.zeros(0)
+    return np.asarray(csr_matrix(matrix)[rows, cols]).ravel()
+
+
+def _index_taxa(
+        rows: pd.DataFrame, distribution: KmerDistribution,
+        selected: np.ndarray = None
+) -> pd.DataFrame:
+    """Locate taxa of the report entries in the k-mer distribution.
+
+    Args:
+        rows (pd.DataFrame): Stacked reports of all the samples.
+        distribution (KmerDistribution): K-mer distribution of
+            the database.
+        selected (np.ndarray): Entries to be located. Defaults to all.
+
+    Returns:
+        pd.DataFrame: The report entries with two additional columns:
+            'genome' and 'mapped' (column and row of the taxon in the
+            k-mer distribution or -1, if the taxon is not there or the
+            entry was not selected).
+    """
+    taxids = rows['ncbi_tax_id'].to_numpy(dtype=np.int64)
+    genomes = pd.Index(distribution.genome_taxids).get_indexer(taxids)
+    mapped = pd.Index(distribution.mapped_taxids).get_indexer(taxids)
+    if selected is not None:
+        genomes[~selected] = -1
+        mapped[~selected] = -1
+    return rows.assign(genome=genomes, mapped=mapped)
+
+
+def _redistribute_reads(
+        rows: pd.DataFrame, distribution: KmerDistribution, level: str,
+        threshold: int, n_samples: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Re-estimate abundances of all the taxa at the requested level.
+
+    Reads classified directly to a taxon above the estimation level are
+    distributed between the taxa at that level, proportionally to:
+      - the fraction of reads of their genomes which Kraken 2 is expected
+        to classify to that taxon (given by the k-mer distribution) and
+      - the number of reads classified directly to those genomes.
+
+    This is done for all the samples at once: with F being the k-mer
+    distribution (mapped taxa x genomes), W the genome read counts and
+    R the read counts of the mapped taxa (both taxa x samples), the
+    reads added to every genome equal W * (F.T @ (R / (F @ W))), where
+    * and / are element-wise.
+
+    Args:
+        rows (pd.DataFrame): Stacked reports of all the samples, with
+            their taxa located in the k-mer distribution.
+        distribution (KmerDistribution): K-mer distribution of
+            the database.
+        level (str): Taxonomic level at which the abundances are estimated.
+        threshold (int): Minimum number of reads required for a taxon to
+            have its abundance re-estimated.
+        n_samples (int): Number of samples.
+
+    Returns:
+        (np.ndarray, np.ndarray): Whether every entry was retained in the
+            estimation and its estimated number of reads.
+    """
+    rank = rows['rank'].astype(str).to_numpy()
+    genomes = rows['genome'].to_numpy(dtype=np.int64)
+    mapped = rows['mapped'].to_numpy(dtype=np.int64)
+    samples = rows['sample'].to_numpy(dtype=np.int64)
+    clade_reads = rows['n_frags_covered'].to_numpy(dtype=float)
+    direct_reads = rows['n_frags_assigned'].to_numpy(dtype=float)
+
+    is_level = rank == level
+    kept = is_level & (clade_reads >= threshold)
+    ancestors = _find_level_ancestors(
+        rows['parent'].to_numpy(dtype=np.int64), is_level
+    )
+
+    # reads of genomes below taxa which did not pass the threshold
+    # are not considered in the estimation
+    is_genome = np.zeros(len(rows), dtype=bool)
+    is_genome[ancestors >= 0] = kept[ancestors[ancestors >= 0]]
+    genome_rows = np.flatnonzero(
+        is_genome & (genomes >= 0) & (direct_reads > 0)
+    )
+
+    is_mapped = (ancestors < 0) & (rank != 'U')
+    mapped_rows = np.flatnonzero(
+        is_mapped & (mapped >= 0) & (direct_reads > 0)
+    )
+
+    F = distribution.fractions
+    W = coo_matrix(
+        (
+            direct_reads[genome_rows],
+            (genomes[genome_rows], samples[genome_rows])
+        ),
+        shape=(F.shape[1], n_samples)
+    ).tocsr()
+    expected = _lookup(F @ W, mapped[mapped_rows], samples[mapped_rows])
+    # reads of taxa which none of the present genomes could have been
+    # classified to are not distributed
+    scaled = np.divide(
+        direct_reads[mapped_rows], expected,
+        out=np.zeros(len(mapped_rows)), where=expected > 0
+    )
+    Q = coo_matrix(
+        (scaled, (mapped[mapped_rows], samples[mapped_rows])),
+        shape=(F.shape[0], n_samples)
+    ).tocsr()
+    added = direct_reads[genome_rows] * _lookup(
+        F.T @ Q, genomes[genome_rows], samples[genome_rows]
+    )
+
+    estimates = clade_reads + np.bincount(
+        ancestors[genome_rows], weights=added, minlength=len(rows)
+    )
+    estimates[~kept] = 0
+    return kept, estimates
+
+
+def _propagate_counts(
+        parents: np.ndarray, kept: np.ndarray, counts: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Sum up the read counts of all the retained taxa in their ancestors.
+
+    Returns:
+        (np.ndarray, np.ndarray): Whether every entry is a retained taxon
+            or its ancestor and the number of reads in its clade.
+    """
+    in_report = kept.copy()
+    clade_counts = np.where(kept, counts, 0)
+    nodes = np.flatnonzero(kept)
+    values = counts[nodes]
+    while len(nodes):
+        nodes = parents[nodes]
+        values = values[nodes >= 0]
+        nodes = nodes[nodes >= 0]
+        np.add.at(clade_counts, nodes, values)
+        in_report[nodes] = True
+    return in_report, clade_counts
+
+
+def _write_bracken_report(
+        fp: str, report: pd.DataFrame, kept: np.ndarray,
+        clade_counts: np.ndarray
+):
+    """Write a Kraken 2 report with abundances re-estimated by Bracken.
+
+    Only the retained taxa and their ancestors are included. Reads are
+    only assigned directly to the retained taxa.
+    """
+    total = clade_counts[report['parent'].to_numpy() < 0].sum()
+    percentages = clade_counts / max(total, 1) * 100
+    assigned = np.where(kept, clade_counts, 0)
+    with open(fp, 'w') as fh:
+        fh.writelines(
+            f"{perc:.2f}\t{clade}\t{direct}\t{rank}\t{taxid}\t{name}\n"
+            for perc, clade, direct, rank, taxid, name in zip(
+                percentages, clade_counts, assigned, report['rank'],
+                report['ncbi_tax_id'], report['name']
+            )
+        )
+
+
+def _estimate_bracken_python(
+        kraken_reports: Kraken2ReportDirectoryFormat,
+        bracken_db: BrackenDBDirectoryFormat,
+        threshold: int,
+        read_len: int,
+        level: str,
+        sample_read_lens: Dict[str, int] = None
+) -> (biom.Table, Kraken2ReportDirectoryFormat):
+    """Re-estimate abundances like Bracken, without running Bracken.
+
+    Every k-mer distribution is parsed once and applied to all the samples
+    (of its read length) together.
+
+    Args:
+        sample_read_lens (dict): Read lengths of (some of) the samples,
+            overriding the default read length.
+    """
+    report_fps = sorted(kraken_reports.path.iterdir())
+    sample_ids = [
+        fp.name.replace(".report.txt", "") for fp in report_fps
+    ]
+    rows = _stack_reports([
+        Kraken2ReportFormat(str(fp), mode='r').view(pd.DataFrame)
+        for fp in report_fps
+    ])
+    samples = rows['sample'].to_numpy(dtype=np.int64)
+    sample_read_lens = sample_read_lens or {}
+    read_lens = np.array(
+        [sample_read_lens.get(sample_id, read_len)
+         for sample_id in sample_ids], dtype=np.int64
+    )
+
+    kept = np.zeros(len(rows), dtype=bool)
+    estimates = np.zeros(len(rows))
+    for length in np.unique(read_lens).tolist():
+        distribution = _load_kmer_distrib(os.path.join(
+            str(bracken_db), f"database{length}mers.kmer_distrib"
+        ))
+        # only samples of this read length can use the distribution
+        selected = read_lens[samples] == length
+        length_kept, length_estimates = _redistribute_reads(
+            _index_taxa(rows, distribution, selected), distribution,
+            level, threshold, len(sample_ids)
+        )
+        kept[selected] = length_kept[selected]
+        estimates[selected] = length_estimates[selected]
+
+    # Bracken reports whole reads only
+    counts = estimates.astype(np.int64)
+    in_report, clade_counts = _propagate_counts(
+        rows['parent'].to_numpy(dtype=np.int64), kept, counts
+    )
+
+    bracken_reports = Kraken2ReportDirectoryFormat()
+    for sample, sample_id in enumerate(sample_ids):
+        selected = in_report & (samples == sample)
+        _write_bracken_report(
+            os.path.join(str(bracken_reports), f"{sample_id}.report.txt"),
+            rows[selected], kept[selected], clade_counts[selected]
+        )
+
+    bracken_table = _counts_to_table(
+        np.asarray(sample_ids)[samples[kept]],
+        rows['ncbi_tax_id'].to_numpy()[kept], counts[kept]
+    )
+
+    return bracken_table, bracken_reports
@@ -9,11 +9,16 @@ import os
 import re
 import subprocess
 import tempfile
+from typing import Dict
 
+import biom
 import pandas as pd
+from qiime2 import NumericMetadataColumn
 
-from q2_moshpit._utils import run_command
-from q2_moshpit.kraken2.select import kraken2_to_features
+from q2_moshpit._utils import run_command, _run_concurrently
+from q2_moshpit.kraken2.abundance import _estimate_bracken_python
+from q2_moshpit.kraken2.select import _kraken2_to_taxonomy
+from q2_moshpit.kraken2.utils import _counts_to_table
 from q2_types_genomics.kraken2 import (
     Kraken2ReportDirectoryFormat,
     BrackenDBDirectoryFormat,
@@ -63,34 +68,50 @@ def _estimate_bracken(
         bracken_db: BrackenDBDirectoryFormat,
         threshold: int,
         read_len: int,
-        level: str
-) -> (pd.DataFrame, Kraken2ReportDirectoryFormat):
-    bracken_tables = []
+        level: str,
+        n_jobs: int = 1,
+        sample_read_lens: Dict[str, int] = None
+) -> (biom.Table, Kraken2ReportDirectoryFormat):
     bracken_reports = Kraken2ReportDirectoryFormat()
+    sample_read_lens = sample_read_lens or {}
 
     with tempfile.TemporaryDirectory() as tmpdir:
-        try:
-            for report_fp in kraken_reports.path.iterdir():
-                bracken_table = _run_bracken_one_sample(
-                    bracken_db=str(bracken_db),
-                    kraken2_report_fp=report_fp,
-                    bracken_report_dir=str(bracken_reports),
-                    tmp_dir=tmpdir, threshold=threshold,
-                    read_len=read_len, level=level
-                )
-                bracken_tables.append(bracken_table)
-        except subprocess.CalledProcessError as e:
-            raise Exception(
-                "An error was encountered while running Bracken, "
-                f"(return code {e.returncode}), please inspect "
-                "stdout and stderr to learn more."
-            )
-
-    bracken_table = pd.concat(bracken_tables).reset_index()
-    bracken_table = bracken_table.pivot(
-        index="sample_id", columns="taxonomy_id", values="new_est_reads"
+        report_fps = list(kraken_reports.path.iterdir())
+        kwargs_list = [
+            {
+                "bracken_db": str(bracken_db),
+                "kraken2_report_fp": report_fp,
+                "bracken_report_dir": str(bracken_reports),
+                "tmp_dir": tmpdir, "threshold": threshold,
+                "read_len": sample_read_lens.get(
+                    report_fp.name.replace(".report.txt", ""), read_len
+                ),
+                "level": level
+            } for report_fp in report_fps
+        ]
+        # every sample is processed by a separate, single-threaded
+        # Bracken process - all of them can run at the same time
+        results = _run_concurrently(
+            _run_bracken_one_sample, kwargs_list, n_jobs=n_jobs,
+            return_exceptions=True
+        )
+
+    errors = [
+        f"{report_fp.name.replace('.report.txt', '')}: {error}"
+        for report_fp, error in zip(report_fps, results)
+        if isinstance(error, Exception)
+    ]
+    if errors:
+        raise Exception(
+            f"Bracken failed for {len(errors)} out of {len(report_fps)} "
+            "sample(s):\n" + "\n".join(errors)
+        )
+
+    bracken_table = pd.concat(results)
+    bracken_table = _counts_to_table(
+        bracken_table["sample_id"], bracken_table["taxonomy_id"],
+        bracken_table["new_est_reads"]
     )
-    bracken_table.fillna(0, inplace=True)
 
     return bracken_table, bracken_reports
 
@@ -111,22 +132,76 @@ def _assert_read_lens_available(
         )
 
 
+def _get_sample_read_lens(
+        kraken_reports: Kraken2ReportDirectoryFormat, read_len: int,
+        read_lens: NumericMetadataColumn = None
+) -> Dict[str, int]:
+    """Find the read length of every sample.
+
+    Read lengths provided in the metadata column take precedence over
+    the default read length.
+
+    Args:
+        kraken_reports (Kraken2ReportDirectoryFormat): Kraken 2 reports.
+        read_len (int): Default read length.
+        read_lens (NumericMetadataColumn): Read lengths of (some of)
+            the samples.
+
+    Returns:
+        dict: Read length of every sample.
+    """
+    sample_read_lens = {
+        fp.name.replace(".report.txt", ""): read_len
+        for fp in kraken_reports.path.iterdir()
+    }
+    if read_lens is None:
+        return sample_read_lens
+
+    lengths = read_lens.to_series().dropna()
+    if not (lengths % 1 == 0).all():
+        raise ValueError(
+            "Read lengths need to be whole numbers. Please check the "
+            f'"{read_lens.name}" metadata column.'
+        )
+    sample_read_lens.update({
+        sample_id: int(length) for sample_id, length in lengths.items()
+        if sample_id in sample_read_lens
+    })
+    return sample_read_lens
+
+
 def estimate_bracken(
     kraken_reports: Kraken2ReportDirectoryFormat,
     bracken_db: BrackenDBDirectoryFormat,
     threshold: int = 0,
     read_len: int = 100,
-    level: str = 'S'
-) -> (Kraken2ReportDirectoryFormat, pd.DataFrame, pd.DataFrame):
-    _assert_read_lens_available(bracken_db, read_len)
-
-    table, reports = _estimate_bracken(
-        kraken_reports=kraken_reports, bracken_db=bracken_db,
-        threshold=threshold, read_len=read_len, level=level
+    level: str = 'S',
+    n_jobs: int = 1,
+    backend: str = 'bracken',
+    read_lens: NumericMetadataColumn = None
+) -> (Kraken2ReportDirectoryFormat, pd.DataFrame, biom.Table):
+    sample_read_lens = _get_sample_read_lens(
+        kraken_reports, read_len, read_lens
     )
+    for length in sorted(set(sample_read_lens.values()) or {read_len}):
+        _assert_read_lens_available(bracken_db, length)
+
+    if backend == 'python':
+        table, reports = _estimate_bracken_python(
+            kraken_reports=kraken_reports, bracken_db=bracken_db,
+            threshold=threshold, read_len=read_len, level=level,
+            sample_read_lens=sample_read_lens
+        )
+    else:
+        table, reports = _estimate_bracken(
+            kraken_reports=kraken_reports, bracken_db=bracken_db,
+            threshold=threshold, read_len=read_len, level=level,
+            n_jobs=n_jobs, sample_read_lens=sample_read_lens
+        )
 
-    _, taxonomy = kraken2_to_features(
-        reports=reports, coverage_threshold=0.0
+    # only the taxonomy is needed - skip building of the feature table
+    taxonomy = _kraken2_to_taxonomy(
+        reports=reports, coverage_threshold=0.0, n_jobs=n_jobs
     )
 
     return reports, taxonomy, table
@@ -17,7 +17,12 @@ from q2_types.per_sample_sequences import (
     SingleLanePerSampleSingleEndFastqDirFmt
 )
 
-from q2_moshpit._utils import run_command, _process_common_input_params
+from q2_moshpit._utils import (
+    run_command, _process_common_input_params, _run_concurrently
+)
+from q2_moshpit.kraken2._format import (
+    Kraken2CompressedOutputDirectoryFormat
+)
 from q2_moshpit.kraken2.utils import _process_kraken2_arg
 from q2_types_genomics.feature_data import MAGSequencesDirFmt
 from q2_types_genomics.kraken2 import (
@@ -47,9 +52,61 @@ def _construct_output_paths(
     return output_fp, report_fp
 
 
+def _load_db_into_page_cache(db_dir: str, chunk_size: int = 2 ** 26):
+    """Reads all the database files once so that they end up in the
+        page cache of the OS.
+
+    Kraken 2 processes started with the '--memory-mapping' flag will
+    then map the already cached database instead of reading it from
+    disk again for every sample.
+
+    Args:
+        db_dir (str): Path to the Kraken 2 database directory.
+        chunk_size (int): Size of the buffer used to read the files.
+    """
+    buffer = bytearray(chunk_size)
+    for fp in sorted(glob.glob(os.path.join(db_dir, "*.k2d"))):
+        with open(fp, "rb") as f:
+            while f.readinto(buffer):
+                pass
+
+
+def _run_kraken2_compressed(cmd, output_fp, verbose=True):
+    """Runs Kraken 2 and compresses the per-read results it writes to
+        stdout with gzip, so that they are never stored uncompressed.
+
+    Args:
+        cmd (list): Kraken 2 command writing its output to stdout
+            (i.e., run with '--output -').
+        output_fp (str): Path to the compressed output file.
+        verbose (bool): Print the command being run.
+    """
+    gzip_cmd = ["gzip", "-c"]
+    if verbose:
+        print("\nCommand:", end=' ')
+        print(" ".join([*cmd, "|", *gzip_cmd, ">", output_fp]), end='\n\n')
+    with open(output_fp, "wb") as out:
+        kraken2 = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        gzip = subprocess.Popen(gzip_cmd, stdin=kraken2.stdout, stdout=out)
+        # only gzip should hold the pipe open so that Kraken 2 gets
+        # notified when gzip exits early
+        kraken2.stdout.close()
+        gzip_code = gzip.wait()
+        kraken2_code = kraken2.wait()
+    for code, _cmd in ((kraken2_code, cmd), (gzip_code, gzip_cmd)):
+        if code != 0:
+            raise subprocess.CalledProcessError(code, _cmd)
+
+
 def _classify_kraken2(
-        seqs, common_args
-) -> (Kraken2ReportDirectoryFormat, Kraken2OutputDirectoryFormat):
+        seqs, common_args, n_jobs: int = 1, compress_hits: bool = False
+) -> (
+        Kraken2ReportDirectoryFormat,
+        Union[
+            Kraken2OutputDirectoryFormat,
+            Kraken2CompressedOutputDirectoryFormat
+        ]
+):
     if isinstance(seqs, MAGSequencesDirFmt):
         manifest = None
     else:
@@ -60,7 +117,10 @@ def _classify_kraken2(
         base_cmd.append("--paired")
 
     kraken2_reports_dir = Kraken2ReportDirectoryFormat()
-    kraken2_outputs_dir = Kraken2OutputDirectoryFormat()
+    if compress_hits:
+        kraken2_outputs_dir = Kraken2CompressedOutputDirectoryFormat()
+    else:
+        kraken2_outputs_dir = Kraken2OutputDirectoryFormat()
 
     def get_paths_for_reads(index, row):
         return _get_seq_paths(index, row, list(manifest.columns))
@@ -79,16 +139,32 @@ def _classify_kraken2(
             )
             path_function = get_paths_for_mags
 
+        cmds = []
         for args in iterate_over:
             _sample, fn = path_function(*args)
             output_fp, report_fp = _construct_output_paths(
                 _sample, kraken2_outputs_dir, kraken2_reports_dir
             )
             cmd = deepcopy(base_cmd)
-            cmd.extend(
-                ["--report", report_fp, "--output", output_fp, *fn]
-            )
-            run_command(cmd=cmd, verbose=True)
+            if compress_hits:
+                # the hits are piped from stdout straight into gzip
+                cmd.extend(["--report", report_fp, "--output", "-", *fn])
+                cmds.append({
+                    "cmd": cmd, "output_fp": f"{output_fp}.gz",
+                    "verbose": True
+                })
+            else:
+                cmd.extend(
+                    ["--report", report_fp, "--output", output_fp, *fn]
+                )
+                cmds.append({"cmd": cmd, "verbose": True})
+
+        # every sample is written to its own report/output files, so the
+        # results do not depend on how many of them are processed at once
+        _run_concurrently(
+            _run_kraken2_compressed if compress_hits else run_command,
+            cmds, n_jobs=n_jobs
+        )
     except subprocess.CalledProcessError as e:
         raise Exception(
             "An error was encountered while running Kraken 2, "
@@ -99,6 +175,29 @@ def _classify_kraken2(
     return kraken2_reports_dir, kraken2_outputs_dir
 
 
+def _construct_common_args(
+        kraken2_db: Kraken2DBDirectoryFormat, kwargs: dict, n_jobs: int,
+        preload_db: bool
+) -> list:
+    if n_jobs > 1:
+        # split the thread budget across the concurrent Kraken 2 processes
+        # and let them all memory-map the same database - this way it only
+        # occupies the RAM (page cache) once instead of once per process
+        kwargs["threads"] = max(1, kwargs["threads"] // n_jobs)
+        kwargs["memory_mapping"] = True
+    if preload_db:
+        # load the database only once and let all the Kraken 2 processes
+        # map it from the page cache instead of reading it for every sample
+        print("Loading the Kraken 2 database into memory...")
+        _load_db_into_page_cache(str(kraken2_db.path))
+        kwargs["memory_mapping"] = True
+    common_args = _process_common_input_params(
+        processing_func=_process_kraken2_arg, params=kwargs
+    )
+    common_args.extend(["--db", str(kraken2_db.path)])
+    return common_args
+
+
 def classify_kraken2(
         seqs: Union[
             SingleLanePerSamplePairedEndFastqDirFmt,
@@ -112,15 +211,46 @@ def classify_kraken2(
         memory_mapping: bool = False,
         minimum_hit_groups: int = 2,
         quick: bool = False,
-        report_minimizer_data: bool = False
+        report_minimizer_data: bool = False,
+        n_jobs: int = 1,
+        preload_db: bool = False
 ) -> (
         Kraken2ReportDirectoryFormat,
         Kraken2OutputDirectoryFormat,
 ):
     kwargs = {k: v for k, v in locals().items()
-              if k not in ["seqs", "kraken2_db"]}
-    common_args = _process_common_input_params(
-        processing_func=_process_kraken2_arg, params=kwargs
+              if k not in ["seqs", "kraken2_db", "n_jobs", "preload_db"]}
+    common_args = _construct_common_args(
+        kraken2_db, kwargs, n_jobs, preload_db
+    )
+    return _classify_kraken2(seqs, common_args, n_jobs=n_jobs)
+
+
+def classify_kraken2_compressed(
+        seqs: Union[
+            SingleLanePerSamplePairedEndFastqDirFmt,
+            SingleLanePerSampleSingleEndFastqDirFmt,
+            MAGSequencesDirFmt,
+        ],
+        kraken2_db: Kraken2DBDirectoryFormat,
+        threads: int = 1,
+        confidence: float = 0.0,
+        minimum_base_quality: int = 0,
+        memory_mapping: bool = False,
+        minimum_hit_groups: int = 2,
+        quick: bool = False,
+        report_minimizer_data: bool = False,
+        n_jobs: int = 1,
+        preload_db: bool = False
+) -> (
+        Kraken2ReportDirectoryFormat,
+        Kraken2CompressedOutputDirectoryFormat,
+):
+    kwargs = {k: v for k, v in locals().items()
+              if k not in ["seqs", "kraken2_db", "n_jobs", "preload_db"]}
+    common_args = _construct_common_args(
+        kraken2_db, kwargs, n_jobs, preload_db
+    )
+    return _classify_kraken2(
+        seqs, common_args, n_jobs=n_jobs, compress_hits=True
     )
-    common_args.extend(["--db", str(kraken2_db.path)])
-    return _classify_kraken2(seqs, common_args)
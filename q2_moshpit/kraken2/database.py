@@ -6,25 +6,38 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 import glob
+import hashlib
+import io
+import json
 import os
 import re
 import shutil
+import string
 import subprocess
 import tarfile
 import tempfile
-from copy import deepcopy
-from typing import List
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
 
 import requests
 import xmltodict
 from q2_types.feature_data import DNAFASTAFormat
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 
-from q2_moshpit._utils import _process_common_input_params, run_command
+from q2_moshpit._utils import (
+    _process_common_input_params, run_command, _run_concurrently,
+    _evict_cache_entries, _hash_file, _get_cache_dir, _get_cache_size
+)
 from q2_types_genomics.kraken2 import (
     Kraken2DBDirectoryFormat, BrackenDBDirectoryFormat,
 )
 
+from q2_moshpit.kraken2._format import Kraken2LibraryDirectoryFormat
+
 from q2_moshpit.kraken2.utils import _process_kraken2_arg
 
 
@@ -43,7 +56,25 @@ COLLECTIONS = {
     "eupathdb": "eupathdb48",
 }
 S3_COLLECTIONS_URL = 'https://genome-idx.s3.amazonaws.com'
-CHUNK_SIZE = 8192
+CHUNK_SIZE = 2**20
+MIN_PART_SIZE = 2**22
+MAX_PART_SIZE = 2**25
+PARTS_PER_CONNECTION = 8
+# maximum size of the downloaded parts held in memory at once
+MAX_BUFFERED_SIZE = 2**28
+MAX_RETRIES = 5
+TIMEOUT = 60
+# files created in the taxonomy directory while building the database
+TAXONOMY_BUILD_FILES = ["prelim_map.txt"]
+COLLECTION_CACHE_DIR_VAR = "Q2_MOSHPIT_KRAKEN2_CACHE_DIR"
+COLLECTION_CACHE_SIZE = 2**38
+COLLECTION_CACHE_SIZE_VAR = "Q2_MOSHPIT_KRAKEN2_CACHE_GB"
+# space required by an extracted collection, relative to its archive
+COLLECTION_EXTRACTION_RATIO = 2
+# dustmasker marks low-complexity regions in lowercase
+MASKED_BASES = bytes.maketrans(
+    string.ascii_lowercase.encode(), b"x" * len(string.ascii_lowercase)
+)
 
 
 def _fetch_taxonomy(db_dir: str, threads: int, use_ftp: bool):
@@ -62,6 +93,32 @@ def _fetch_taxonomy(db_dir: str, threads: int, use_ftp: bool):
         )
 
 
+def _fetch_library(
+        db_dir: str, staging_dir: str, library: str, common_args: List[str]
+):
+    """Download a library into a staging directory and move it into
+    the database once the download is complete."""
+    os.makedirs(staging_dir, exist_ok=True)
+    cmd = [
+        "kraken2-build", "--download-library", library,
+        *common_args, "--db", staging_dir
+    ]
+    try:
+        run_command(cmd=cmd, verbose=True)
+    except subprocess.CalledProcessError as e:
+        raise Exception(
+            f"An error was encountered while downloading the "
+            f"'{library}' library, (return code {e.returncode}), "
+            "please inspect stdout and stderr to learn more."
+        )
+
+    lib_path = os.path.join(db_dir, "library", library)
+    if os.path.exists(lib_path):
+        shutil.rmtree(lib_path)
+    os.makedirs(os.path.dirname(lib_path), exist_ok=True)
+    shutil.move(os.path.join(staging_dir, "library", library), lib_path)
+
+
 def _fetch_libraries(db_dir: str, libraries: List[str], all_kwargs: dict):
     kwargs = {
         k: v for k, v in all_kwargs.items()
@@ -70,11 +127,8 @@ def _fetch_libraries(db_dir: str, libraries: List[str], all_kwargs: dict):
     common_args = _process_common_input_params(
         processing_func=_process_kraken2_arg, params=kwargs
     )
-    common_args.extend(["--db", db_dir])
-    base_cmd = [
-        "kraken2-build", "--download-library",
-    ]
     fetch_behaviour = all_kwargs.get("library_exists", "refetch")
+    to_fetch = []
     for library in libraries:
         if fetch_behaviour == "skip":
             lib_path = os.path.join(db_dir, "library", library)
@@ -84,16 +138,24 @@ def _fetch_libraries(db_dir: str, libraries: List[str], all_kwargs: dict):
                     f"already exists."
                 )
                 continue
-        try:
-            cmd = deepcopy(base_cmd)
-            cmd.extend([library, *common_args])
-            run_command(cmd=cmd, verbose=True)
-        except subprocess.CalledProcessError as e:
-            raise Exception(
-                f"An error was encountered while downloading the "
-                f"'{library}' library, (return code {e.returncode}), "
-                "please inspect stdout and stderr to learn more."
-            )
+        to_fetch.append(library)
+
+    # every library is downloaded into a separate directory, so that
+    # concurrent downloads do not interfere with each other
+    staging_root = os.path.join(db_dir, "staging")
+    try:
+        _run_concurrently(
+            _fetch_library, [
+                {
+                    "db_dir": db_dir,
+                    "staging_dir": os.path.join(staging_root, library),
+                    "library": library, "common_args": common_args
+                } for library in to_fetch
+            ],
+            n_jobs=all_kwargs.get("n_jobs", 1)
+        )
+    finally:
+        shutil.rmtree(staging_root, ignore_errors=True)
 
 
 def _add_seqs_to_library(db_dir: str, seqs: DNAFASTAFormat, no_masking: bool):
@@ -112,6 +174,106 @@ def _add_seqs_to_library(db_dir: str, seqs: DNAFASTAFormat, no_masking: bool):
         )
 
 
+def _mask_low_complexity(fasta_fp: str, masked_fp: str):
+    """Mask low-complexity regions of the sequences the same way
+    kraken2-build does: with dustmasker, replacing masked bases by x."""
+    dust_fp = f"{masked_fp}.dust"
+    cmd = [
+        "dustmasker", "-in", fasta_fp, "-outfmt", "fasta", "-out", dust_fp
+    ]
+    try:
+        run_command(cmd=cmd, verbose=True)
+    except subprocess.CalledProcessError as e:
+        raise Exception(
+            "An error was encountered while masking low-complexity "
+            f"sequences, (return code {e.returncode}), please inspect "
+            "stdout and stderr to learn more."
+        )
+    with open(dust_fp, "rb") as src, open(masked_fp, "wb") as dst:
+        for line in src:
+            if not line.startswith(b">"):
+                line = line.translate(MASKED_BASES)
+            dst.write(line)
+    os.remove(dust_fp)
+
+
+def _split_into_batches(fps: List[str], n_batches: int) -> List[List[str]]:
+    """Split files into at most n_batches batches of similar total size.
+
+    Starting with the largest one, every file is assigned to the batch
+    with the smallest total size so far.
+    """
+    sizes = [0] * min(n_batches, len(fps))
+    batches = [[] for _ in sizes]
+    for fp in sorted(fps, key=os.path.getsize, reverse=True):
+        smallest = sizes.index(min(sizes))
+        batches[smallest].append(fp)
+        sizes[smallest] += os.path.getsize(fp)
+    return batches
+
+
+def _concatenate_fasta(fps: List[str], out_fp: str):
+    with open(out_fp, "wb") as out:
+        for fp in fps:
+            with open(fp, "rb") as fh:
+                shutil.copyfileobj(fh, out, CHUNK_SIZE)
+                if fh.tell() == 0:
+                    continue
+                # the next file needs to start on a new line
+                fh.seek(-1, os.SEEK_END)
+                if fh.read(1) != b"\n":
+                    out.write(b"\n")
+
+
+def _prepare_library_batch(fps: List[str], batch_fp: str, no_masking: bool):
+    if no_masking:
+        _concatenate_fasta(fps, batch_fp)
+        return
+    _concatenate_fasta(fps, f"{batch_fp}.tmp")
+    _mask_low_complexity(f"{batch_fp}.tmp", batch_fp)
+    os.remove(f"{batch_fp}.tmp")
+
+
+def _add_seq_batches_to_library(
+        db_dir: str, seqs: List[DNAFASTAFormat], no_masking: bool,
+        threads: int = 1
+):
+    """Add many sequence files to the library in a few large batches.
+
+    Rather than running kraken2-build for every file, the files are
+    concatenated into (at most) as many batches as there are threads.
+    The batches are masked concurrently and only then added to the
+    library, without being masked again.
+
+    Args:
+        db_dir (str): Directory of the database.
+        seqs (list): Sequences to be added to the library.
+        no_masking (bool): Do not mask low-complexity sequences.
+        threads (int): Number of batches to be prepared concurrently.
+    """
+    batch_dir = os.path.join(db_dir, "batches")
+    os.makedirs(batch_dir, exist_ok=True)
+    batches = _split_into_batches([str(seq.path) for seq in seqs], threads)
+    batch_fps = [
+        os.path.join(batch_dir, f"batch{i}.fna") for i in range(len(batches))
+    ]
+    try:
+        _run_concurrently(
+            _prepare_library_batch, [
+                {"fps": fps, "batch_fp": batch_fp, "no_masking": no_masking}
+                for fps, batch_fp in zip(batches, batch_fps)
+            ],
+            n_jobs=threads
+        )
+        for batch_fp in batch_fps:
+            _add_seqs_to_library(
+                db_dir=db_dir, seqs=DNAFASTAFormat(batch_fp, mode="r"),
+                no_masking=True
+            )
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+
 def _build_kraken2_database(db_dir: str, all_kwargs: dict):
     kwargs = {
         k: v for k, v in all_kwargs.items()
@@ -155,6 +317,38 @@ def _build_bracken_database(
         )
 
 
+def _build_bracken_databases(
+        kraken2_db_dir: str, threads: int, kmer_len: int,
+        read_lens: List[int]
+):
+    """Build Bracken databases for multiple read lengths.
+
+    The most expensive step of every build is the classification of the
+    whole library (database.kraken), which is independent of the read
+    length. bracken-build skips that step when its results already exist,
+    so only the first build classifies the library, using all the threads.
+    The builds for the remaining read lengths then run concurrently,
+    splitting the threads between them.
+    """
+    if not read_lens:
+        return
+    _build_bracken_database(
+        kraken2_db_dir=kraken2_db_dir, threads=threads,
+        kmer_len=kmer_len, read_len=read_lens[0]
+    )
+    n_jobs = max(min(threads, len(read_lens) - 1), 1)
+    _run_concurrently(
+        _build_bracken_database, [
+            {
+                "kraken2_db_dir": kraken2_db_dir,
+                "threads": max(threads // n_jobs, 1),
+                "kmer_len": kmer_len, "read_len": read_len
+            } for read_len in read_lens[1:]
+        ],
+        n_jobs=n_jobs
+    )
+
+
 def _find_latest_db(collection: str, response: requests.Response) -> str:
     collection_id = COLLECTIONS[collection]
     pattern = fr'kraken\/k2_{collection_id}_\d{{8}}.tar.gz'
@@ -175,7 +369,587 @@ def _find_latest_db(collection: str, response: requests.Response) -> str:
     return latest_db
 
 
-def _fetch_db_collection(collection: str, tmp_dir: str):
+def _get_session(n_connections: int) -> requests.Session:
+    """Create an HTTP session with a pool of reusable connections.
+
+    Requests failing due to connection or server errors are retried
+    with an exponential backoff.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=max(n_connections, 1),
+        max_retries=Retry(
+            total=MAX_RETRIES, backoff_factor=1,
+            status_forcelist=[500, 502, 503, 504]
+        )
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _get_part_size(total_size: int, n_connections: int) -> int:
+    """Find the size of the parts a remote file should be downloaded in.
+
+    The part size grows with the size of the file, so that the number of
+    requests stays bounded, while every connection still gets several
+    parts to download. Parts are held in memory until they are consumed,
+    hence the upper limit: two parts per connection need to fit into
+    the memory reserved for the download.
+    """
+    part_size = -(-total_size // (n_connections * PARTS_PER_CONNECTION))
+    max_part_size = min(
+        MAX_PART_SIZE, MAX_BUFFERED_SIZE // (2 * n_connections)
+    )
+    return max(min(part_size, max_part_size), MIN_PART_SIZE)
+
+
+def _get_parts_ahead(part_size: int, n_connections: int) -> int:
+    """Find how many parts can be downloaded ahead of the consumer
+    without exceeding the memory reserved for the download."""
+    return max(min(2 * n_connections, MAX_BUFFERED_SIZE // part_size), 1)
+
+
+def _iter_range(
+        session: requests.Session, url: str, start: int, end: int,
+        etag: str = None
+) -> Iterator[bytes]:
+    """Download a byte range of a remote file.
+
+    Transfers which get interrupted are resumed from the last received
+    byte. If the remote file changes in the meantime, the download fails.
+
+    Yields:
+        bytes: Consecutive chunks of the range.
+    """
+    offset, attempt = start, 0
+    while offset <= end:
+        headers = {"Range": f"bytes={offset}-{end}"}
+        if etag:
+            headers["If-Match"] = etag
+        try:
+            with session.get(
+                    url, headers=headers, stream=True, timeout=TIMEOUT
+            ) as response:
+                if response.status_code != 206:
+                    raise ValueError(
+                        f'Could not download bytes {offset}-{end} of '
+                        f'"{url}". Status code was: '
+                        f'{response.status_code}. Please try again.'
+                    )
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    offset += len(chunk)
+                    attempt = 0
+                    yield chunk
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout
+        ):
+            pass  # continue from the last received byte
+        if offset <= end:
+            attempt += 1
+            if attempt > MAX_RETRIES:
+                raise requests.exceptions.ConnectionError(
+                    f'Download of bytes {offset}-{end} of "{url}" '
+                    f'was interrupted {MAX_RETRIES} times in a row'
+                )
+            time.sleep(2 ** (attempt - 1))
+
+
+def _fetch_range(
+        session: requests.Session, url: str, start: int, end: int,
+        etag: str = None
+) -> bytes:
+    return b"".join(_iter_range(session, url, start, end, etag))
+
+
+class _ETagDigest:
+    """Calculates the ETag S3 assigns to an object with the same contents.
+
+    ETags of objects uploaded to S3 in a single part are MD5 digests of
+    their contents. ETags of multipart uploads are MD5 digests of the
+    concatenated (binary) MD5 digests of all the parts, followed by "-"
+    and the number of parts.
+
+    Args:
+        part_size (int): Size of the uploaded parts or None, if the object
+            was uploaded in a single part.
+    """
+    def __init__(self, part_size: int = None):
+        self._part_size = part_size
+        self._part = hashlib.md5()
+        self._part_remaining = part_size
+        self._part_digests = []
+
+    def update(self, data: bytes):
+        if self._part_size is None:
+            self._part.update(data)
+            return
+        view = memoryview(data)
+        while len(view):
+            size = min(len(view), self._part_remaining)
+            self._part.update(view[:size])
+            view = view[size:]
+            self._part_remaining -= size
+            if self._part_remaining == 0:
+                self._part_digests.append(self._part.digest())
+                self._part = hashlib.md5()
+                self._part_remaining = self._part_size
+
+    def hexdigest(self) -> str:
+        if self._part_size is None:
+            return self._part.hexdigest()
+        digests = list(self._part_digests)
+        if self._part_remaining != self._part_size or not digests:
+            digests.append(self._part.digest())
+        return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def _find_upload_part_size(
+        session: requests.Session, url: str, etag: str
+) -> Optional[int]:
+    """Find the size of the parts an S3 object was uploaded in.
+
+    The size of the first part is requested from S3 - all the other
+    parts (apart from the last one) have the same size.
+
+    Returns:
+        int: Size of the uploaded parts or None, if the object was not
+            uploaded in multiple parts or the size could not be found.
+    """
+    if not re.fullmatch(r'"?[0-9a-f]{32}-\d+"?', etag or ""):
+        return None
+    try:
+        response = session.head(
+            url, params={"partNumber": 1}, timeout=TIMEOUT
+        )
+    except requests.exceptions.RequestException:
+        return None
+    if response.status_code not in (200, 206):
+        return None
+    part_size = int(response.headers.get("content-length", 0))
+    return part_size or None
+
+
+def _verify_checksum(name: str, checksum: str, etag: str) -> bool:
+    """Verify a downloaded file using the ETag returned by S3.
+
+    The checksum needs to be calculated the same way S3 calculates
+    the ETag (see _ETagDigest), for both single- and multipart uploads.
+
+    Returns:
+        bool: Whether the file could be verified.
+
+    Raises:
+        ValueError: If the MD5 checksum of the file does not match the ETag.
+    """
+    expected = (etag or "").strip('"')
+    if not re.fullmatch(r"[0-9a-f]{32}(-\d+)?", expected):
+        return False
+    if checksum != expected:
+        raise ValueError(
+            f'Checksum of the downloaded file "{name}" ({checksum}) does '
+            f'not match the expected one ({expected}). Please try again.'
+        )
+    return True
+
+
+def _stream_file(
+        url: str, n_connections: int = 1, desc: str = None
+) -> Iterator[bytes]:
+    """Download a remote file as a stream of consecutive chunks.
+
+    The file is split into byte ranges (parts) which are downloaded over
+    a pool of connections, while the parts which are already complete are
+    handed over to the consumer in order. Only a limited number of parts
+    is downloaded ahead of the consumer, so that the memory use stays
+    below MAX_BUFFERED_SIZE. Once the whole file is consumed, it is
+    verified using the ETag provided by the server, where available -
+    also for files uploaded to S3 in multiple parts, as long as the size
+    of those parts can be found.
+
+    Args:
+        url (str): URL of the file.
+        n_connections (int): Number of concurrent connections.
+        desc (str): Description of the download shown in the progress bar.
+
+    Yields:
+        bytes: Consecutive chunks of the file.
+
+    Raises:
+        ValueError: If the file could not be downloaded or was corrupted.
+    """
+    session = _get_session(n_connections)
+    response = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    if response.status_code != 200:
+        raise ValueError(
+            f'Could not fetch "{url}". Status code was: '
+            f'{response.status_code}. Please try again later.'
+        )
+    total_size = int(response.headers.get("content-length", 0))
+    etag = response.headers.get("etag")
+    expected_etag = etag
+    upload_part_size = _find_upload_part_size(session, url, etag)
+    if upload_part_size is None and "-" in (etag or ""):
+        print(
+            f'The size of the parts "{url}" was uploaded in could not be '
+            'found - the downloaded file will not be verified.'
+        )
+        expected_etag = None
+    digest = _ETagDigest(upload_part_size)
+
+    with tqdm(desc=desc, total=total_size or None, unit="B",
+              unit_scale=True, unit_divisor=1024) as progress_bar:
+        if "bytes" not in response.headers.get("accept-ranges", "") \
+                or total_size == 0:
+            # the file can only be downloaded at once, over one connection
+            with session.get(url, stream=True, timeout=TIMEOUT) as response:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    digest.update(chunk)
+                    progress_bar.update(len(chunk))
+                    yield chunk
+        else:
+            part_size = _get_part_size(total_size, n_connections)
+            parts_ahead = _get_parts_ahead(part_size, n_connections)
+            parts = deque()
+            with ThreadPoolExecutor(max_workers=n_connections) as executor:
+                try:
+                    for start in range(0, total_size, part_size):
+                        parts.append(executor.submit(
+                            _fetch_range, session, url, start,
+                            min(start + part_size, total_size) - 1, etag
+                        ))
+                        if len(parts) < parts_ahead:
+                            continue
+                        chunk = parts.popleft().result()
+                        digest.update(chunk)
+                        progress_bar.update(len(chunk))
+                        yield chunk
+                    while parts:
+                        chunk = parts.popleft().result()
+                        digest.update(chunk)
+                        progress_bar.update(len(chunk))
+                        yield chunk
+                finally:
+                    # the consumer may stop early
+                    for part in parts:
+                        part.cancel()
+
+    _verify_checksum(
+        os.path.basename(url), digest.hexdigest(), expected_etag
+    )
+
+
+class _ChunkStream(io.RawIOBase):
+    """Read-only file-like object reading from an iterator of chunks."""
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not len(self._chunk):
+            try:
+                self._chunk = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+def _find_gzip_decompressor(threads: int = 1) -> Optional[List[str]]:
+    """Find a command for fast gzip decompression, if one is installed.
+
+    igzip (ISA-L) is preferred thanks to its much faster inflation,
+    followed by pigz, which offloads reading, writing and checksum
+    calculation to separate threads.
+
+    Returns:
+        list: The command decompressing stdin to stdout or None, if no
+            suitable tool is available.
+    """
+    if shutil.which("igzip"):
+        return ["igzip", "-d", "-c"]
+    if shutil.which("pigz"):
+        return ["pigz", "-d", "-c", "-p", str(threads)]
+    return None
+
+
+def _extract_tar_members(fileobj, mode: str, destinations: Dict[str, str]):
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        for member in tar:
+            extension = os.path.splitext(member.name)[1].lstrip(".")
+            if not member.isfile() or extension not in destinations:
+                continue
+            fp = os.path.join(
+                destinations[extension], os.path.basename(member.name)
+            )
+            with tar.extractfile(member) as src, open(fp, "wb") as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+def _feed_stream(src, dst):
+    try:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    finally:
+        dst.close()
+
+
+def _extract_db_files(
+        fileobj, destinations: Dict[str, str],
+        decompress_cmd: List[str] = None
+):
+    """Extract database files from a streamed .tar.gz archive.
+
+    The archive is read sequentially, in a single pass. Members with one
+    of the requested extensions are written directly into the respective
+    destination directories (ignoring the directory structure of the
+    archive), all the other members are skipped.
+
+    When a decompression command is provided, the archive is decompressed
+    by that external process (running alongside the extraction) instead
+    of Python's single-threaded gzip module.
+
+    Args:
+        fileobj: File-like object to read the archive from.
+        destinations (dict): Directory where the files with the given
+            extension should be extracted to, by extension.
+        decompress_cmd (list): Command decompressing stdin to stdout.
+    """
+    if not decompress_cmd:
+        _extract_tar_members(fileobj, "r|gz", destinations)
+        return
+
+    with subprocess.Popen(
+        decompress_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    ) as process, ThreadPoolExecutor(max_workers=1) as executor:
+        feeding = executor.submit(_feed_stream, fileobj, process.stdin)
+        try:
+            _extract_tar_members(process.stdout, "r|", destinations)
+            # anything after the end of the archive needs to be consumed
+            # for the decompression to finish
+            while process.stdout.read(CHUNK_SIZE):
+                pass
+        except BaseException:
+            process.kill()
+            # an interrupted download is the likely cause of the failure
+            error = feeding.exception()
+            if error is not None and \
+                    not isinstance(error, BrokenPipeError):
+                raise error
+            raise
+        feeding.result()
+        if process.wait() != 0:
+            raise Exception(
+                "An error was encountered while decompressing the "
+                f"database, (return code {process.returncode}), please "
+                "inspect stdout and stderr to learn more."
+            )
+
+
+def _find_s3_object(response: requests.Response, key: str) \
+        -> Optional[dict]:
+    """Find the description (ETag, Size, ...) of an S3 object
+    in the bucket listing."""
+    s3_objects = xmltodict.parse(response.content).get('ListBucketResult')
+    if not s3_objects:
+        return None
+    contents = s3_objects.get('Contents') or []
+    if isinstance(contents, dict):
+        contents = [contents]
+    for obj in contents:
+        if obj.get('Key') == key:
+            return obj
+    return None
+
+
+def _get_collection_cache_dir() -> Optional[str]:
+    """Find the cache of extracted database collections.
+
+    The cache is only used when its location is set using
+    the Q2_MOSHPIT_KRAKEN2_CACHE_DIR environment variable.
+    """
+    return _get_cache_dir(
+        COLLECTION_CACHE_DIR_VAR, COLLECTION_CACHE_SIZE_VAR,
+        COLLECTION_CACHE_SIZE
+    )
+
+
+def _get_collection_cache_size() -> int:
+    return _get_cache_size(COLLECTION_CACHE_SIZE_VAR, COLLECTION_CACHE_SIZE)
+
+
+def _can_cache_collection(
+        cache_dir: str, destinations: Dict[str, str], archive_size: int
+) -> bool:
+    """Check whether a collection can be added to the cache.
+
+    Cached files are hardlinked into the destination directories, so the
+    cache needs to be located on the same file system - copying the files
+    would write the whole database twice. The cache also needs to have
+    enough space for the extracted collection.
+
+    Args:
+        cache_dir (str): Path to the cache.
+        destinations (dict): Destination directories of the database
+            files.
+        archive_size (int): Size of the collection archive in bytes.
+
+    Returns:
+        bool: Whether the collection can be cached.
+    """
+    device = os.stat(cache_dir).st_dev
+    if any(os.stat(d).st_dev != device for d in destinations.values()):
+        print(
+            'The database cache is located on a different file system '
+            'than the output, the database will not be cached.'
+        )
+        return False
+
+    required = archive_size * COLLECTION_EXTRACTION_RATIO
+    max_size = _get_collection_cache_size()
+    if required <= max_size:
+        _evict_cache_entries(cache_dir, max_size - required)
+        if shutil.disk_usage(cache_dir).free >= required:
+            return True
+    print(
+        'There is not enough space in the database cache, '
+        'the database will not be cached.'
+    )
+    return False
+
+
+def _link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _link_db_files(source: str, destinations: Dict[str, str]):
+    """Hardlink the database files into their destination directories.
+
+    Files are copied instead, when they cannot be linked (e.g., when
+    the destination is located on a different file system). If any of
+    the files cannot be linked nor copied, none of them are left behind.
+    """
+    linked = []
+    try:
+        for entry in os.scandir(source):
+            extension = os.path.splitext(entry.name)[1].lstrip(".")
+            if extension not in destinations:
+                continue
+            linked.append(
+                os.path.join(destinations[extension], entry.name)
+            )
+            _link_or_copy(entry.path, linked[-1])
+    except OSError:
+        for fp in linked:
+            if os.path.exists(fp):
+                os.remove(fp)
+        raise
+
+
+def _download_db_files(
+        url: str, desc: str, destinations: Dict[str, str], threads: int = 1,
+        n_connections: int = 1
+):
+    # the archive is extracted while it is being downloaded,
+    # without ever being saved
+    chunks = _stream_file(url, n_connections=n_connections, desc=desc)
+    try:
+        stream = io.BufferedReader(_ChunkStream(chunks), CHUNK_SIZE)
+        _extract_db_files(
+            stream, destinations,
+            decompress_cmd=_find_gzip_decompressor(threads)
+        )
+        # consume the rest of the archive to finish its verification
+        while stream.read(CHUNK_SIZE):
+            pass
+    finally:
+        chunks.close()
+
+
+def _download_cached_db_files(
+        url: str, desc: str, entry_dir: str, extensions: List[str],
+        threads: int = 1, n_connections: int = 1
+):
+    """Download database files into a new entry of the collection cache.
+
+    The files are extracted into a temporary directory first, which is
+    then renamed, so that incomplete entries never appear in the cache.
+    The cached files are made read-only, as they may get hardlinked.
+    """
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir), prefix=".")
+    try:
+        _download_db_files(
+            url, desc, {ext: tmp_dir for ext in extensions}, threads,
+            n_connections
+        )
+        for entry in os.scandir(tmp_dir):
+            os.chmod(entry.path, 0o444)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            if not os.path.isdir(entry_dir):
+                raise
+            # another process has cached the same collection meanwhile
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _fetch_cached_db_files(
+        url: str, desc: str, cache_dir: str, s3_object: dict,
+        destinations: Dict[str, str], threads: int = 1,
+        n_connections: int = 1
+) -> bool:
+    """Fetch database files of a collection through the cache.
+
+    A cached collection is identified by its key and ETag, which changes
+    whenever the collection is re-uploaded. Collections which are not
+    cached yet get downloaded into the cache, if they fit.
+
+    Returns:
+        bool: Whether the files were fetched - False, if the collection is
+            not cached and cannot be added to the cache.
+    """
+    key, etag = s3_object['Key'], s3_object['ETag']
+    entry_dir = os.path.join(
+        cache_dir,
+        hashlib.blake2b(f"{key}\0{etag}".encode(), digest_size=16).hexdigest()
+    )
+    if os.path.isdir(entry_dir):
+        print(f'Using the cached "{key}" database.')
+    elif _can_cache_collection(
+            cache_dir, destinations, int(s3_object.get('Size') or 0)
+    ):
+        _download_cached_db_files(
+            url, desc, entry_dir, list(destinations), threads,
+            n_connections
+        )
+    else:
+        return False
+
+    _link_db_files(entry_dir, destinations)
+    try:
+        os.utime(entry_dir)  # mark as recently used
+        _evict_cache_entries(
+            cache_dir, _get_collection_cache_size(), keep=entry_dir
+        )
+    except OSError:
+        pass  # the database files are already in place
+    return True
+
+
+def _fetch_db_collection(
+        collection: str, destinations: Dict[str, str], threads: int = 1,
+        n_connections: int = 1
+):
     err_msg = 'Could not connect to the server. Please check your internet ' \
               'connection and try again. The error was: {}.'
     try:
@@ -194,31 +968,31 @@ def _fetch_db_collection(collection: str, tmp_dir: str):
         )
 
     db_uri = f'{S3_COLLECTIONS_URL}/{latest_db}'
+    desc = f'Downloading the "{latest_db}" database'
+    s3_object = _find_s3_object(response, latest_db) or {}
+    cache_dir = _get_collection_cache_dir()
     try:
-        response = requests.get(db_uri, stream=True)
-        total_size = int(response.headers.get('content-length', 0))
-        if total_size > 0:
-            progress_bar = tqdm(
-                desc=f'Downloading the "{latest_db}" database',
-                total=total_size, unit='B',
-                unit_scale=True, unit_divisor=1024,
-            )
-        db_path = os.path.join(tmp_dir, os.path.split(db_uri)[-1])
-        with open(db_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                f.write(chunk) if chunk else False
-                if total_size > 0:
-                    progress_bar.update(len(chunk))
-            progress_bar.close() if total_size > 0 else False
-    except requests.exceptions.ConnectionError as e:
+        if cache_dir and s3_object.get('ETag'):
+            try:
+                if _fetch_cached_db_files(
+                    db_uri, desc, cache_dir, s3_object, destinations,
+                    threads, n_connections
+                ):
+                    return
+            except requests.exceptions.RequestException:
+                raise
+            except OSError as e:
+                # e.g. the cache ran out of space
+                print(
+                    f'The database cache could not be used ({e}), '
+                    'the database will be downloaded directly.'
+                )
+        _download_db_files(
+            db_uri, desc, destinations, threads, n_connections
+        )
+    except requests.exceptions.RequestException as e:
         raise ValueError(err_msg.format(e))
 
-    msg = "Download finished. Extracting database files..."
-    print(f"{msg}", end="", flush=True)
-    with tarfile.open(db_path, "r:gz") as tar:
-        tar.extractall(path=tmp_dir)
-    print(f"\r{msg} Done.", flush=True)
-
 
 def _move_db_files(source: str, destination: str, extension: str = "k2d"):
     files = glob.glob(f"{source}/*.{extension}")
@@ -227,37 +1001,134 @@ def _move_db_files(source: str, destination: str, extension: str = "k2d"):
         shutil.move(file, new_file)
 
 
-def _fetch_prebuilt_dbs(bracken_db, kraken2_db, collection, tmp):
-    # Find files with the latest version
-    _fetch_db_collection(collection=collection, tmp_dir=tmp)
-    # Move the Kraken2/Bracken database files to the final location
-    _move_db_files(tmp, str(kraken2_db.path), extension="k2d")
-    _move_db_files(tmp, str(bracken_db.path), extension="kmer_distrib")
+def _fetch_prebuilt_dbs(
+        bracken_db, kraken2_db, collection, threads=1, n_connections=1
+):
+    # Find files with the latest version and extract the Kraken2/Bracken
+    # database files directly into their final location
+    _fetch_db_collection(
+        collection=collection,
+        destinations={
+            "k2d": str(kraken2_db.path),
+            "kmer_distrib": str(bracken_db.path)
+        },
+        threads=threads, n_connections=n_connections
+    )
 
 
-def _build_dbs_from_seqs(bracken_db, kraken2_db, seqs, tmp_dir, common_args):
-    # Fetch taxonomy (also needed for custom databases)
-    _fetch_taxonomy(
-        db_dir=tmp_dir, threads=common_args["threads"],
-        use_ftp=common_args["use_ftp"]
+def _has_taxonomy(db_dir: str) -> bool:
+    return all(
+        os.path.isfile(os.path.join(db_dir, "taxonomy", fn))
+        for fn in ("nodes.dmp", "names.dmp")
     )
-    for seq in seqs:
-        _add_seqs_to_library(
-            db_dir=tmp_dir, seqs=seq, no_masking=common_args["no_masking"]
+
+
+def _link_tree(source: str, destination: str, exclude: List[str] = ()):
+    """Hardlink (or copy) all the files of a directory tree."""
+    for root, _, fns in os.walk(source):
+        dst_root = os.path.join(destination, os.path.relpath(root, source))
+        os.makedirs(dst_root, exist_ok=True)
+        for fn in fns:
+            if fn not in exclude:
+                _link_or_copy(
+                    os.path.join(root, fn), os.path.join(dst_root, fn)
+                )
+
+
+def _load_library(library: Kraken2LibraryDirectoryFormat, db_dir: str) \
+        -> dict:
+    """Set up a database directory with the taxonomy and the library
+    of a previous build.
+
+    Returns:
+        dict: Manifest of the library.
+    """
+    for subdir in ("taxonomy", "library"):
+        _link_tree(
+            os.path.join(str(library), subdir), os.path.join(db_dir, subdir)
+        )
+    with open(os.path.join(str(library), "manifest.json")) as fh:
+        return json.load(fh)
+
+
+def _save_library(
+        db_dir: str, library: Kraken2LibraryDirectoryFormat, manifest: dict
+):
+    """Save the taxonomy and the library of the database."""
+    _link_tree(
+        os.path.join(db_dir, "taxonomy"),
+        os.path.join(str(library), "taxonomy"), exclude=TAXONOMY_BUILD_FILES
+    )
+    _link_tree(
+        os.path.join(db_dir, "library"), os.path.join(str(library), "library")
+    )
+    with open(os.path.join(str(library), "manifest.json"), "w") as fh:
+        json.dump(manifest, fh)
+
+
+def _build_dbs_from_seqs(bracken_db, kraken2_db, seqs, tmp_dir, common_args):
+    # Fetch taxonomy (also needed for custom databases), unless it comes
+    # from a previous build
+    if not _has_taxonomy(tmp_dir):
+        _fetch_taxonomy(
+            db_dir=tmp_dir, threads=common_args["threads"],
+            use_ftp=common_args["use_ftp"]
+        )
+    # Fetch the requested reference libraries, next to the sequences
+    if common_args.get("libraries"):
+        _fetch_libraries(
+            db_dir=tmp_dir, libraries=common_args["libraries"],
+            all_kwargs=common_args
+        )
+    if seqs:
+        _add_seq_batches_to_library(
+            db_dir=tmp_dir, seqs=seqs,
+            no_masking=common_args["no_masking"],
+            threads=common_args["threads"]
         )
     # Build the Kraken2 database
     _build_kraken2_database(db_dir=tmp_dir, all_kwargs=common_args)
     # Build the Bracken database
-    for rl in common_args["read_len"]:
-        _build_bracken_database(
-            kraken2_db_dir=tmp_dir, threads=common_args["threads"],
-            kmer_len=common_args["kmer_len"], read_len=rl
-        )
+    _build_bracken_databases(
+        kraken2_db_dir=tmp_dir, threads=common_args["threads"],
+        kmer_len=common_args["kmer_len"], read_lens=common_args["read_len"]
+    )
     # Move the Kraken2/Bracken database files to the final location
     _move_db_files(tmp_dir, str(kraken2_db.path), extension="k2d")
     _move_db_files(tmp_dir, str(bracken_db.path), extension="kmer_distrib")
 
 
+def _build_dbs_from_library(
+        bracken_db, kraken2_db, new_library, seqs, library, tmp_dir,
+        common_args
+):
+    # Only the sequences which are not in the library yet get masked
+    # and added to it - the hash table and the k-mer distributions
+    # are always built from the whole library
+    manifest = {"seqs": [], "no_masking": common_args["no_masking"]}
+    if library is not None:
+        manifest = _load_library(library, tmp_dir)
+        if manifest["no_masking"] != common_args["no_masking"]:
+            raise ValueError(
+                'The library was built with "no_masking" set to '
+                f'{manifest["no_masking"]}. Please use the same setting to '
+                'update the database.'
+            )
+
+    added, new_seqs = set(manifest["seqs"]), {}
+    for seq in seqs:
+        digest = _hash_file(str(seq.path))
+        if digest not in added:
+            new_seqs.setdefault(digest, seq)
+    manifest["seqs"].extend(new_seqs)
+
+    _build_dbs_from_seqs(
+        bracken_db, kraken2_db, list(new_seqs.values()), tmp_dir,
+        common_args
+    )
+    _save_library(tmp_dir, new_library, manifest)
+
+
 def build_kraken_db(
     seqs: DNAFASTAFormat = None,
     collection: str = None,
@@ -271,6 +1142,10 @@ def build_kraken_db(
     load_factor: float = 0.7,
     fast_build: bool = False,
     read_len: int = None,
+    libraries: List[str] = None,
+    library_exists: str = 'skip',
+    n_jobs: int = 1,
+    n_connections: int = 4,
 ) -> (Kraken2DBDirectoryFormat, BrackenDBDirectoryFormat):
     kraken2_db = Kraken2DBDirectoryFormat()
     bracken_db = BrackenDBDirectoryFormat()
@@ -280,22 +1155,63 @@ def build_kraken_db(
         read_len = [50, 75, 100, 150, 200, 250, 300]
 
     with tempfile.TemporaryDirectory() as tmp:
-        if seqs:
+        if seqs or libraries:
             # Construct the custom-made database
-            common_args = {k: v for k, v in locals().items()
-                           if k not in ["seqs", "collection"]}
+            common_args = {
+                k: v for k, v in locals().items()
+                if k not in ["seqs", "collection", "n_connections"]
+            }
 
             # Fetch taxonomy (also needed for custom databases)
             _build_dbs_from_seqs(
                 bracken_db, kraken2_db, seqs, tmp, common_args
             )
         elif collection:
-            _fetch_prebuilt_dbs(bracken_db, kraken2_db, collection, tmp)
+            _fetch_prebuilt_dbs(
+                bracken_db, kraken2_db, collection, threads, n_connections
+            )
         else:
             raise ValueError(
-                'You need to either provide a list of sequences to build the '
-                'database from or a valid collection name to be fetched from '
-                '"Kraken 2/Bracken Refseq indexes" resource.'
+                'You need to either provide a list of sequences or libraries '
+                'to build the database from or a valid collection name to be '
+                'fetched from "Kraken 2/Bracken Refseq indexes" resource.'
             )
 
     return kraken2_db, bracken_db
+
+
+def update_kraken_db(
+    seqs: DNAFASTAFormat,
+    library: Kraken2LibraryDirectoryFormat = None,
+    threads: int = 1,
+    kmer_len: int = 35,
+    minimizer_len: int = 31,
+    minimizer_spaces: int = 7,
+    no_masking: bool = False,
+    max_db_size: int = 0,
+    use_ftp: bool = False,
+    load_factor: float = 0.7,
+    fast_build: bool = False,
+    read_len: int = None,
+    libraries: List[str] = None,
+    library_exists: str = 'skip',
+    n_jobs: int = 1,
+) -> (Kraken2DBDirectoryFormat, BrackenDBDirectoryFormat,
+      Kraken2LibraryDirectoryFormat):
+    kraken2_db = Kraken2DBDirectoryFormat()
+    bracken_db = BrackenDBDirectoryFormat()
+    new_library = Kraken2LibraryDirectoryFormat()
+
+    if not read_len:
+        # use the same values as in the pre-built databases
+        read_len = [50, 75, 100, 150, 200, 250, 300]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        common_args = {k: v for k, v in locals().items()
+                       if k not in ["seqs", "library", "new_library"]}
+        _build_dbs_from_library(
+            bracken_db, kraken2_db, new_library, seqs, library, tmp,
+            common_args
+        )
+
+    return kraken2_db, bracken_db, new_library
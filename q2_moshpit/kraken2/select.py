@@ -7,18 +7,23 @@
 # ----------------------------------------------------------------------------
 
 import os
-from collections import deque
-from typing import List
+from typing import List, Set, Tuple, Union
 
-from q2_moshpit.kraken2.utils import (
-    _find_lca, _taxon_to_list, _join_ranks
+from q2_moshpit._utils import _run_concurrently
+from q2_moshpit.kraken2._format import (
+    Kraken2CompressedOutputDirectoryFormat
 )
+from q2_moshpit.kraken2.tree import NCBITree
+from q2_moshpit.kraken2.utils import _find_group_lcas, _join_ranks
 from q2_types_genomics.kraken2 import (
-    Kraken2ReportDirectoryFormat, Kraken2OutputDirectoryFormat
+    Kraken2ReportDirectoryFormat, Kraken2OutputDirectoryFormat,
+    Kraken2ReportFormat
 )
 
+import biom
+import numpy as np
 import pandas as pd
-import skbio
+from scipy.sparse import coo_matrix
 
 RANKS = 'dkpcofgs'
 
@@ -34,27 +39,25 @@ def _find_lcas(taxa_list: List[pd.DataFrame], mode: str):
         pd.DataFrame: A DataFrame containing the LCA of each feature (MAG).
     """
     methods = {
-        'lca': _find_lca,
+        'lca': _find_group_lcas,
         # 'super': _find_super_lca,
         # 'majority': _find_lca_majority
     }
     func = methods[mode]
     taxa = pd.concat(taxa_list)
 
-    # Convert taxonomies to list; optionally remove rank handle
-    taxa['Taxon'] = taxa['Taxon'].apply(
-        lambda x: _taxon_to_list(x, rank_handle=f'^[{RANKS[:-1]}]__|s1?__')
-    )
-
-    # Find LCA for every MAG
-    results = {}
-    for mag_id in taxa['mag_id'].unique():
-        data = taxa[taxa['mag_id'] == mag_id]['Taxon']
-        result = func(data)
-        results[mag_id] = result
+    # Split taxonomies into a matrix of ranks (one column per rank)
+    # indexed by MAG IDs; remove rank handles
+    ranks = taxa['Taxon'].str.split(';', expand=True)
+    ranks.index = taxa['mag_id'].values
+    rank_handle = f'^[{RANKS[:-1]}]__|s1?__'
+    for col in ranks.columns:
+        ranks[col] = ranks[col].str.strip().str.replace(
+            rank_handle, '', regex=True
+        )
 
-    results = pd.DataFrame.from_dict(results, orient='index')
-    results = results.apply(lambda x: x.tolist(), axis=1).to_frame()
+    # Find LCA for all MAGs at once
+    results = func(ranks).to_frame()
     results.columns = ['Taxon']
 
     # Join ranks
@@ -69,24 +72,40 @@ def _find_lcas(taxa_list: List[pd.DataFrame], mode: str):
 
 def kraken2_to_mag_features(
         reports: Kraken2ReportDirectoryFormat,
-        hits: Kraken2OutputDirectoryFormat,
+        hits: Union[
+            Kraken2OutputDirectoryFormat,
+            Kraken2CompressedOutputDirectoryFormat
+        ],
         coverage_threshold: float = 0.1,
         # lca_mode: str = 'lca'
 ) -> pd.DataFrame:
-    table, taxonomy = kraken2_to_features(reports, coverage_threshold)
+    sample_ids, tips, taxonomy = _kraken2_to_features(
+        reports, coverage_threshold
+    )
 
+    MAG_COL = 1
+    TAXA_COL = 2
+    if isinstance(hits, Kraken2CompressedOutputDirectoryFormat):
+        # decompressed on the fly while parsing
+        hits_fn, compression = '{}.output.txt.gz', 'gzip'
+    else:
+        hits_fn, compression = '{}.output.txt', None
     taxa_list = []
     # convert IDs to match MAGs instead of taxids/db ids
-    for mag_id in table.index:
-        kraken_table_fp = (hits.path / f'{mag_id}.output.txt')
+    for mag_id, mag_tips in zip(sample_ids, tips):
+        if not mag_tips:
+            continue
+        kraken_table_fp = (hits.path / hits_fn.format(mag_id))
+        # only the contig ID and taxid columns are needed - skip parsing
+        # of the (potentially very long) LCA mapping and length columns
         hits_df = pd.read_csv(
-            kraken_table_fp, sep='\t', header=None, dtype='str'
+            kraken_table_fp, sep='\t', header=None,
+            usecols=[MAG_COL, TAXA_COL],
+            dtype={MAG_COL: 'str', TAXA_COL: 'str'},
+            compression=compression
         )
-        MAG_COL = 1
-        TAXA_COL = 2
 
-        mag_series = table.loc[mag_id, :]
-        mag_obs = mag_series[mag_series != 0]
+        mag_obs = pd.Series(True, index=mag_tips, name=mag_id)
         merged_df = hits_df.join(mag_obs, on=TAXA_COL, how='right')
         merged_df = merged_df.join(taxonomy, on=TAXA_COL, how='left')
 
@@ -98,99 +117,310 @@ def kraken2_to_mag_features(
     return _find_lcas(taxa_list, mode='lca')
 
 
-def kraken2_to_features(reports: Kraken2ReportDirectoryFormat,
-                        coverage_threshold: float = 0.1) \
-        -> (pd.DataFrame, pd.DataFrame):
+def _parse_kraken2_report(report_fp: str, coverage_threshold: float):
+    """Convert a single Kraken 2 report into an NCBI tree.
 
-    rows = []
-    trees = []
-    for relpath, df in reports.reports.iter_views(pd.DataFrame):
-        sample_id = os.path.basename(relpath).replace(".report.txt", "")
+    Args:
+        report_fp (str): Path to the Kraken 2 report.
+        coverage_threshold (float): The minimum percent coverage required
+            to keep a taxon in the tree.
 
-        filtered = df[df['perc_frags_covered'] >= coverage_threshold]
-        tree = _kraken_to_ncbi_tree(filtered)
-        tips = _ncbi_tree_to_tips(tree)
-        if tips:
-            table_row = pd.Series(True, index=_ncbi_tree_to_tips(tree))
-            table_row.name = sample_id
-            rows.append(table_row)
-        trees.append(tree)
+    Returns:
+        (NCBITree, list): Tree of all the taxa above the coverage threshold
+            and taxids of the tree's tips which were leaves of the report.
+    """
+    df = Kraken2ReportFormat(report_fp, mode='r').view(pd.DataFrame)
+    filtered = df[df['perc_frags_covered'] >= coverage_threshold]
+    tree = _kraken_to_ncbi_tree(filtered)
+    return tree, _ncbi_tree_to_tips(tree)
 
-    full_tree = _combine_ncbi_trees(trees)
 
-    table = pd.DataFrame(rows).fillna(False)
-    taxonomy = _to_taxonomy(full_tree)
+def _list_kraken2_reports(
+        reports: Kraken2ReportDirectoryFormat, coverage_threshold: float
+):
+    """Find sample IDs and arguments for parsing of all Kraken 2 reports.
 
-    return table, taxonomy
+    Returns:
+        (list, list): Sample IDs and keyword arguments for every report.
+    """
+    sample_ids, kwargs_list = [], []
+    for relpath, _ in reports.reports.iter_views(Kraken2ReportFormat):
+        sample_ids.append(
+            os.path.basename(relpath).replace(".report.txt", "")
+        )
+        kwargs_list.append({
+            "report_fp": os.path.join(str(reports.path), str(relpath)),
+            "coverage_threshold": coverage_threshold
+        })
+    return sample_ids, kwargs_list
+
+
+def _parse_kraken2_reports(
+        reports: Kraken2ReportDirectoryFormat, coverage_threshold: float,
+        n_jobs: int = 1
+):
+    """Convert all Kraken 2 reports into NCBI trees.
 
+    Reports are parsed independently of each other, by up to 'n_jobs'
+    processes at once.
 
-def _get_indentation(string, indent=2):
-    return (len(string) - len(string.lstrip(' '))) // indent
+    Returns:
+        (list, list, list): Sample IDs, their trees and tips.
+    """
+    sample_ids, kwargs_list = _list_kraken2_reports(
+        reports, coverage_threshold
+    )
+    results = _run_concurrently(
+        _parse_kraken2_report, kwargs_list, n_jobs=n_jobs,
+        use_processes=True
+    )
+    trees = [tree for tree, _ in results]
+    tips = [sample_tips for _, sample_tips in results]
+    return sample_ids, trees, tips
 
 
-def _kraken_to_ncbi_tree(df):
-    tree = skbio.TreeNode()
-    stack = deque([(0, tree)])
-    for _, row in df.iterrows():
-        r = row['rank']
-        label = row['name']
-        otu = str(row['ncbi_tax_id'])
+def _parse_kraken2_report_lineages(
+        report_fp: str, coverage_threshold: float, indent: int = 2
+) -> Tuple[List[Tuple[str, tuple]], Set[str]]:
+    """Find lineages of all the taxa of a single Kraken 2 report.
 
-        if r in ('U', 'R'):
-            continue  # unclassified or root
+    Equivalent to the taxonomy of the report's NCBI tree, but the tree
+    is never built. Just like in the tree, internal non-strain
+    infra-clades without any entries nested under them (e.g., "G1")
+    are represented by their names and lineages of their ancestors.
 
-        indent = _get_indentation(label)
-        name = f"{r.lower()}__{label.strip()}"
-        node = skbio.TreeNode(name=name, length=0.0)
+    Args:
+        report_fp (str): Path to the Kraken 2 report.
+        coverage_threshold (float): The minimum percent coverage required
+            to keep a taxon.
+        indent (int): Number of spaces used to indent every level
+            of the report.
+
+    Returns:
+        (list, set): Taxids of all the taxa above the coverage threshold
+            (or names of the childless infra-clades) with names of all
+            the entries above (and including) them, and names of all
+            the entries with other entries nested under them.
+    """
+    df = Kraken2ReportFormat(report_fp, mode='r').view(pd.DataFrame)
+    filtered = df[df['perc_frags_covered'] >= coverage_threshold]
+    indents, names, taxids, has_taxid = _report_entries(filtered, indent)
+    parents = _find_parents(indents)
+
+    lineages = []
+    for parent, name in zip(parents.tolist(), names):
+        lineages.append(
+            (lineages[parent] if parent >= 0 else ()) + (name,)
+        )
+    is_parent = np.zeros(len(names), dtype=bool)
+    is_parent[parents[parents >= 0]] = True
+
+    taxa = []
+    for taxid, lineage, is_taxon, has_children in zip(
+            taxids, lineages, has_taxid, is_parent
+    ):
+        if is_taxon:
+            taxa.append((taxid, lineage))
+        elif not has_children:
+            taxa.append((lineage[-1], lineage[:-1]))
+    return taxa, set(names[is_parent])
+
+
+def _kraken2_to_taxonomy(
+        reports: Kraken2ReportDirectoryFormat, coverage_threshold: float,
+        n_jobs: int = 1
+) -> pd.DataFrame:
+    """Find taxonomy of all the taxa found in the Kraken 2 reports.
+
+    A faster alternative to kraken2_to_features when only the taxonomy
+    is needed: lineages are taken directly from the reports, without
+    building and merging their trees or a feature table. Every taxid is
+    only converted into a taxonomy string once. Infra-clades without any
+    entries nested under them are only included if they have no nested
+    entries in any of the reports - like the tips of the merged trees.
+
+    Returns:
+        pd.DataFrame: Taxonomy of all the taxa, in order of their first
+            appearance in the reports.
+    """
+    _, kwargs_list = _list_kraken2_reports(reports, coverage_threshold)
+    results = _run_concurrently(
+        _parse_kraken2_report_lineages, kwargs_list, n_jobs=n_jobs,
+        use_processes=True
+    )
+
+    lineages, internal = {}, set()
+    for report_lineages, report_internal in results:
+        internal.update(report_internal)
+        for taxid, lineage in report_lineages:
+            lineages.setdefault(taxid, lineage)
+
+    rows = [(taxid, _pad_ranks(lineage))
+            for taxid, lineage in lineages.items() if taxid not in internal]
+    taxonomy = pd.DataFrame(rows, columns=['Feature ID', 'Taxon'])
+    taxonomy = taxonomy.set_index('Feature ID')
+
+    return taxonomy
 
-        # Don't include internal non-strain infra-clades as tips
-        if len(r) == 1 or r.startswith('S'):
-            id_node = skbio.TreeNode(name=otu, length=0.0)
-            node.length = 1.0  # not infra-clade, so give it a length
-            node.append(id_node)
 
-        parent_indent, parent_node = stack[-1]
-        if parent_indent >= indent and parent_node.children:
-            parent_node.children[0].is_actual_tip = True
+def _tips_to_table(sample_ids: List[str], tips: List[List[str]]) \
+        -> biom.Table:
+    """Assemble a sparse presence/absence table from tips of all samples.
 
-        while parent_indent >= indent:
+    Taxa are integer-coded in order of their first appearance, so that
+    the table never has to be materialized as a dense frame. Samples
+    without any tips are not included in the table.
+
+    Args:
+        sample_ids (list): IDs of all the samples.
+        tips (list): Taxids of the tips found in every sample.
+
+    Returns:
+        biom.Table: Table of taxa (observations) present in the samples.
+    """
+    taxa, kept_samples, rows, cols = {}, [], [], []
+    for sample_id, sample_tips in zip(sample_ids, tips):
+        if not sample_tips:
+            continue
+        col = len(kept_samples)
+        kept_samples.append(sample_id)
+        rows.extend(taxa.setdefault(taxid, len(taxa)) for taxid in sample_tips)
+        cols.extend([col] * len(sample_tips))
+
+    data = coo_matrix(
+        (np.ones(len(rows)), (rows, cols)),
+        shape=(len(taxa), len(kept_samples))
+    ).tocsr()
+    # tips within a sample are unique but make sure not to count them twice
+    data.data[:] = 1
+    return biom.Table(
+        data, observation_ids=list(taxa), sample_ids=kept_samples
+    )
+
+
+def _kraken2_to_features(
+        reports: Kraken2ReportDirectoryFormat, coverage_threshold: float,
+        n_jobs: int = 1
+):
+    """Find taxa present in every sample and their taxonomy.
+
+    Returns:
+        (list, list, pd.DataFrame): Sample IDs, their tips and
+            the taxonomy of all the tips.
+    """
+    sample_ids, trees, tips = _parse_kraken2_reports(
+        reports, coverage_threshold, n_jobs=n_jobs
+    )
+    taxonomy = _to_taxonomy(_combine_ncbi_trees(trees))
+    return sample_ids, tips, taxonomy
+
+
+def kraken2_to_features(reports: Kraken2ReportDirectoryFormat,
+                        coverage_threshold: float = 0.1,
+                        n_jobs: int = 1) \
+        -> (biom.Table, pd.DataFrame):
+    sample_ids, tips, taxonomy = _kraken2_to_features(
+        reports, coverage_threshold, n_jobs=n_jobs
+    )
+    table = _tips_to_table(sample_ids, tips)
+    return table, taxonomy
+
+
+def _find_parents(indents: np.ndarray) -> np.ndarray:
+    """Find the parent of every entry of a Kraken 2 report.
+
+    The parent is the closest preceding entry with a lower indentation.
+
+    Args:
+        indents (np.ndarray): Indentation level of every report entry.
+
+    Returns:
+        np.ndarray: Index of the parent of every entry or -1 if the entry
+            has no parent in the report.
+    """
+    parents = np.full(len(indents), -1, dtype=np.int64)
+    stack = []
+    for i, indent in enumerate(indents.tolist()):
+        while stack and stack[-1][0] >= indent:
             stack.pop()
-            parent_indent, parent_node = stack[-1]
+        if stack:
+            parents[i] = stack[-1][1]
+        stack.append((indent, i))
+    return parents
+
 
-        parent_node.append(node)
-        stack.append((indent, node))
+def _report_entries(df, indent=2):
+    """Extract the properties of all the Kraken 2 report entries.
 
-    # last entry is always a tip
-    _, parent_node = stack[-1]
-    if parent_node.children:
-        parent_node.children[0].is_actual_tip = True
+    Unclassified and root entries are skipped.
 
-    return tree
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray, np.ndarray): Indentation
+            level, name (prefixed with the rank handle) and taxid of every
+            entry and whether the entry represents a taxon on its own
+            (internal non-strain infra-clades do not).
+    """
+    df = df[~df['rank'].isin(('U', 'R'))]  # unclassified or root
+    ranks, labels = df['rank'].astype(str), df['name'].astype(str)
+
+    indents = (
+        (labels.str.len() - labels.str.lstrip(' ').str.len()) // indent
+    ).to_numpy()
+    names = (ranks.str.lower() + '__' + labels.str.strip()).to_numpy()
+    taxids = df['ncbi_tax_id'].astype(str).to_numpy()
+
+    # Don't include internal non-strain infra-clades as tips
+    has_taxid = ((ranks.str.len() == 1) | ranks.str.startswith('S')).to_numpy()
+    return indents, names, taxids, has_taxid
+
+
+def _kraken_to_ncbi_tree(df, indent=2):
+    indents, names, taxids, has_taxid = _report_entries(df, indent)
+    # an entry is a tip if the next one is not nested under it; the last
+    # entry is always a tip
+    is_tip = has_taxid & (np.append(indents[1:], -1) <= indents)
+
+    # every entry becomes a node, directly followed by its taxid node (if
+    # any); node 0 is the root
+    entry_nodes = (
+        1 + np.arange(len(names)) + np.cumsum(has_taxid) - has_taxid
+    ).astype(np.int64)
+    taxid_nodes = entry_nodes[has_taxid] + 1
+    n_nodes = 1 + len(names) + int(has_taxid.sum())
+
+    entry_parents = _find_parents(indents)
+    parents = np.full(n_nodes, -1, dtype=np.int64)
+    parents[entry_nodes] = np.where(
+        entry_parents >= 0, entry_nodes[entry_parents], 0
+    )
+    parents[taxid_nodes] = entry_nodes[has_taxid]
+
+    node_names = np.full(n_nodes, None, dtype=object)
+    node_names[entry_nodes] = names
+    node_names[taxid_nodes] = taxids[has_taxid]
+
+    # not infra-clade, so give it a length
+    lengths = np.zeros(n_nodes)
+    lengths[0] = np.nan
+    lengths[entry_nodes] = has_taxid.astype(float)
+
+    actual_tips = np.zeros(n_nodes, dtype=bool)
+    actual_tips[taxid_nodes] = is_tip[has_taxid]
+
+    return NCBITree.from_arrays(
+        parents, node_names.tolist(), lengths, actual_tips
+    )
 
 
 def _combine_ncbi_trees(trees):
     full_tree = trees[0]
     for tree in trees[1:]:
-        for tip in list(tree.tips()):
-            try:
-                # check if taxid is already in this tree
-                full_tree.find(tip.name)
-                continue  # for clarity
-            except skbio.tree.MissingNodeError:
-                parents = list(tip.ancestors())[:-1]  # ignore unnamed root
-                matching = full_tree
-                while parents:
-                    node = parents.pop()
-                    try:
-                        matching = matching.find(node.name)
-                    except skbio.tree.MissingNodeError:
-                        matching.append(node)
-                        break
+        full_tree.merge(tree)
     return full_tree
 
 
 def _ncbi_tree_to_tips(tree):
-    return [n.name for n in tree.tips() if hasattr(n, 'is_actual_tip')]
+    return tree.actual_tip_names()
 
 
 def _pad_ranks(ranks):
@@ -222,8 +452,8 @@ def _pad_ranks(ranks):
 
 
 def _to_taxonomy(tree):
-    rows = [(node.name, _pad_ranks(ranks))
-            for node, ranks in tree.to_taxonomy()]
+    rows = [(name, _pad_ranks(ranks))
+            for name, ranks in tree.to_taxonomy()]
     taxonomy = pd.DataFrame(rows, columns=['Feature ID', 'Taxon'])
     taxonomy = taxonomy.set_index('Feature ID')
 
@@ -0,0 +1,237 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+from pandas._testing import assert_frame_equal
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_moshpit.kraken2.abundance import (
+    _read_kmer_distrib, _find_level_ancestors, _estimate_bracken_python,
+    _load_kmer_distrib
+)
+from q2_types_genomics.kraken2 import (
+    BrackenDBDirectoryFormat, Kraken2ReportDirectoryFormat
+)
+
+
+class TestAbundance(TestPluginBase):
+    package = "q2_moshpit.kraken2.tests"
+
+    def setUp(self):
+        super().setUp()
+        self.reports = Kraken2ReportDirectoryFormat(
+            self.get_data_path('bracken-python/reports'), 'r'
+        )
+        self.bracken_db = BrackenDBDirectoryFormat(
+            self.get_data_path('bracken-python/db'), 'r'
+        )
+        self.temp_dir = tempfile.mkdtemp()
+        # the cache of k-mer distribution indices is enabled for all tests
+        env = patch.dict(os.environ, {
+            'Q2_MOSHPIT_BRACKEN_CACHE_DIR': self.temp_dir
+        })
+        env.start()
+        self.addCleanup(env.stop)
+        os.environ.pop('Q2_MOSHPIT_BRACKEN_CACHE_GB', None)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _list_index_dirs(self):
+        return [
+            entry.path for entry in os.scandir(self.temp_dir)
+            if entry.is_dir() and not entry.name.startswith('.')
+        ]
+
+    def test_read_kmer_distrib(self):
+        obs = _read_kmer_distrib(self.get_data_path(
+            'bracken-python/db/database100mers.kmer_distrib'
+        ))
+
+        np.testing.assert_array_equal(obs.mapped_taxids, [1, 10, 11, 12, 121])
+        np.testing.assert_array_equal(obs.genome_taxids, [11, 12, 121])
+        np.testing.assert_array_almost_equal(
+            obs.fractions.toarray(),
+            [[0.1, 0.2, 0.1],
+             [0.3, 0.0, 0.5],
+             [0.6, 0.0, 0.0],
+             [0.0, 0.8, 0.2],
+             [0.0, 0.0, 0.3]]
+        )
+
+    def test_read_kmer_distrib_empty(self):
+        obs = _read_kmer_distrib(self.get_data_path(
+            'bracken-db/database100mers.kmer_distrib'
+        ))
+
+        self.assertTupleEqual(obs.fractions.shape, (0, 0))
+
+    def test_load_kmer_distrib_index(self):
+        fp = self.get_data_path(
+            'bracken-python/db/database100mers.kmer_distrib'
+        )
+        exp = _read_kmer_distrib(fp)
+
+        _load_kmer_distrib(fp)
+        # the index is used instead of parsing the file again
+        with patch('q2_moshpit.kraken2.abundance._read_kmer_distrib') as p:
+            obs = _load_kmer_distrib(fp)
+            p.assert_not_called()
+
+        self.assertEqual(len(self._list_index_dirs()), 1)
+        self.assertIsInstance(obs.mapped_taxids, np.memmap)
+        np.testing.assert_array_equal(obs.mapped_taxids, exp.mapped_taxids)
+        np.testing.assert_array_equal(obs.genome_taxids, exp.genome_taxids)
+        np.testing.assert_array_equal(
+            obs.fractions.toarray(), exp.fractions.toarray()
+        )
+
+    def test_load_kmer_distrib_index_corrupted(self):
+        fp = self.get_data_path(
+            'bracken-python/db/database100mers.kmer_distrib'
+        )
+
+        _load_kmer_distrib(fp)
+        index_fp = os.path.join(self._list_index_dirs()[0], 'indptr.npy')
+        os.remove(index_fp)
+
+        obs = _load_kmer_distrib(fp)
+
+        self.assertTupleEqual(obs.fractions.shape, (5, 3))
+        self.assertTrue(os.path.isfile(index_fp))
+
+    def test_load_kmer_distrib_index_eviction(self):
+        fps = [
+            self.get_data_path(
+                f'bracken-python/db/database{read_len}mers.kmer_distrib'
+            ) for read_len in (100, 150)
+        ]
+
+        _load_kmer_distrib(fps[0])
+        # a single byte
+        with patch.dict(
+                os.environ, {'Q2_MOSHPIT_BRACKEN_CACHE_GB': str(2**-30)}
+        ):
+            _load_kmer_distrib(fps[1])
+            index_dirs = self._list_index_dirs()
+            # the index in use is never evicted
+            obs = _load_kmer_distrib(fps[1])
+
+        self.assertEqual(len(index_dirs), 1)
+        self.assertIsInstance(obs.mapped_taxids, np.memmap)
+
+    def test_load_kmer_distrib_index_changed_file(self):
+        fp = os.path.join(self.temp_dir, 'database100mers.kmer_distrib')
+        shutil.copyfile(self.get_data_path(
+            'bracken-python/db/database100mers.kmer_distrib'
+        ), fp)
+        _load_kmer_distrib(fp)
+
+        # same size, different fractions
+        with open(fp) as fh:
+            contents = fh.read()
+        with open(fp, 'w') as fh:
+            fh.write(contents.replace('11:60:100', '11:70:100'))
+        obs = _load_kmer_distrib(fp)
+
+        self.assertEqual(len(self._list_index_dirs()), 2)
+        self.assertAlmostEqual(obs.fractions[2, 0], 0.7)
+
+    def test_load_kmer_distrib_cache_disabled(self):
+        fp = self.get_data_path(
+            'bracken-python/db/database100mers.kmer_distrib'
+        )
+        os.environ.pop('Q2_MOSHPIT_BRACKEN_CACHE_DIR')
+
+        obs = _load_kmer_distrib(fp)
+
+        self.assertListEqual(os.listdir(self.temp_dir), [])
+        self.assertNotIsInstance(obs.mapped_taxids, np.memmap)
+        self.assertTupleEqual(obs.fractions.shape, (5, 3))
+
+    def test_find_level_ancestors(self):
+        #   0 (R) -> 1 (G) -> 2 (S) -> 3 (S1)
+        #                  -> 4 (G1) -> 5 (S)
+        parents = np.array([-1, 0, 1, 2, 1, 4])
+        is_level = np.array([False, False, True, False, False, True])
+
+        obs = _find_level_ancestors(parents, is_level)
+
+        np.testing.assert_array_equal(obs, [-1, -1, 2, 2, -1, 5])
+
+    def test_estimate_bracken_python(self):
+        obs_table, obs_reports = _estimate_bracken_python(
+            kraken_reports=self.reports, bracken_db=self.bracken_db,
+            threshold=5, read_len=100, level='S'
+        )
+
+        # s1: 10 reads of the root are split 3:4:1 between genomes 11, 12
+        # and 121 while 20 reads of the genus are split 9:5 between
+        # genomes 11 and 121; s2: species 12 does not pass the threshold
+        # so all the reads end up in species 11
+        exp_table = pd.DataFrame(
+            {'11': [46.0, 47.0], '12': [43.0, 0.0]}, index=['s1', 's2']
+        )
+        assert_frame_equal(obs_table.to_dataframe(dense=True).T, exp_table)
+
+        with open(os.path.join(str(obs_reports), 's1.report.txt')) as fh:
+            obs_report = fh.read()
+        self.assertEqual(
+            obs_report,
+            '100.00\t89\t0\tR\t1\troot\n'
+            '100.00\t89\t0\tG\t10\t  Genus A\n'
+            '51.69\t46\t46\tS\t11\t    Genus A species 1\n'
+            '48.31\t43\t43\tS\t12\t    Genus A species 2\n'
+        )
+        with open(os.path.join(str(obs_reports), 's2.report.txt')) as fh:
+            obs_report = fh.read()
+        self.assertEqual(
+            obs_report,
+            '100.00\t47\t0\tR\t1\troot\n'
+            '100.00\t47\t0\tG\t10\t  Genus A\n'
+            '100.00\t47\t47\tS\t11\t    Genus A species 1\n'
+        )
+
+    def test_estimate_bracken_python_genus(self):
+        obs_table, _ = _estimate_bracken_python(
+            kraken_reports=self.reports, bracken_db=self.bracken_db,
+            threshold=0, read_len=100, level='G'
+        )
+
+        exp_table = pd.DataFrame({'10': [90.0, 50.0]}, index=['s1', 's2'])
+        assert_frame_equal(obs_table.to_dataframe(dense=True).T, exp_table)
+
+    def test_estimate_bracken_python_sample_read_lens(self):
+        with patch(
+            'q2_moshpit.kraken2.abundance._load_kmer_distrib',
+            wraps=_load_kmer_distrib
+        ) as p:
+            obs_table, _ = _estimate_bracken_python(
+                kraken_reports=self.reports, bracken_db=self.bracken_db,
+                threshold=5, read_len=100, level='S',
+                sample_read_lens={'s1': 150}
+            )
+        # every distribution is only loaded once
+        self.assertEqual(p.call_count, 2)
+
+        # s1: 10 reads of the root are split 3:2 between genomes 11 and 12
+        # while all 20 reads of the genus go to genome 11
+        exp_table = pd.DataFrame(
+            {'11': [56.0, 47.0], '12': [34.0, 0.0]}, index=['s1', 's2']
+        )
+        assert_frame_equal(obs_table.to_dataframe(dense=True).T, exp_table)
+
+
+if __name__ == "__main__":
+    unittest.main()
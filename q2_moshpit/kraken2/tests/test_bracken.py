@@ -14,10 +14,13 @@ from unittest.mock import patch
 
 import pandas as pd
 from pandas._testing import assert_frame_equal
+from qiime2 import NumericMetadataColumn
 from qiime2.plugin.testing import TestPluginBase
 
 from q2_moshpit.kraken2.bracken import (
-    _assert_read_lens_available, _run_bracken_one_sample, _estimate_bracken)
+    _assert_read_lens_available, _run_bracken_one_sample, _estimate_bracken,
+    _get_sample_read_lens, estimate_bracken
+)
 from q2_types_genomics.kraken2 import (BrackenDBDirectoryFormat,
                                        Kraken2ReportDirectoryFormat)
 
@@ -156,13 +159,152 @@ class TestBracken(TestPluginBase):
             self.get_data_path('bracken-report/samples-merged.csv'),
             index_col=0
         )
-        exp_table.columns = [int(x) for x in exp_table.columns]
-        exp_table.columns.name = "taxonomy_id"
-        exp_table.index = pd.Index(exp_table.index, name='sample_id')
+        exp_table.index.name = None
 
-        assert_frame_equal(obs_table, exp_table)
+        assert_frame_equal(
+            obs_table.to_dataframe(dense=True).T, exp_table
+        )
         self.assertIsInstance(obs_reports, Kraken2ReportDirectoryFormat)
 
+    @patch('q2_moshpit.kraken2.bracken._run_bracken_one_sample')
+    def test_estimate_bracken_concurrent(self, p1):
+        kraken_reports = Kraken2ReportDirectoryFormat(
+            self.get_data_path('reports-mags'), 'r'
+        )
+        tables = {
+            fp.name: pd.read_csv(
+                self.get_data_path(f'bracken-report/sample{i}.table.csv'),
+                index_col=0
+            ) for i, fp in enumerate(
+                sorted(kraken_reports.path.iterdir()), start=1
+            )
+        }
+        p1.side_effect = lambda **kwargs: \
+            tables[kwargs['kraken2_report_fp'].name]
+
+        obs_table, _ = _estimate_bracken(
+            kraken_reports=kraken_reports,
+            bracken_db=BrackenDBDirectoryFormat(),
+            n_jobs=2, **self.kwargs
+        )
+        exp_table = pd.read_csv(
+            self.get_data_path('bracken-report/samples-merged.csv'),
+            index_col=0
+        )
+        exp_table.index.name = None
+
+        assert_frame_equal(
+            obs_table.to_dataframe(dense=True).T, exp_table
+        )
+        self.assertEqual(p1.call_count, 2)
+
+    @patch('q2_moshpit.kraken2.bracken._run_bracken_one_sample')
+    def test_estimate_bracken_failed_samples(self, p1):
+        kraken_reports = Kraken2ReportDirectoryFormat(
+            self.get_data_path('reports-mags'), 'r'
+        )
+
+        def run_bracken(**kwargs):
+            if kwargs['kraken2_report_fp'].name.startswith('3b72'):
+                raise Exception('return code 123')
+            return pd.DataFrame()
+
+        p1.side_effect = run_bracken
+
+        with self.assertRaisesRegex(
+            Exception,
+            r'Bracken failed for 1 out of 2 sample\(s\):\n'
+            r'3b72d1a7-ddb0-4dc7-ac36-080ceda04aaa: return code 123'
+        ):
+            _estimate_bracken(
+                kraken_reports=kraken_reports,
+                bracken_db=BrackenDBDirectoryFormat(),
+                n_jobs=2, **self.kwargs
+            )
+
+    @patch('q2_moshpit.kraken2.bracken._run_bracken_one_sample')
+    def test_estimate_bracken_sample_read_lens(self, p1):
+        kraken_reports = Kraken2ReportDirectoryFormat(
+            self.get_data_path('reports-mags'), 'r'
+        )
+        p1.return_value = pd.DataFrame(
+            columns=['sample_id', 'taxonomy_id', 'new_est_reads']
+        )
+
+        _estimate_bracken(
+            kraken_reports=kraken_reports,
+            bracken_db=BrackenDBDirectoryFormat(),
+            threshold=5, read_len=100, level='S',
+            sample_read_lens={'8894435a-c836-4c18-b475-8b38a9ab6c6b': 150}
+        )
+
+        obs = {
+            call.kwargs['kraken2_report_fp'].name: call.kwargs['read_len']
+            for call in p1.call_args_list
+        }
+        self.assertDictEqual(obs, {
+            '3b72d1a7-ddb0-4dc7-ac36-080ceda04aaa.report.txt': 100,
+            '8894435a-c836-4c18-b475-8b38a9ab6c6b.report.txt': 150
+        })
+
+    @unittest.skipUnless(
+        shutil.which('bracken'), 'Bracken is not installed.'
+    )
+    def test_estimate_bracken_backends_agree(self):
+        # Bracken itself is the reference for the python backend
+        kraken_reports = Kraken2ReportDirectoryFormat(
+            self.get_data_path('bracken-python/reports'), 'r'
+        )
+        bracken_db = BrackenDBDirectoryFormat(
+            self.get_data_path('bracken-python/db'), 'r'
+        )
+        tables = {}
+        for backend in ('bracken', 'python'):
+            _, _, table = estimate_bracken(
+                kraken_reports=kraken_reports, bracken_db=bracken_db,
+                threshold=5, read_len=100, level='S', backend=backend
+            )
+            tables[backend] = table.to_dataframe(dense=True).T
+
+        taxa = sorted(set(tables['bracken'].columns) |
+                      set(tables['python'].columns))
+        exp, obs = (
+            tables[backend].reindex(columns=taxa, fill_value=0.0)
+            .sort_index() for backend in ('bracken', 'python')
+        )
+        assert_frame_equal(obs, exp)
+
+    def test_get_sample_read_lens(self):
+        kraken_reports = Kraken2ReportDirectoryFormat(
+            self.get_data_path('reports-mags'), 'r'
+        )
+        read_lens = NumericMetadataColumn(pd.Series(
+            [150.0, 250.0], name='read_len',
+            index=pd.Index(
+                ['8894435a-c836-4c18-b475-8b38a9ab6c6b', 'other-sample'],
+                name='id'
+            )
+        ))
+
+        obs = _get_sample_read_lens(kraken_reports, 100, read_lens)
+
+        self.assertDictEqual(obs, {
+            '3b72d1a7-ddb0-4dc7-ac36-080ceda04aaa': 100,
+            '8894435a-c836-4c18-b475-8b38a9ab6c6b': 150
+        })
+
+    def test_get_sample_read_lens_not_whole_numbers(self):
+        kraken_reports = Kraken2ReportDirectoryFormat(
+            self.get_data_path('reports-mags'), 'r'
+        )
+        read_lens = NumericMetadataColumn(pd.Series(
+            [150.5], name='read_len',
+            index=pd.Index(['8894435a-c836-4c18-b475-8b38a9ab6c6b'], name='id')
+        ))
+
+        with self.assertRaisesRegex(ValueError, 'whole numbers.*read_len'):
+            _get_sample_read_lens(kraken_reports, 100, read_lens)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -5,7 +5,9 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import gzip
 import os
+import tempfile
 import unittest
 from subprocess import CalledProcessError
 
@@ -27,8 +29,12 @@ from unittest.mock import patch, ANY, call
 from qiime2.plugin.testing import TestPluginBase
 from qiime2.plugins import moshpit
 
+from q2_moshpit.kraken2._format import (
+    Kraken2CompressedOutputDirectoryFormat
+)
 from q2_moshpit.kraken2.classification import (
-    _get_seq_paths, _construct_output_paths, _classify_kraken2
+    _get_seq_paths, _construct_output_paths, _classify_kraken2,
+    _load_db_into_page_cache, _run_kraken2_compressed
 )
 
 
@@ -271,6 +277,85 @@ class TestKraken2Classification(TestPluginBase):
             ]
         )
 
+    @patch("q2_moshpit.kraken2.classification.run_command")
+    def test_classify_kraken_mags_concurrent(self, p1):
+        seqs = MAGSequencesDirFmt(self.get_data_path("mags-derep"), "r")
+        common_args = ["--db", "/some/where/db", "--quick"]
+
+        obs_reports, obs_outputs = _classify_kraken2(
+            seqs, common_args, n_jobs=2
+        )
+
+        exp_calls = []
+        for mag_id in (
+            "3b72d1a7-ddb0-4dc7-ac36-080ceda04aaa",
+            "8894435a-c836-4c18-b475-8b38a9ab6c6b"
+        ):
+            exp_calls.append(call(
+                cmd=[
+                    "kraken2", "--db", "/some/where/db", "--quick",
+                    "--report",
+                    os.path.join(obs_reports.path, f"{mag_id}.report.txt"),
+                    "--output",
+                    os.path.join(obs_outputs.path, f"{mag_id}.output.txt"),
+                    os.path.join(seqs.path, f"{mag_id}.fasta"),
+                ],
+                verbose=True,
+            ))
+        self.assertEqual(p1.call_count, 2)
+        p1.assert_has_calls(exp_calls, any_order=True)
+
+    @patch("q2_moshpit.kraken2.classification._run_kraken2_compressed")
+    def test_classify_kraken_mags_compressed(self, p1):
+        seqs = MAGSequencesDirFmt(self.get_data_path("mags-derep"), "r")
+        common_args = ["--db", "/some/where/db", "--quick"]
+
+        obs_reports, obs_outputs = _classify_kraken2(
+            seqs, common_args, compress_hits=True
+        )
+
+        self.assertIsInstance(
+            obs_outputs, Kraken2CompressedOutputDirectoryFormat
+        )
+        exp_calls = []
+        for mag_id in (
+            "3b72d1a7-ddb0-4dc7-ac36-080ceda04aaa",
+            "8894435a-c836-4c18-b475-8b38a9ab6c6b"
+        ):
+            exp_calls.append(call(
+                cmd=[
+                    "kraken2", "--db", "/some/where/db", "--quick",
+                    "--report",
+                    os.path.join(obs_reports.path, f"{mag_id}.report.txt"),
+                    "--output", "-",
+                    os.path.join(seqs.path, f"{mag_id}.fasta"),
+                ],
+                output_fp=os.path.join(
+                    obs_outputs.path, f"{mag_id}.output.txt.gz"
+                ),
+                verbose=True,
+            ))
+        self.assertEqual(p1.call_count, 2)
+        p1.assert_has_calls(exp_calls, any_order=True)
+
+    def test_run_kraken2_compressed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output_fp = os.path.join(tmp, "sample1.output.txt.gz")
+            _run_kraken2_compressed(
+                ["printf", "C\\tread1\\t2\\t150\\t2:116\\n"], output_fp,
+                verbose=False
+            )
+
+            with gzip.open(output_fp, "rt") as fh:
+                self.assertEqual(fh.read(), "C\tread1\t2\t150\t2:116\n")
+
+    def test_run_kraken2_compressed_error(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output_fp = os.path.join(tmp, "sample1.output.txt.gz")
+            with self.assertRaises(CalledProcessError) as cm:
+                _run_kraken2_compressed(["false"], output_fp, verbose=False)
+            self.assertEqual(cm.exception.cmd, ["false"])
+
     @patch("q2_moshpit.kraken2.classification.Kraken2OutputDirectoryFormat")
     @patch("q2_moshpit.kraken2.classification.Kraken2ReportDirectoryFormat")
     @patch(
@@ -318,7 +403,78 @@ class TestKraken2Classification(TestPluginBase):
             '--minimum-base-quality', '0', '--minimum-hit-groups', '2',
             '--quick', '--db', str(db.view(Kraken2DBDirectoryFormat).path)
         ]
-        p1.assert_called_with(ANY, exp_args)
+        p1.assert_called_with(ANY, exp_args, n_jobs=1)
+
+    @patch("q2_moshpit.kraken2.classification._classify_kraken2")
+    def test_classify_kraken_action_concurrent(self, p1):
+        seqs = Artifact.import_data(
+            'FeatureData[MAG]', self.get_data_path("mags-derep")
+        )
+        db = Artifact.import_data('Kraken2DB', self.get_data_path("db"))
+        p1.return_value = (
+            Kraken2ReportDirectoryFormat(
+                self.get_data_path("reports-mags"), "r"
+            ),
+            Kraken2OutputDirectoryFormat(
+                self.get_data_path("outputs-mags"), "r"
+            ),
+        )
+
+        moshpit.actions.classify_kraken2(
+            seqs=seqs, kraken2_db=db, threads=8, n_jobs=3
+        )
+
+        exp_args = [
+            '--threads', '2', '--minimum-base-quality', '0',
+            '--memory-mapping',
+            '--minimum-hit-groups', '2',
+            '--db', str(db.view(Kraken2DBDirectoryFormat).path)
+        ]
+        p1.assert_called_with(ANY, exp_args, n_jobs=3)
+
+    @patch("q2_moshpit.kraken2.classification._load_db_into_page_cache")
+    @patch("q2_moshpit.kraken2.classification._classify_kraken2")
+    def test_classify_kraken_action_preload_db(self, p1, p2):
+        seqs = Artifact.import_data(
+            'FeatureData[MAG]', self.get_data_path("mags-derep")
+        )
+        db = Artifact.import_data('Kraken2DB', self.get_data_path("db"))
+        p1.return_value = (
+            Kraken2ReportDirectoryFormat(
+                self.get_data_path("reports-mags"), "r"
+            ),
+            Kraken2OutputDirectoryFormat(
+                self.get_data_path("outputs-mags"), "r"
+            ),
+        )
+
+        moshpit.actions.classify_kraken2(
+            seqs=seqs, kraken2_db=db, preload_db=True
+        )
+
+        db_path = str(db.view(Kraken2DBDirectoryFormat).path)
+        exp_args = [
+            '--threads', '1', '--minimum-base-quality', '0',
+            '--memory-mapping', '--minimum-hit-groups', '2',
+            '--db', db_path
+        ]
+        p1.assert_called_with(ANY, exp_args, n_jobs=1)
+        p2.assert_called_once_with(db_path)
+
+    @patch("q2_moshpit.kraken2.classification.open", create=True)
+    def test_load_db_into_page_cache(self, p1):
+        db_dir = self.get_data_path("db")
+        p1.return_value.__enter__.return_value.readinto.side_effect = [
+            1, 0, 1, 0, 1, 0
+        ]
+
+        _load_db_into_page_cache(db_dir)
+
+        p1.assert_has_calls([
+            call(os.path.join(db_dir, fn), "rb")
+            for fn in ("hash.k2d", "opts.k2d", "taxo.k2d")
+        ], any_order=True)
+        self.assertEqual(p1.call_count, 3)
 
 
 if __name__ == "__main__":
@@ -5,13 +5,18 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import hashlib
 import io
+import json
 import os
+import re
 import shutil
 import tarfile
 import tempfile
+import threading
 import unittest
 from copy import deepcopy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from requests.exceptions import ConnectionError
 from subprocess import CalledProcessError
 from tempfile import TemporaryDirectory
@@ -26,8 +31,15 @@ from q2_moshpit.kraken2.database import (
     _fetch_taxonomy, _fetch_libraries, _add_seqs_to_library,
     _build_kraken2_database, _move_db_files, _build_bracken_database,
     _find_latest_db, _fetch_db_collection, S3_COLLECTIONS_URL,
-    _build_dbs_from_seqs, _fetch_prebuilt_dbs
+    _build_dbs_from_seqs, _fetch_prebuilt_dbs, _stream_file,
+    _get_part_size, _extract_db_files, _find_gzip_decompressor,
+    _ChunkStream, _mask_low_complexity, _split_into_batches,
+    _concatenate_fasta, _add_seq_batches_to_library,
+    _build_bracken_databases, _find_s3_object, _can_cache_collection,
+    _link_db_files, _build_dbs_from_library, _get_parts_ahead, _ETagDigest
 )
+from q2_moshpit.kraken2._format import Kraken2LibraryDirectoryFormat
+from q2_moshpit._utils import _hash_file
 from q2_types_genomics.kraken2 import (
     Kraken2DBDirectoryFormat, BrackenDBDirectoryFormat
 )
@@ -37,6 +49,76 @@ class MockTempDir(tempfile.TemporaryDirectory):
     pass
 
 
+class MockS3Handler(BaseHTTPRequestHandler):
+    """Serves files from memory and supports ranged requests, like S3."""
+    files = {}
+    etags = {}
+    # sizes of the parts multipart uploads were split into
+    part_sizes = {}
+    requested_ranges = []
+    interrupt_after = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send_object_headers(self, status, data, length):
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', self.etags.get(
+            self.path, f'"{hashlib.md5(data).hexdigest()}"'
+        ))
+
+    def do_HEAD(self):
+        path, _, query = self.path.partition('?')
+        data = self.files.get(path)
+        if data is None:
+            self.send_error(404)
+            return
+        part = re.fullmatch(r'partNumber=(\d+)', query)
+        if part is None:
+            self._send_object_headers(200, data, len(data))
+            self.end_headers()
+            return
+        if path not in self.part_sizes:
+            self.send_error(400)
+            return
+        part_size = self.part_sizes[path]
+        start = (int(part.group(1)) - 1) * part_size
+        self.path = path
+        self._send_object_headers(
+            206, data, len(data[start:start + part_size])
+        )
+        self.end_headers()
+
+    def do_GET(self):
+        data = self.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        if 'Range' not in self.headers:
+            self._send_object_headers(200, data, len(data))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        start, end = map(int, re.match(
+            r'bytes=(\d+)-(\d+)', self.headers['Range']
+        ).groups())
+        self.requested_ranges.append((start, end))
+        body = data[start:end + 1]
+        self._send_object_headers(206, data, len(body))
+        self.send_header(
+            'Content-Range', f'bytes {start}-{end}/{len(data)}'
+        )
+        self.end_headers()
+        if self.interrupt_after is not None:
+            # drop the connection in the middle of the transfer (once)
+            body = body[:self.interrupt_after]
+            MockS3Handler.interrupt_after = None
+            self.close_connection = True
+        self.wfile.write(body)
+
+
 class TestKraken2Database(TestPluginBase):
     package = "q2_moshpit.kraken2.tests"
 
@@ -57,23 +139,33 @@ class TestKraken2Database(TestPluginBase):
                 <Contents>
                     <Key>kraken/k2_viral_20230314.tar.gz</Key>
                     <LastModified>2023-03-22T01:29:11.000Z</LastModified>
+                    <ETag>"7a3c4f6c0e1b8f1d2e7c9a5b3d6e8f01-12"</ETag>
+                    <Size>1000</Size>
                 </Contents>
             </ListBucketResult>
         '''
 
         self.temp_dir = tempfile.mkdtemp()
+        # the database cache is disabled unless a test enables it
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        env = patch.dict(os.environ)
+        env.start()
+        self.addCleanup(env.stop)
+        os.environ.pop('Q2_MOSHPIT_KRAKEN2_CACHE_DIR', None)
+        os.environ.pop('Q2_MOSHPIT_KRAKEN2_CACHE_GB', None)
         self.temp_tar = os.path.join(self.temp_dir, 'temp.tar.gz')
 
         with tarfile.open(self.temp_tar, "w:gz") as tar:
-            data = io.BytesIO(b"sample data")
-            tarinfo = tarfile.TarInfo(name="sample.txt")
-            tarinfo.size = len(data.getbuffer())
-            tar.addfile(tarinfo, data)
-
-        with open(self.temp_tar, "rb") as f:
-            self.tar_chunks = [
-                chunk for chunk in iter(lambda: f.read(8192), b"")
-            ]
+            for name, content in (
+                ("k2_viral/hash.k2d", b"hash"),
+                ("k2_viral/database100mers.kmer_distrib", b"distrib"),
+                ("k2_viral/inspect.txt", b"inspect")
+            ):
+                data = io.BytesIO(content)
+                tarinfo = tarfile.TarInfo(name=name)
+                tarinfo.size = len(data.getbuffer())
+                tar.addfile(tarinfo, data)
 
     def tearDown(self):
         shutil.rmtree(self.temp_dir)
@@ -100,11 +192,21 @@ class TestKraken2Database(TestPluginBase):
         ):
             _fetch_taxonomy(self.kraken2_db_dir, threads=3, use_ftp=True)
 
+    @staticmethod
+    def _download_library(cmd, verbose):
+        # mimic kraken2-build --download-library
+        library, db_dir = cmd[2], cmd[-1]
+        os.makedirs(os.path.join(db_dir, 'library', library))
+        open(os.path.join(
+            db_dir, 'library', library, 'library.fna'), 'w'
+        ).close()
+
     @patch('q2_moshpit.kraken2.database.run_command')
     def test_fetch_libraries_skip(self, p1):
         all_kwargs = deepcopy(self.kwargs)
         all_kwargs['library_exists'] = 'skip'
         libraries = ['plasmid', 'human']
+        p1.side_effect = self._download_library
 
         with TemporaryDirectory() as tmp_dir:
             for lib in libraries:
@@ -117,9 +219,15 @@ class TestKraken2Database(TestPluginBase):
                 tmp_dir, libraries=libraries, all_kwargs=all_kwargs
             )
 
+            self.assertListEqual(
+                os.listdir(os.path.join(tmp_dir, 'library', 'human')),
+                ['library.fna']
+            )
+
         exp_cmd = [
             "kraken2-build", "--download-library", libraries[1],
-            "--threads", "2", "--db", tmp_dir
+            "--threads", "2", "--db",
+            os.path.join(tmp_dir, "staging", libraries[1])
         ]
         p1.assert_called_once_with(
             cmd=exp_cmd, verbose=True
@@ -129,22 +237,38 @@ class TestKraken2Database(TestPluginBase):
     def test_fetch_libraries_refetch(self, p1):
         all_kwargs = deepcopy(self.kwargs)
         all_kwargs['library_exists'] = 'refetch'
+        all_kwargs['n_jobs'] = 2
         libraries = ['plasmid', 'human']
+        p1.side_effect = self._download_library
 
-        _fetch_libraries(
-            self.kraken2_db_dir, libraries=libraries, all_kwargs=all_kwargs
-        )
+        with TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, 'library', 'plasmid'))
+            open(os.path.join(
+                tmp_dir, 'library', 'plasmid', 'old.fna'), 'w'
+            ).close()
+
+            _fetch_libraries(
+                tmp_dir, libraries=libraries, all_kwargs=all_kwargs
+            )
+
+            for lib in libraries:
+                self.assertListEqual(
+                    os.listdir(os.path.join(tmp_dir, 'library', lib)),
+                    ['library.fna']
+                )
+            # staging directories are removed once merged
+            self.assertListEqual(os.listdir(tmp_dir), ['library'])
 
         base_cmd = ["kraken2-build", "--download-library"]
-        exp_common_args = ["--threads", "2", "--db", self.kraken2_db_dir]
         exp_cmds = [
-            [*base_cmd, libraries[0], *exp_common_args],
-            [*base_cmd, libraries[1], *exp_common_args]
+            [*base_cmd, lib, "--threads", "2", "--db",
+             os.path.join(tmp_dir, "staging", lib)]
+            for lib in libraries
         ]
         p1.assert_has_calls([
             call(cmd=exp_cmds[0], verbose=True),
             call(cmd=exp_cmds[1], verbose=True)
-        ])
+        ], any_order=True)
 
     @patch(
         'q2_moshpit.kraken2.database.run_command',
@@ -156,11 +280,13 @@ class TestKraken2Database(TestPluginBase):
                 "An error was encountered .* downloading the 'human' "
                 r"library, \(return code 123\), please inspect .*"
         ):
-
             _fetch_libraries(
-                self.kraken2_db_dir, libraries=['human'],
+                self.temp_dir, libraries=['human'],
                 all_kwargs=self.kwargs
             )
+        self.assertFalse(
+            os.path.exists(os.path.join(self.temp_dir, 'staging'))
+        )
 
     @patch('q2_moshpit.kraken2.database.run_command')
     def test_add_seqs_to_library(self, p1):
@@ -190,6 +316,120 @@ class TestKraken2Database(TestPluginBase):
                 self.kraken2_db_dir, seqs=seqs, no_masking=True
             )
 
+    def _write_fasta(self, name, content):
+        fp = os.path.join(self.temp_dir, name)
+        with open(fp, 'w') as fh:
+            fh.write(content)
+        return fp
+
+    @patch('q2_moshpit.kraken2.database.run_command')
+    def test_mask_low_complexity(self, p1):
+        def _dustmasker(cmd, verbose):
+            with open(cmd[cmd.index('-out') + 1], 'w') as fh:
+                fh.write('>seq1 kraken:taxid|123\nACGTacgtnACGT\n>seq2\nAC\n')
+        p1.side_effect = _dustmasker
+        fasta_fp = self._write_fasta('seqs.fna', '')
+        masked_fp = os.path.join(self.temp_dir, 'masked.fna')
+
+        _mask_low_complexity(fasta_fp, masked_fp)
+
+        p1.assert_called_once_with(cmd=[
+            'dustmasker', '-in', fasta_fp, '-outfmt', 'fasta',
+            '-out', f'{masked_fp}.dust'
+        ], verbose=True)
+        with open(masked_fp) as fh:
+            self.assertEqual(
+                fh.read(), '>seq1 kraken:taxid|123\nACGTxxxxxACGT\n>seq2\nAC\n'
+            )
+        self.assertFalse(os.path.exists(f'{masked_fp}.dust'))
+
+    @patch(
+        'q2_moshpit.kraken2.database.run_command',
+        side_effect=CalledProcessError(123, 'cmd')
+    )
+    def test_mask_low_complexity_exception(self, p1):
+        with self.assertRaisesRegex(
+                Exception,
+                "An error was encountered while masking low-complexity "
+                r"sequences, \(return code 123\), please inspect .*"
+        ):
+            _mask_low_complexity('seqs.fna', 'masked.fna')
+
+    def test_split_into_batches(self):
+        fps = [
+            self._write_fasta(f's{i}.fna', 'A' * size)
+            for i, size in enumerate([10, 60, 30, 20, 50])
+        ]
+
+        obs = _split_into_batches(fps, 2)
+
+        self.assertListEqual(
+            obs, [[fps[1], fps[3], fps[0]], [fps[4], fps[2]]]
+        )
+        self.assertListEqual(_split_into_batches(fps[:1], 2), [fps[:1]])
+
+    def test_concatenate_fasta(self):
+        fps = [
+            self._write_fasta('s1.fna', '>s1\nACGT'),
+            self._write_fasta('s2.fna', ''),
+            self._write_fasta('s3.fna', '>s3\nTTTT\n')
+        ]
+        out_fp = os.path.join(self.temp_dir, 'out.fna')
+
+        _concatenate_fasta(fps, out_fp)
+
+        with open(out_fp) as fh:
+            self.assertEqual(fh.read(), '>s1\nACGT\n>s3\nTTTT\n')
+
+    @patch('q2_moshpit.kraken2.database._add_seqs_to_library')
+    @patch('q2_moshpit.kraken2.database._mask_low_complexity')
+    def test_add_seq_batches_to_library(self, mock_mask, mock_add):
+        seqs = [
+            DNAFASTAFormat(
+                self._write_fasta(f's{i}.fna', f'>s{i}\n' + 'A' * size), 'r'
+            ) for i, size in enumerate([10, 60, 30])
+        ]
+        mock_mask.side_effect = lambda src, dst: shutil.copy(src, dst)
+        added = []
+        mock_add.side_effect = lambda db_dir, seqs, no_masking: \
+            added.append(open(str(seqs.path)).read())
+
+        _add_seq_batches_to_library(
+            self.temp_dir, seqs, no_masking=False, threads=2
+        )
+
+        self.assertEqual(mock_mask.call_count, 2)
+        self.assertEqual(mock_add.call_count, 2)
+        for _call in mock_add.call_args_list:
+            self.assertEqual(_call.kwargs['db_dir'], self.temp_dir)
+            self.assertTrue(_call.kwargs['no_masking'])
+        self.assertListEqual(added, [
+            '>s1\n' + 'A' * 60 + '\n',
+            '>s2\n' + 'A' * 30 + '\n>s0\n' + 'A' * 10 + '\n'
+        ])
+        # the batches are removed once added
+        self.assertFalse(
+            os.path.exists(os.path.join(self.temp_dir, 'batches'))
+        )
+
+    @patch('q2_moshpit.kraken2.database._add_seqs_to_library')
+    @patch('q2_moshpit.kraken2.database._mask_low_complexity')
+    def test_add_seq_batches_to_library_no_masking(
+            self, mock_mask, mock_add
+    ):
+        seqs = [
+            DNAFASTAFormat(self._write_fasta('s0.fna', '>s0\nACGT\n'), 'r')
+        ]
+
+        _add_seq_batches_to_library(
+            self.temp_dir, seqs, no_masking=True, threads=4
+        )
+
+        mock_mask.assert_not_called()
+        mock_add.assert_called_once_with(
+            db_dir=self.temp_dir, seqs=ANY, no_masking=True
+        )
+
     @patch('q2_moshpit.kraken2.database.run_command')
     def test_build_kraken2_database(self, p1):
         _build_kraken2_database(self.kraken2_db_dir, all_kwargs=self.kwargs)
@@ -257,6 +497,40 @@ class TestKraken2Database(TestPluginBase):
                 kmer_len=31, read_len=150
             )
 
+    @patch('q2_moshpit.kraken2.database._build_bracken_database')
+    def test_build_bracken_databases(self, p1):
+        _build_bracken_databases(
+            kraken2_db_dir=self.kraken2_db_dir, threads=5,
+            kmer_len=31, read_lens=[100, 150, 200]
+        )
+
+        self.assertEqual(p1.call_count, 3)
+        # the library is classified by the first build only
+        self.assertEqual(p1.call_args_list[0], call(
+            kraken2_db_dir=self.kraken2_db_dir, threads=5,
+            kmer_len=31, read_len=100
+        ))
+        p1.assert_has_calls([
+            call(kraken2_db_dir=self.kraken2_db_dir, threads=2,
+                 kmer_len=31, read_len=150),
+            call(kraken2_db_dir=self.kraken2_db_dir, threads=2,
+                 kmer_len=31, read_len=200)
+        ], any_order=True)
+
+    @patch('q2_moshpit.kraken2.database._build_bracken_database')
+    def test_build_bracken_databases_single_thread(self, p1):
+        _build_bracken_databases(
+            kraken2_db_dir=self.kraken2_db_dir, threads=1,
+            kmer_len=31, read_lens=[100, 150]
+        )
+
+        p1.assert_has_calls([
+            call(kraken2_db_dir=self.kraken2_db_dir, threads=1,
+                 kmer_len=31, read_len=100),
+            call(kraken2_db_dir=self.kraken2_db_dir, threads=1,
+                 kmer_len=31, read_len=150)
+        ])
+
     def test_find_latest_db(self):
         response = Mock(content=self.s3_response)
 
@@ -272,72 +546,419 @@ class TestKraken2Database(TestPluginBase):
         ):
             _find_latest_db('viral', response)
 
-    @patch("requests.get")
-    @patch("tarfile.open")
+    def _start_s3_server(self, files, etags=None, part_sizes=None):
+        MockS3Handler.files = files
+        MockS3Handler.etags = etags or {}
+        MockS3Handler.part_sizes = part_sizes or {}
+        MockS3Handler.requested_ranges = []
+        MockS3Handler.interrupt_after = None
+        server = ThreadingHTTPServer(('127.0.0.1', 0), MockS3Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f'http://127.0.0.1:{server.server_address[1]}'
+
+    def test_get_part_size(self):
+        self.assertEqual(_get_part_size(1000, 4), 2**22)
+        self.assertEqual(_get_part_size(2**36, 4), 2**25)
+        self.assertEqual(_get_part_size(2**28, 4), 2**23)
+        # parts of all the connections need to fit into the buffer
+        self.assertEqual(_get_part_size(2**36, 16), 2**23)
+        self.assertEqual(_get_part_size(2**36, 128), 2**22)
+
+    def test_get_parts_ahead(self):
+        self.assertEqual(_get_parts_ahead(2**23, 4), 8)
+        self.assertEqual(_get_parts_ahead(2**22, 128), 64)
+        self.assertEqual(_get_parts_ahead(2**30, 4), 1)
+
+    def test_etag_digest(self):
+        data = os.urandom(1050)
+        parts = [data[start:start + 100] for start in range(0, 1050, 100)]
+        exp = hashlib.md5(
+            b''.join(hashlib.md5(part).digest() for part in parts)
+        ).hexdigest() + '-11'
+
+        digest = _ETagDigest(100)
+        for start in range(0, 1050, 70):
+            digest.update(data[start:start + 70])
+
+        self.assertEqual(digest.hexdigest(), exp)
+
+    def test_etag_digest_single_part(self):
+        data = os.urandom(1050)
+
+        digest = _ETagDigest()
+        digest.update(data[:500])
+        digest.update(data[500:])
+
+        self.assertEqual(digest.hexdigest(), hashlib.md5(data).hexdigest())
+
+    @patch('q2_moshpit.kraken2.database.MIN_PART_SIZE', 100)
+    def test_stream_file(self):
+        data = os.urandom(1050)
+        url = self._start_s3_server({'/db.tar.gz': data})
+
+        obs = b''.join(_stream_file(f'{url}/db.tar.gz', n_connections=3))
+
+        self.assertEqual(obs, data)
+        self.assertListEqual(
+            sorted(MockS3Handler.requested_ranges),
+            [(start, min(start + 99, 1049)) for start in range(0, 1050, 100)]
+        )
+
+    @patch('time.sleep')
+    @patch('q2_moshpit.kraken2.database.MIN_PART_SIZE', 1000)
+    @patch('q2_moshpit.kraken2.database.CHUNK_SIZE', 100)
+    def test_stream_file_interrupted(self, mock_sleep):
+        data = os.urandom(1000)
+        url = self._start_s3_server({'/db.tar.gz': data})
+        MockS3Handler.interrupt_after = 300
+
+        obs = b''.join(_stream_file(f'{url}/db.tar.gz'))
+
+        self.assertEqual(obs, data)
+        # the transfer continues from the last received byte
+        self.assertListEqual(
+            MockS3Handler.requested_ranges, [(0, 999), (300, 999)]
+        )
+
+    def test_stream_file_checksum_mismatch(self):
+        url = self._start_s3_server(
+            {'/db.tar.gz': b'some data'},
+            etags={'/db.tar.gz': f'"{hashlib.md5(b"other").hexdigest()}"'}
+        )
+
+        with self.assertRaisesRegex(ValueError, 'Checksum .+ does not match'):
+            list(_stream_file(f'{url}/db.tar.gz'))
+
+    @patch('q2_moshpit.kraken2.database.MIN_PART_SIZE', 100)
+    def test_stream_file_multipart_etag(self):
+        data = os.urandom(1050)
+        parts = [data[start:start + 300] for start in range(0, 1050, 300)]
+        etag = hashlib.md5(
+            b''.join(hashlib.md5(part).digest() for part in parts)
+        ).hexdigest() + '-4'
+        url = self._start_s3_server(
+            {'/db.tar.gz': data}, etags={'/db.tar.gz': f'"{etag}"'},
+            part_sizes={'/db.tar.gz': 300}
+        )
+
+        obs = b''.join(_stream_file(f'{url}/db.tar.gz', n_connections=3))
+
+        self.assertEqual(obs, data)
+
+    def test_stream_file_multipart_etag_mismatch(self):
+        url = self._start_s3_server(
+            {'/db.tar.gz': b'some data'},
+            etags={'/db.tar.gz': f'"{hashlib.md5(b"other").hexdigest()}-1"'},
+            part_sizes={'/db.tar.gz': 9}
+        )
+
+        with self.assertRaisesRegex(ValueError, 'Checksum .+ does not match'):
+            list(_stream_file(f'{url}/db.tar.gz'))
+
+    def test_stream_file_multipart_etag_unknown_part_size(self):
+        url = self._start_s3_server(
+            {'/db.tar.gz': b'some data'},
+            etags={'/db.tar.gz': f'"{hashlib.md5(b"other").hexdigest()}-1"'}
+        )
+
+        obs = b''.join(_stream_file(f'{url}/db.tar.gz'))
+
+        # the file cannot be verified
+        self.assertEqual(obs, b'some data')
+
+    def test_stream_file_not_found(self):
+        url = self._start_s3_server({})
+
+        with self.assertRaisesRegex(ValueError, r'Status code was: 404'):
+            list(_stream_file(f'{url}/db.tar.gz'))
+
+    def test_extract_db_files(self):
+        kraken2_dir = os.path.join(self.temp_dir, 'kraken2')
+        bracken_dir = os.path.join(self.temp_dir, 'bracken')
+        os.makedirs(kraken2_dir)
+        os.makedirs(bracken_dir)
+
+        with open(self.temp_tar, 'rb') as fh:
+            _extract_db_files(
+                fh, {'k2d': kraken2_dir, 'kmer_distrib': bracken_dir}
+            )
+
+        self.assertListEqual(os.listdir(kraken2_dir), ['hash.k2d'])
+        self.assertListEqual(
+            os.listdir(bracken_dir), ['database100mers.kmer_distrib']
+        )
+        with open(os.path.join(kraken2_dir, 'hash.k2d'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'hash')
+
+    @patch('shutil.which', side_effect=lambda cmd: cmd == 'pigz')
+    def test_find_gzip_decompressor(self, mock_which):
+        self.assertListEqual(
+            _find_gzip_decompressor(threads=4),
+            ['pigz', '-d', '-c', '-p', '4']
+        )
+
+    @patch('shutil.which', return_value=None)
+    def test_find_gzip_decompressor_none(self, mock_which):
+        self.assertIsNone(_find_gzip_decompressor(threads=4))
+
+    def test_extract_db_files_external(self):
+        kraken2_dir = os.path.join(self.temp_dir, 'kraken2')
+        os.makedirs(kraken2_dir)
+
+        with open(self.temp_tar, 'rb') as fh:
+            _extract_db_files(
+                fh, {'k2d': kraken2_dir}, decompress_cmd=['gzip', '-dc']
+            )
+
+        with open(os.path.join(kraken2_dir, 'hash.k2d'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'hash')
+
+    def test_extract_db_files_external_error(self):
+        with open(self.temp_tar, 'rb') as fh:
+            data = bytearray(fh.read())
+        # corrupt the CRC32 of the archive
+        data[-8] ^= 0xff
+
+        with self.assertRaisesRegex(
+                Exception,
+                "An error was encountered while decompressing the "
+                r"database, \(return code 1\), please inspect .+"
+        ):
+            _extract_db_files(
+                io.BytesIO(data), {'k2d': self.temp_dir},
+                decompress_cmd=['gzip', '-dc']
+            )
+
+    def test_extract_db_files_external_interrupted(self):
+        with open(self.temp_tar, 'rb') as fh:
+            data = fh.read()
+
+        def _interrupted_stream():
+            yield data[:50]
+            raise ConnectionError("Some error.")
+
+        with self.assertRaisesRegex(ConnectionError, "Some error"):
+            _extract_db_files(
+                _ChunkStream(_interrupted_stream()), {'k2d': self.temp_dir},
+                decompress_cmd=['gzip', '-dc']
+            )
+
+    def _fetch_viral_collection(self, url, name):
+        kraken2_dir = os.path.join(self.temp_dir, name, 'kraken2')
+        bracken_dir = os.path.join(self.temp_dir, name, 'bracken')
+        os.makedirs(kraken2_dir)
+        os.makedirs(bracken_dir)
+
+        with patch('q2_moshpit.kraken2.database.S3_COLLECTIONS_URL', url):
+            _fetch_db_collection(
+                "viral", {'k2d': kraken2_dir, 'kmer_distrib': bracken_dir},
+                threads=2, n_connections=2
+            )
+
+        self.assertListEqual(os.listdir(kraken2_dir), ['hash.k2d'])
+        self.assertListEqual(
+            os.listdir(bracken_dir), ['database100mers.kmer_distrib']
+        )
+        with open(os.path.join(kraken2_dir, 'hash.k2d'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'hash')
+        return kraken2_dir, bracken_dir
+
+    def _start_collection_server(self):
+        with open(self.temp_tar, 'rb') as fh:
+            return self._start_s3_server({
+                '/': self.s3_response,
+                '/kraken/k2_viral_20230314.tar.gz': fh.read()
+            })
+
+    def test_fetch_db_collection_success(self):
+        url = self._start_collection_server()
+
+        self._fetch_viral_collection(url, 'out')
+
+        # the archive itself is never saved
+        self.assertListEqual(
+            sorted(os.listdir(self.temp_dir)), ['out', 'temp.tar.gz']
+        )
+
+    def test_fetch_db_collection_cached(self):
+        url = self._start_collection_server()
+        os.environ['Q2_MOSHPIT_KRAKEN2_CACHE_DIR'] = self.cache_dir
+        kraken2_dir, _ = self._fetch_viral_collection(url, 'out1')
+        MockS3Handler.requested_ranges = []
+
+        obs_kraken2_dir, _ = self._fetch_viral_collection(url, 'out2')
+
+        # nothing is downloaded again
+        self.assertListEqual(MockS3Handler.requested_ranges, [])
+        entries = os.listdir(self.cache_dir)
+        self.assertEqual(len(entries), 1)
+        self.assertTrue(os.path.samefile(
+            os.path.join(self.cache_dir, entries[0], 'hash.k2d'),
+            os.path.join(obs_kraken2_dir, 'hash.k2d')
+        ))
+
+    def test_fetch_db_collection_cache_disabled(self):
+        url = self._start_collection_server()
+
+        self._fetch_viral_collection(url, 'out1')
+        with patch.dict(os.environ, {
+            'Q2_MOSHPIT_KRAKEN2_CACHE_DIR': self.cache_dir,
+            'Q2_MOSHPIT_KRAKEN2_CACHE_GB': '0'
+        }):
+            self._fetch_viral_collection(url, 'out2')
+
+        self.assertEqual(len(MockS3Handler.requested_ranges), 2)
+        self.assertListEqual(os.listdir(self.cache_dir), [])
+
     @patch(
-        "q2_moshpit.kraken2.database._find_latest_db",
-        return_value="kraken/k2_viral.tar.gz"
+        'q2_moshpit.kraken2.database._download_cached_db_files',
+        side_effect=OSError(28, 'No space left on device')
     )
-    @patch("q2_moshpit.kraken2.database.tqdm")
-    def test_fetch_db_collection_success(
-            self, mock_tqdm, mock_find, mock_tarfile_open, mock_requests_get
-    ):
-        mock_requests_get.side_effect = [
-            MagicMock(status_code=200),
-            MagicMock(
-                status_code=200,
-                iter_content=lambda chunk_size: self.tar_chunks,
-                headers={}
-            )
-        ]
-        mock_tarfile_open.return_value.__enter__.return_value = MagicMock()
+    def test_fetch_db_collection_cache_error(self, mock_download):
+        url = self._start_collection_server()
+        os.environ['Q2_MOSHPIT_KRAKEN2_CACHE_DIR'] = self.cache_dir
+
+        # the database is downloaded directly instead
+        self._fetch_viral_collection(url, 'out')
+
+        mock_download.assert_called_once()
+        self.assertListEqual(os.listdir(self.cache_dir), [])
+
+    def test_fetch_db_collection_cache_invalid_size(self):
+        os.environ['Q2_MOSHPIT_KRAKEN2_CACHE_DIR'] = self.cache_dir
+        os.environ['Q2_MOSHPIT_KRAKEN2_CACHE_GB'] = '10GB'
+        with patch(
+                'requests.get',
+                return_value=Mock(status_code=200, content=self.s3_response)
+        ), self.assertRaisesRegex(
+                ValueError, r'Q2_MOSHPIT_KRAKEN2_CACHE_GB .+"10GB"'
+        ):
+            _fetch_db_collection('viral', {'k2d': self.temp_dir})
 
-        _fetch_db_collection("viral", "/tmp")
+    def test_find_s3_object(self):
+        response = Mock(content=self.s3_response)
 
-        mock_requests_get.has_calls([
-            call(S3_COLLECTIONS_URL),
-            call(f"{S3_COLLECTIONS_URL}/kraken/k2_viral.tar.gz", stream=True)
-        ])
-        mock_tarfile_open.assert_called_once_with(
-            "/tmp/k2_viral.tar.gz", "r:gz"
+        obs = _find_s3_object(response, 'kraken/k2_viral_20230314.tar.gz')
+
+        self.assertEqual(
+            obs['ETag'], '"7a3c4f6c0e1b8f1d2e7c9a5b3d6e8f01-12"'
+        )
+        self.assertEqual(obs['Size'], '1000')
+        self.assertIsNone(
+            _find_s3_object(response, 'kraken/k2_viral_20230315.tar.gz')
+        )
+
+    @patch('shutil.disk_usage', return_value=Mock(free=3000))
+    def test_can_cache_collection(self, mock_usage):
+        for i, name in enumerate(['old', 'new']):
+            os.makedirs(os.path.join(self.cache_dir, name))
+            with open(
+                    os.path.join(self.cache_dir, name, 'db.k2d'), 'wb'
+            ) as fh:
+                fh.write(bytes(200))
+            os.utime(os.path.join(self.cache_dir, name), (i, i))
+        destinations = {'k2d': self.temp_dir}
+
+        with patch.dict(os.environ, {'Q2_MOSHPIT_KRAKEN2_CACHE_GB': '1e-6'}):
+            # 2 x 350 B do not fit into the cache (~1 kB) without its
+            # least recently used entry
+            self.assertTrue(
+                _can_cache_collection(self.cache_dir, destinations, 350)
+            )
+            self.assertListEqual(os.listdir(self.cache_dir), ['new'])
+            # more than the size of the cache
+            self.assertFalse(
+                _can_cache_collection(self.cache_dir, destinations, 600)
+            )
+        # more than the free space
+        self.assertFalse(
+            _can_cache_collection(self.cache_dir, destinations, 2000)
         )
-        mock_find.assert_called_once_with("viral", ANY)
-        mock_tqdm.assert_not_called()
+
+    def test_can_cache_collection_other_file_system(self):
+        stat = os.stat
+
+        def _stat(path, *args, **kwargs):
+            result = stat(path, *args, **kwargs)
+            if path == self.cache_dir:
+                return Mock(st_dev=result.st_dev + 1)
+            return result
+
+        with patch('os.stat', side_effect=_stat):
+            self.assertFalse(_can_cache_collection(
+                self.cache_dir, {'k2d': self.temp_dir}, 0
+            ))
+
+    @patch('os.link', side_effect=OSError('Invalid cross-device link'))
+    def test_link_db_files_copy(self, mock_link):
+        src_dir = os.path.join(self.temp_dir, 'src')
+        dst_dir = os.path.join(self.temp_dir, 'dst')
+        os.makedirs(src_dir)
+        os.makedirs(dst_dir)
+        for name in ('hash.k2d', 'inspect.txt'):
+            with open(os.path.join(src_dir, name), 'w') as fh:
+                fh.write(name)
+
+        _link_db_files(src_dir, {'k2d': dst_dir})
+
+        self.assertListEqual(os.listdir(dst_dir), ['hash.k2d'])
+        self.assertFalse(os.path.samefile(
+            os.path.join(src_dir, 'hash.k2d'),
+            os.path.join(dst_dir, 'hash.k2d')
+        ))
+
+    def test_link_db_files_error(self):
+        src_dir = os.path.join(self.temp_dir, 'src')
+        dst_dir = os.path.join(self.temp_dir, 'dst')
+        os.makedirs(src_dir)
+        os.makedirs(dst_dir)
+        for name in ('hash.k2d', 'opts.k2d'):
+            with open(os.path.join(src_dir, name), 'w') as fh:
+                fh.write(name)
+
+        def _link_once(src, dst):
+            if os.listdir(dst_dir):
+                raise OSError('No space left on device')
+            shutil.copyfile(src, dst)
+
+        with patch(
+                'q2_moshpit.kraken2.database._link_or_copy',
+                side_effect=_link_once
+        ), self.assertRaisesRegex(OSError, 'No space'):
+            _link_db_files(src_dir, {'k2d': dst_dir})
+
+        # no incomplete database is left behind
+        self.assertListEqual(os.listdir(dst_dir), [])
 
     @patch("requests.get")
-    @patch("tarfile.open")
+    @patch("q2_moshpit.kraken2.database._stream_file")
     @patch(
         "q2_moshpit.kraken2.database._find_latest_db",
         return_value="kraken/k2_viral.tar.gz"
     )
-    @patch("q2_moshpit.kraken2.database.tqdm")
-    def test_fetch_db_collection_success_with_tqdm(
-            self, mock_tqdm, mock_find, mock_tarfile_open, mock_requests_get
+    def test_fetch_db_collection_download_error(
+            self, mock_find, mock_stream, mock_requests_get
     ):
-        mock_requests_get.side_effect = [
-            MagicMock(status_code=200),
-            MagicMock(
-                status_code=200,
-                iter_content=lambda chunk_size: self.tar_chunks,
-                headers={"content-length": '1000'}
-            )
-        ]
-        mock_tarfile_open.return_value.__enter__.return_value = MagicMock()
-
-        _fetch_db_collection("viral", "/tmp")
+        def _interrupted_stream(*args, **kwargs):
+            yield b"some data"
+            raise ConnectionError("Some error.")
 
-        mock_requests_get.has_calls([
-            call(S3_COLLECTIONS_URL),
-            call(f"{S3_COLLECTIONS_URL}/kraken/k2_viral.tar.gz", stream=True)
-        ])
-        mock_tarfile_open.assert_called_once_with(
-            "/tmp/k2_viral.tar.gz", "r:gz"
+        mock_requests_get.return_value = MagicMock(
+            status_code=200, content=self.s3_response
         )
-        mock_find.assert_called_once_with("viral", ANY)
-        mock_tqdm.assert_called_once_with(
-            desc='Downloading the "kraken/k2_viral.tar.gz" database',
-            total=1000, unit='B',
-            unit_scale=True, unit_divisor=1024,
+        mock_stream.side_effect = _interrupted_stream
+
+        with self.assertRaisesRegex(
+                ValueError, r".+The error was\: Some error\."
+        ):
+            _fetch_db_collection("viral", {'k2d': self.temp_dir})
+
+        mock_stream.assert_called_once_with(
+            f"{S3_COLLECTIONS_URL}/kraken/k2_viral.tar.gz", n_connections=1,
+            desc='Downloading the "kraken/k2_viral.tar.gz" database'
         )
 
     @patch('requests.get')
@@ -373,17 +994,24 @@ class TestKraken2Database(TestPluginBase):
             for f in fake_files[:2]:
                 self.assertTrue(os.path.exists(os.path.join(fake_dest, f)))
 
+    def _touch_db_files(self, db_dir, *fns):
+        for fn in fns:
+            os.makedirs(os.path.dirname(os.path.join(db_dir, fn)),
+                        exist_ok=True)
+            with open(os.path.join(db_dir, fn), 'w') as fh:
+                fh.write(fn)
+
     @patch("q2_moshpit.kraken2.database._fetch_taxonomy")
-    @patch("q2_moshpit.kraken2.database._add_seqs_to_library")
+    @patch("q2_moshpit.kraken2.database._add_seq_batches_to_library")
     @patch("q2_moshpit.kraken2.database._build_kraken2_database")
-    @patch("q2_moshpit.kraken2.database._build_bracken_database")
+    @patch("q2_moshpit.kraken2.database._build_bracken_databases")
     @patch("q2_moshpit.kraken2.database._move_db_files")
     def test_build_dbs_from_seqs(
             self, mock_move, mock_bracken, mock_kraken,
             mock_add_seqs, mock_fetch_tax
     ):
         bracken_db, kraken2_db = MagicMock(), MagicMock()
-        seqs, tmp_dir = ["seq1", "seq2"], "/tmp"
+        seqs, tmp_dir = ["seq1", "seq2"], self.temp_dir
         common_args = {
             "threads": 1, "use_ftp": False, "no_masking": False,
             "read_len": [100, 150], "kmer_len": 35
@@ -396,39 +1024,276 @@ class TestKraken2Database(TestPluginBase):
         mock_fetch_tax.assert_called_once_with(
             db_dir=tmp_dir, threads=1, use_ftp=False
         )
-        mock_add_seqs.assert_has_calls([
-            call(db_dir=tmp_dir, seqs="seq1", no_masking=False),
-            call(db_dir=tmp_dir, seqs="seq2", no_masking=False)
-        ])
+        mock_add_seqs.assert_called_once_with(
+            db_dir=tmp_dir, seqs=seqs, no_masking=False, threads=1
+        )
         mock_kraken.assert_called_once_with(
             db_dir=tmp_dir, all_kwargs=common_args
         )
-        mock_bracken.assert_has_calls([
-            call(kraken2_db_dir=tmp_dir, threads=1,
-                 kmer_len=35, read_len=100),
-            call(kraken2_db_dir=tmp_dir, threads=1,
-                 kmer_len=35, read_len=150)
-        ])
-        mock_move.has_calls([
+        mock_bracken.assert_called_once_with(
+            kraken2_db_dir=tmp_dir, threads=1,
+            kmer_len=35, read_lens=[100, 150]
+        )
+        mock_move.assert_has_calls([
             call(tmp_dir, str(kraken2_db.path), extension="k2d"),
             call(tmp_dir, str(bracken_db.path), extension="kmer_distrib")
         ])
 
-    @patch("q2_moshpit.kraken2.database._fetch_db_collection")
+    @patch("q2_moshpit.kraken2.database._fetch_taxonomy")
+    @patch("q2_moshpit.kraken2.database._fetch_libraries")
+    @patch("q2_moshpit.kraken2.database._add_seq_batches_to_library")
+    @patch("q2_moshpit.kraken2.database._build_kraken2_database")
+    @patch("q2_moshpit.kraken2.database._build_bracken_databases")
     @patch("q2_moshpit.kraken2.database._move_db_files")
-    def test_fetch_prebuilt_dbs(self, mock_move, mock_fetch):
+    def test_build_dbs_from_seqs_libraries_only(
+            self, mock_move, mock_bracken, mock_kraken,
+            mock_add_seqs, mock_fetch_libs, mock_fetch_tax
+    ):
+        bracken_db, kraken2_db = MagicMock(), MagicMock()
+        common_args = {
+            "threads": 1, "use_ftp": False, "no_masking": False,
+            "read_len": [100], "kmer_len": 35,
+            "libraries": ["viral", "plasmid"], "library_exists": "skip",
+            "n_jobs": 2
+        }
+
+        _build_dbs_from_seqs(
+            bracken_db, kraken2_db, None, self.temp_dir, common_args
+        )
+
+        mock_fetch_libs.assert_called_once_with(
+            db_dir=self.temp_dir, libraries=["viral", "plasmid"],
+            all_kwargs=common_args
+        )
+        mock_add_seqs.assert_not_called()
+        mock_kraken.assert_called_once_with(
+            db_dir=self.temp_dir, all_kwargs=common_args
+        )
+
+    @patch("tempfile.TemporaryDirectory", return_value=MockTempDir())
+    @patch("q2_moshpit.kraken2.database.Kraken2DBDirectoryFormat")
+    @patch("q2_moshpit.kraken2.database.BrackenDBDirectoryFormat")
+    @patch("q2_moshpit.kraken2.database._build_dbs_from_seqs")
+    def test_build_kraken_db_action_with_libraries(
+            self, mock_build, mock_bracken, mock_kraken, mock_tmp
+    ):
+        mock_kraken.return_value = Kraken2DBDirectoryFormat(
+            self.get_data_path('db'), 'r'
+        )
+        mock_bracken.return_value = BrackenDBDirectoryFormat(
+            self.get_data_path('bracken-db'), 'r'
+        )
+
+        moshpit.actions.build_kraken_db(
+            libraries=['viral', 'plasmid'], library_exists='refetch',
+            n_jobs=2
+        )
+
+        common_args = mock_build.call_args.args[4]
+        self.assertIsNone(mock_build.call_args.args[2])
+        self.assertListEqual(common_args['libraries'], ['viral', 'plasmid'])
+        self.assertEqual(common_args['library_exists'], 'refetch')
+        self.assertEqual(common_args['n_jobs'], 2)
+
+    def _mock_library_build(self, mock_fetch_tax, mock_add_seqs, mock_kraken):
+        mock_fetch_tax.side_effect = lambda db_dir, **_: \
+            self._touch_db_files(
+                db_dir, 'taxonomy/nodes.dmp', 'taxonomy/names.dmp'
+            )
+        mock_add_seqs.side_effect = lambda db_dir, seqs, **_: \
+            self._touch_db_files(db_dir, *[
+                f'library/added/{os.path.basename(str(seq.path))}'
+                for seq in seqs
+            ])
+        mock_kraken.side_effect = lambda db_dir, **_: \
+            self._touch_db_files(
+                db_dir, 'hash.k2d', 'taxonomy/prelim_map.txt'
+            )
+
+    def _list_files(self, path):
+        return sorted(
+            os.path.relpath(os.path.join(root, fn), path)
+            for root, _, fns in os.walk(path) for fn in fns
+        )
+
+    @patch("q2_moshpit.kraken2.database._fetch_taxonomy")
+    @patch("q2_moshpit.kraken2.database._add_seq_batches_to_library")
+    @patch("q2_moshpit.kraken2.database._build_kraken2_database")
+    @patch("q2_moshpit.kraken2.database._build_bracken_databases")
+    def test_build_dbs_from_library_new(
+            self, mock_bracken, mock_kraken, mock_add_seqs, mock_fetch_tax
+    ):
+        self._mock_library_build(mock_fetch_tax, mock_add_seqs, mock_kraken)
+        kraken2_db = Kraken2DBDirectoryFormat()
+        bracken_db = BrackenDBDirectoryFormat()
+        new_library = Kraken2LibraryDirectoryFormat()
+        tmp_dir = os.path.join(self.temp_dir, 'db')
+        seqs = [
+            DNAFASTAFormat(self._write_fasta('s1.fna', '>s1\nACGT\n'), 'r'),
+            DNAFASTAFormat(self._write_fasta('s2.fna', '>s2\nTTTT\n'), 'r')
+        ]
+        common_args = {
+            "threads": 1, "use_ftp": False, "no_masking": False,
+            "read_len": [100], "kmer_len": 35
+        }
+
+        _build_dbs_from_library(
+            bracken_db, kraken2_db, new_library, seqs, None, tmp_dir,
+            common_args
+        )
+
+        mock_fetch_tax.assert_called_once()
+        mock_add_seqs.assert_called_once_with(
+            db_dir=tmp_dir, seqs=seqs, no_masking=False, threads=1
+        )
+        self.assertListEqual(os.listdir(str(kraken2_db)), ['hash.k2d'])
+        # files created while building the database are not saved
+        self.assertListEqual(self._list_files(str(new_library)), [
+            'library/added/s1.fna', 'library/added/s2.fna', 'manifest.json',
+            'taxonomy/names.dmp', 'taxonomy/nodes.dmp'
+        ])
+        with open(os.path.join(str(new_library), 'manifest.json')) as fh:
+            self.assertDictEqual(json.load(fh), {
+                'seqs': [_hash_file(str(seq.path)) for seq in seqs],
+                'no_masking': False
+            })
+
+    @patch("q2_moshpit.kraken2.database._fetch_taxonomy")
+    @patch("q2_moshpit.kraken2.database._add_seq_batches_to_library")
+    @patch("q2_moshpit.kraken2.database._build_kraken2_database")
+    @patch("q2_moshpit.kraken2.database._build_bracken_databases")
+    def test_build_dbs_from_library_update(
+            self, mock_bracken, mock_kraken, mock_add_seqs, mock_fetch_tax
+    ):
+        self._mock_library_build(mock_fetch_tax, mock_add_seqs, mock_kraken)
+        s1 = DNAFASTAFormat(self._write_fasta('s1.fna', '>s1\nACGT\n'), 'r')
+        s2 = DNAFASTAFormat(self._write_fasta('s2.fna', '>s2\nTTTT\n'), 'r')
+        library_dir = os.path.join(self.temp_dir, 'library')
+        self._touch_db_files(
+            library_dir, 'library/added/s1.fna', 'taxonomy/nodes.dmp',
+            'taxonomy/names.dmp'
+        )
+        with open(os.path.join(library_dir, 'manifest.json'), 'w') as fh:
+            json.dump(
+                {'seqs': [_hash_file(str(s1.path))], 'no_masking': False}, fh
+            )
+        library = Kraken2LibraryDirectoryFormat(library_dir, 'r')
+        new_library = Kraken2LibraryDirectoryFormat()
+        tmp_dir = os.path.join(self.temp_dir, 'db')
+        common_args = {
+            "threads": 1, "use_ftp": False, "no_masking": False,
+            "read_len": [100], "kmer_len": 35
+        }
+
+        _build_dbs_from_library(
+            BrackenDBDirectoryFormat(), Kraken2DBDirectoryFormat(),
+            new_library, [s1, s2], library, tmp_dir, common_args
+        )
+
+        # only the new sequence is masked and added
+        mock_fetch_tax.assert_not_called()
+        mock_add_seqs.assert_called_once_with(
+            db_dir=tmp_dir, seqs=[s2], no_masking=False, threads=1
+        )
+        # but the whole library is indexed
+        mock_kraken.assert_called_once_with(
+            db_dir=tmp_dir, all_kwargs=common_args
+        )
+        mock_bracken.assert_called_once_with(
+            kraken2_db_dir=tmp_dir, threads=1, kmer_len=35, read_lens=[100]
+        )
+        self.assertListEqual(self._list_files(str(new_library)), [
+            'library/added/s1.fna', 'library/added/s2.fna', 'manifest.json',
+            'taxonomy/names.dmp', 'taxonomy/nodes.dmp'
+        ])
+        with open(os.path.join(str(new_library), 'manifest.json')) as fh:
+            self.assertListEqual(json.load(fh)['seqs'], [
+                _hash_file(str(s1.path)), _hash_file(str(s2.path))
+            ])
+        # the previous library is left untouched
+        self.assertListEqual(self._list_files(library_dir), [
+            'library/added/s1.fna', 'manifest.json',
+            'taxonomy/names.dmp', 'taxonomy/nodes.dmp'
+        ])
+
+    @patch("q2_moshpit.kraken2.database._fetch_taxonomy")
+    @patch("q2_moshpit.kraken2.database._add_seq_batches_to_library")
+    @patch("q2_moshpit.kraken2.database._build_kraken2_database")
+    @patch("q2_moshpit.kraken2.database._build_bracken_databases")
+    def test_build_dbs_from_library_no_new_seqs(
+            self, mock_bracken, mock_kraken, mock_add_seqs, mock_fetch_tax
+    ):
+        self._mock_library_build(mock_fetch_tax, mock_add_seqs, mock_kraken)
+        s1 = DNAFASTAFormat(self._write_fasta('s1.fna', '>s1\nACGT\n'), 'r')
+        library_dir = os.path.join(self.temp_dir, 'library')
+        self._touch_db_files(
+            library_dir, 'library/added/s1.fna', 'taxonomy/nodes.dmp',
+            'taxonomy/names.dmp'
+        )
+        manifest = {'seqs': [_hash_file(str(s1.path))], 'no_masking': False}
+        with open(os.path.join(library_dir, 'manifest.json'), 'w') as fh:
+            json.dump(manifest, fh)
+        new_library = Kraken2LibraryDirectoryFormat()
+        tmp_dir = os.path.join(self.temp_dir, 'db')
+        common_args = {
+            "threads": 1, "use_ftp": False, "no_masking": False,
+            "read_len": [100], "kmer_len": 35
+        }
+
+        _build_dbs_from_library(
+            BrackenDBDirectoryFormat(), Kraken2DBDirectoryFormat(),
+            new_library, [s1], Kraken2LibraryDirectoryFormat(library_dir, 'r'),
+            tmp_dir, common_args
+        )
+
+        # nothing gets fetched, masked or added to the library
+        mock_fetch_tax.assert_not_called()
+        mock_add_seqs.assert_not_called()
+        mock_kraken.assert_called_once_with(
+            db_dir=tmp_dir, all_kwargs=common_args
+        )
+        self.assertListEqual(self._list_files(str(new_library)), [
+            'library/added/s1.fna', 'manifest.json',
+            'taxonomy/names.dmp', 'taxonomy/nodes.dmp'
+        ])
+        with open(os.path.join(str(new_library), 'manifest.json')) as fh:
+            self.assertDictEqual(json.load(fh), manifest)
+
+    def test_build_dbs_from_library_masking_mismatch(self):
+        library_dir = os.path.join(self.temp_dir, 'library')
+        self._touch_db_files(
+            library_dir, 'library/added/s1.fna', 'taxonomy/nodes.dmp',
+            'taxonomy/names.dmp'
+        )
+        with open(os.path.join(library_dir, 'manifest.json'), 'w') as fh:
+            json.dump({'seqs': ['abc'], 'no_masking': True}, fh)
+        common_args = {
+            "threads": 1, "use_ftp": False, "no_masking": False,
+            "read_len": [100], "kmer_len": 35
+        }
+
+        with self.assertRaisesRegex(ValueError, 'no_masking.+True'):
+            _build_dbs_from_library(
+                MagicMock(), MagicMock(), MagicMock(), [],
+                Kraken2LibraryDirectoryFormat(library_dir, 'r'),
+                os.path.join(self.temp_dir, 'db'), common_args
+            )
+
+    @patch("q2_moshpit.kraken2.database._fetch_db_collection")
+    def test_fetch_prebuilt_dbs(self, mock_fetch):
         bracken_db = MagicMock(path="/path/to/bracken_db")
         kraken2_db = MagicMock(path="/path/to/kraken2_db")
 
-        _fetch_prebuilt_dbs(bracken_db, kraken2_db, "some_collection", "/tmp")
+        _fetch_prebuilt_dbs(bracken_db, kraken2_db, "some_collection")
 
         mock_fetch.assert_called_once_with(
-            collection="some_collection", tmp_dir="/tmp"
+            collection="some_collection",
+            destinations={
+                "k2d": "/path/to/kraken2_db",
+                "kmer_distrib": "/path/to/bracken_db"
+            },
+            threads=1, n_connections=1
         )
-        mock_move.assert_has_calls([
-            call("/tmp", str(kraken2_db.path), extension="k2d"),
-            call("/tmp", str(bracken_db.path), extension="kmer_distrib")
-        ])
 
     @patch("tempfile.TemporaryDirectory", return_value=MockTempDir())
     @patch("q2_moshpit.kraken2.database.Kraken2DBDirectoryFormat")
@@ -450,7 +1315,7 @@ class TestKraken2Database(TestPluginBase):
 
         mock_fetch.assert_called_once_with(
             fake_bracken_dir_fmt, fake_kraken_dir_fmt,
-            "viral", str(mock_tmp.return_value.name)
+            "viral", 1, 4
         )
 
     @patch("tempfile.TemporaryDirectory", return_value=MockTempDir())
@@ -481,6 +1346,7 @@ class TestKraken2Database(TestPluginBase):
             'minimizer_spaces': 7, 'no_masking': False, 'max_db_size': 0,
             'use_ftp': False, 'load_factor': 0.7, 'fast_build': True,
             'read_len': [50, 75, 100, 150, 200, 250, 300],
+            'libraries': None, 'library_exists': 'skip', 'n_jobs': 1,
             'kraken2_db': fake_kraken_dir_fmt,
             'bracken_db': fake_bracken_dir_fmt,
             'tmp': str(mock_tmp.return_value.name)
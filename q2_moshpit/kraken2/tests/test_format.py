@@ -0,0 +1,144 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from qiime2.plugin import ValidationError
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_moshpit.kraken2._format import (
+    Kraken2LibraryDirectoryFormat, Kraken2LibraryManifestFormat,
+    Kraken2LibrarySequencesFormat,
+    Kraken2CompressedOutputFormat, Kraken2CompressedOutputDirectoryFormat
+)
+
+
+class TestKraken2LibraryFormats(TestPluginBase):
+    package = "q2_moshpit.kraken2.tests"
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        for fp, content in (
+                ('taxonomy/nodes.dmp', '1\t|\t1\t|\tno rank\t|\n'),
+                ('taxonomy/names.dmp',
+                 '1\t|\troot\t|\t\t|\tscientific name\t|\n'),
+                ('taxonomy/nucl_gb.accession2taxid',
+                 'accession\taccession.version\ttaxid\tgi\n'),
+                ('library/added/abc.fna',
+                 '>kraken:taxid|1|s1\nACGTxxxxAC\nGT\n'),
+                ('library/added/prelim_map_abc.txt',
+                 'TAXID\tkraken:taxid|1|s1\t1\n')
+        ):
+            self._write_file(fp, content)
+        self._write_manifest({'seqs': ['abc'], 'no_masking': False})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_file(self, fp, content):
+        fp = os.path.join(self.temp_dir, fp)
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        with open(fp, 'w') as fh:
+            fh.write(content)
+
+    def _write_manifest(self, manifest):
+        with open(os.path.join(self.temp_dir, 'manifest.json'), 'w') as fh:
+            json.dump(manifest, fh)
+
+    def test_library_dir_format(self):
+        fmt = Kraken2LibraryDirectoryFormat(self.temp_dir, mode='r')
+        fmt.validate()
+
+    def test_library_dir_format_missing_taxonomy(self):
+        os.remove(os.path.join(self.temp_dir, 'taxonomy', 'names.dmp'))
+
+        fmt = Kraken2LibraryDirectoryFormat(self.temp_dir, mode='r')
+        with self.assertRaisesRegex(ValidationError, '"names.dmp" is missing'):
+            fmt.validate()
+
+    def test_library_dir_format_invalid_sequences(self):
+        self._write_file('library/added/abc.fna', 'ACGT\n>s1\nACGT\n')
+
+        fmt = Kraken2LibraryDirectoryFormat(self.temp_dir, mode='r')
+        with self.assertRaisesRegex(ValidationError, 'start with a FASTA'):
+            fmt.validate()
+
+    def test_library_sequences_format_invalid_line(self):
+        self._write_file('library/added/abc.fna', '>s1\nAC GT\n')
+
+        fmt = Kraken2LibrarySequencesFormat(
+            os.path.join(self.temp_dir, 'library/added/abc.fna'), mode='r'
+        )
+        with self.assertRaisesRegex(ValidationError, 'Line 2 is neither'):
+            fmt.validate()
+
+    def test_library_dir_format_invalid_taxonomy_dump(self):
+        self._write_file('taxonomy/names.dmp', '1,root,scientific name\n')
+
+        fmt = Kraken2LibraryDirectoryFormat(self.temp_dir, mode='r')
+        with self.assertRaisesRegex(ValidationError, 'NCBI taxonomy dump'):
+            fmt.validate()
+
+    def test_library_manifest_format_invalid(self):
+        self._write_manifest({'seqs': ['abc']})
+
+        fmt = Kraken2LibraryManifestFormat(
+            os.path.join(self.temp_dir, 'manifest.json'), mode='r'
+        )
+        with self.assertRaisesRegex(ValidationError, 'no_masking'):
+            fmt.validate()
+
+
+
+class TestKraken2CompressedOutputFormats(TestPluginBase):
+    package = "q2_moshpit.kraken2.tests"
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.fp = os.path.join(self.temp_dir, 'sample1.output.txt.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_hits(self, content):
+        with gzip.open(self.fp, 'wt') as fh:
+            fh.write(content)
+
+    def test_compressed_output_dir_format(self):
+        self._write_hits(
+            'C\tread1\t2\t150\t2:116\n'
+            'U\tread2\t0\t150\t0:116\n'
+        )
+
+        fmt = Kraken2CompressedOutputDirectoryFormat(self.temp_dir, mode='r')
+        fmt.validate()
+
+    def test_compressed_output_format_invalid_line(self):
+        self._write_hits('C\tread1\t2\n')
+
+        fmt = Kraken2CompressedOutputFormat(self.fp, mode='r')
+        with self.assertRaisesRegex(ValidationError, 'Line 1 is not'):
+            fmt.validate()
+
+    def test_compressed_output_format_not_gzip(self):
+        with open(self.fp, 'w') as fh:
+            fh.write('C\tread1\t2\t150\t2:116\n')
+
+        fmt = Kraken2CompressedOutputFormat(self.fp, mode='r')
+        with self.assertRaisesRegex(ValidationError, 'not a valid gzip'):
+            fmt.validate()
+
+
+if __name__ == '__main__':
+    unittest.main()
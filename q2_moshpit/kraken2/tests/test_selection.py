@@ -5,15 +5,26 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import gzip
+import os
 import shutil
 import tempfile
+from unittest.mock import patch
 
+import numpy as np
 import pandas as pd
 import pandas.testing
 from pandas._testing import assert_frame_equal
 import skbio
-from q2_moshpit.kraken2 import kraken2_to_features  # , kraken2_to_mag_features
-from q2_moshpit.kraken2.select import _kraken_to_ncbi_tree, _find_lcas
+from q2_moshpit.kraken2 import kraken2_to_features, kraken2_to_mag_features
+from q2_moshpit.kraken2._format import (
+    Kraken2CompressedOutputDirectoryFormat
+)
+from q2_moshpit.kraken2.tree import NCBITree
+from q2_moshpit.kraken2.select import (
+    _kraken_to_ncbi_tree, _find_lcas, _combine_ncbi_trees, _find_parents,
+    _tips_to_table, _kraken2_to_taxonomy
+)
 from qiime2.plugin.testing import TestPluginBase
 
 from q2_types_genomics.kraken2 import (
@@ -25,6 +36,20 @@ class MockTempDir(tempfile.TemporaryDirectory):
     pass
 
 
+def _tree_from_lineages(lineages):
+    tree = NCBITree()
+    for lineage in lineages:
+        parent = tree.ROOT
+        for name in lineage:
+            node = tree.find(name)
+            parent = tree.add_node(parent, name) if node is None else node
+    return tree
+
+
+def _table_to_frame(table):
+    return table.to_dataframe(dense=True).T.astype(bool)
+
+
 class TestKrakenSelect(TestPluginBase):
     package = "q2_moshpit.kraken2.tests"
 
@@ -87,7 +112,9 @@ class TestKrakenSelect(TestPluginBase):
         obs_table, obs_taxonomy = kraken2_to_features(
             reports, coverage_threshold=0.1)
 
-        assert_frame_equal(obs_table, self.kraken2_reads_table_filtered)
+        assert_frame_equal(
+            _table_to_frame(obs_table), self.kraken2_reads_table_filtered
+        )
         assert_frame_equal(obs_taxonomy, self.kraken_taxonomy_filtered)
 
     def test_kraken2_to_features_no_coverage_threshold(self):
@@ -96,9 +123,72 @@ class TestKrakenSelect(TestPluginBase):
         )
         obs_table, obs_taxonomy = kraken2_to_features(reports, 0.0)
 
-        assert_frame_equal(obs_table, self.kraken2_reads_table)
+        assert_frame_equal(
+            _table_to_frame(obs_table), self.kraken2_reads_table
+        )
         assert_frame_equal(obs_taxonomy, self.kraken_taxonomy)
 
+    def test_kraken2_to_features_parallel(self):
+        reports = Kraken2ReportDirectoryFormat(
+            self.get_data_path("kraken2-reports-select/samples"), "r"
+        )
+        obs_table, obs_taxonomy = kraken2_to_features(
+            reports, coverage_threshold=0.1, n_jobs=2)
+
+        assert_frame_equal(
+            _table_to_frame(obs_table), self.kraken2_reads_table_filtered
+        )
+        assert_frame_equal(obs_taxonomy, self.kraken_taxonomy_filtered)
+
+    def test_kraken2_to_taxonomy(self):
+        reports = Kraken2ReportDirectoryFormat(
+            self.get_data_path("kraken2-reports-select/samples"), "r"
+        )
+
+        for threshold, exp in ((0.0, self.kraken_taxonomy),
+                               (0.1, self.kraken_taxonomy_filtered)):
+            obs = _kraken2_to_taxonomy(reports, threshold, n_jobs=2)
+            # taxa are listed in order of their first appearance
+            assert_frame_equal(obs.sort_index(), exp.sort_index())
+
+    def test_kraken2_to_taxonomy_infra_clade_leaves(self):
+        reports = Kraken2ReportDirectoryFormat(
+            self.get_data_path("kraken2-reports-select/infra-leaves"), "r"
+        )
+        _, exp = kraken2_to_features(reports, 0.0)
+
+        obs = _kraken2_to_taxonomy(reports, 0.0)
+
+        assert_frame_equal(obs.sort_index(), exp.sort_index())
+        # the last entry of sample1 has no entries nested under it
+        self.assertEqual(
+            obs.loc['g1__Mycobacterium avium complex (MAC)', 'Taxon'],
+            'd__Bacteria;k__Bacteria;p__Actinomycetota;c__Actinomycetes;'
+            'o__Mycobacteriales;f__Mycobacteriaceae;g__Mycobacterium'
+        )
+        # only childless in sample2
+        self.assertNotIn(
+            'g1__Mycobacterium tuberculosis complex', obs.index
+        )
+
+    def test_tips_to_table(self):
+        obs = _tips_to_table(
+            ['s1', 's2', 's3'], [['1', '2'], [], ['3', '1']]
+        )
+
+        self.assertListEqual(list(obs.ids(axis='sample')), ['s1', 's3'])
+        self.assertListEqual(
+            list(obs.ids(axis='observation')), ['1', '2', '3']
+        )
+        np.testing.assert_array_equal(
+            obs.matrix_data.toarray(), [[1, 1], [1, 0], [0, 1]]
+        )
+
+    def test_tips_to_table_empty(self):
+        obs = _tips_to_table(['s1'], [[]])
+
+        self.assertTupleEqual(obs.shape, (0, 0))
+
     def test_kraken_to_ncbi_tree(self):
         reports = Kraken2ReportDirectoryFormat(
             self.get_data_path("kraken2-to-ncbi-tree/example1"), "r"
@@ -109,7 +199,7 @@ class TestKrakenSelect(TestPluginBase):
         exp_tree_fp = self.get_data_path("kraken2-to-ncbi-tree/exp-tree1.txt")
         exp_tree = skbio.TreeNode.read(exp_tree_fp)
 
-        obs_tree = _kraken_to_ncbi_tree(report_df)
+        obs_tree = _kraken_to_ncbi_tree(report_df).to_skbio()
 
         # skbio.TreeNode doesn't define an equality operator, so performing
         # this test on newick strings (which is probably fragile)
@@ -117,6 +207,60 @@ class TestKrakenSelect(TestPluginBase):
 
         raise NotImplementedError('Additional tests needed.')
 
+    def test_find_parents(self):
+        indents = np.array([1, 2, 3, 3, 2, 4, 1, 2])
+        obs = _find_parents(indents)
+        exp = np.array([-1, 0, 1, 1, 0, 4, -1, 6])
+        np.testing.assert_array_equal(obs, exp)
+
+    def test_kraken_to_ncbi_tree_tips(self):
+        reports = Kraken2ReportDirectoryFormat(
+            self.get_data_path("kraken2-reports-select/samples"), "r"
+        )
+        report_df = list(reports.reports.iter_views(pd.DataFrame))[0][1]
+
+        obs_tree = _kraken_to_ncbi_tree(report_df)
+
+        exp_tips = [
+            '1767', '1138383', '701042', '1764', '339268', '2775496',
+            '1389713', '1773', '1778', '185642', '1784', '2857058',
+            '398694', '1719132'
+        ]
+        self.assertListEqual(obs_tree.actual_tip_names(), exp_tips)
+
+    def test_kraken_to_ncbi_tree_empty(self):
+        reports = Kraken2ReportDirectoryFormat(
+            self.get_data_path("kraken2-to-ncbi-tree/example1"), "r"
+        )
+        report_df = list(reports.reports.iter_views(pd.DataFrame))[0][1]
+
+        obs_tree = _kraken_to_ncbi_tree(report_df.iloc[:0])
+
+        self.assertEqual(len(obs_tree), 1)
+        self.assertListEqual(obs_tree.actual_tip_names(), [])
+
+    def test_combine_ncbi_trees(self):
+        trees = [
+            _tree_from_lineages([
+                ['d__D', 'g__G', 's__A', '1'], ['d__D', 'g__G', 's__B', '2']
+            ]),
+            _tree_from_lineages([
+                ['d__D', 'g__G', 's__C', '3'], ['d__D', 'g__G', 's__B', '2']
+            ]),
+            _tree_from_lineages([
+                ['d__F', 's__E', '4'], ['d__D', 'g__G', 's__C', '3']
+            ]),
+        ]
+
+        obs_tree = _combine_ncbi_trees(trees)
+
+        obs_nodes = [obs_tree.names[node] for node in obs_tree.preorder()]
+        exp_nodes = [
+            None, 'd__D', 'g__G', 's__A', '1', 's__B', '2', 's__C', '3',
+            'd__F', 's__E', '4'
+        ]
+        self.assertListEqual(obs_nodes, exp_nodes)
+
     # The following test is currently failing b/c the format is looking
     # for file names that don't exist in the `outputs-mags` directory. It's
     # looking for `outputs-mags/sample1/sample1.output.txt`, but the file
@@ -134,6 +278,32 @@ class TestKrakenSelect(TestPluginBase):
     #         reports, hits, 0.0
     #     )
 
+    @patch('q2_moshpit.kraken2.select._find_lcas')
+    @patch('q2_moshpit.kraken2.select._kraken2_to_features')
+    def test_kraken2_to_mag_features_compressed_hits(self, p1, p2):
+        taxonomy = pd.DataFrame(
+            {'Taxon': ['d__Bacteria', 'd__Archaea']},
+            index=pd.Index(['2', '2157'])
+        )
+        p1.return_value = (['mag1'], [['2']], taxonomy)
+        with gzip.open(
+                os.path.join(self.temp_dir, 'mag1.output.txt.gz'), 'wt'
+        ) as fh:
+            fh.write('C\tcontig1\t2\t120\t2:86\n'
+                     'C\tcontig2\t2157\t98\t2157:64\n'
+                     'U\tcontig3\t0\t87\t0:53\n')
+        hits = Kraken2CompressedOutputDirectoryFormat(self.temp_dir, 'r')
+
+        obs = kraken2_to_mag_features('reports', hits, 0.0)
+
+        self.assertIs(obs, p2.return_value)
+        obs_taxa, = p2.call_args.args[0]
+        exp_taxa = pd.DataFrame(
+            {'Taxon': ['d__Bacteria'], 'mag_id': ['mag1']},
+            index=pd.Index(['contig1'], name='Feature ID')
+        )
+        assert_frame_equal(obs_taxa, exp_taxa)
+
     def test_find_lcas_mode_lca(self):
         taxa = [self.taxa_mag1, self.taxa_mag2, self.taxa_mag3, self.taxa_mag4]
         obs = _find_lcas(taxa, mode='lca')
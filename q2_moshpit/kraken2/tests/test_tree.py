@@ -0,0 +1,119 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import pickle
+import unittest
+
+import numpy as np
+import skbio
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_moshpit.kraken2.tree import NCBITree
+
+
+class TestNCBITree(TestPluginBase):
+    package = "q2_moshpit.kraken2.tests"
+
+    def setUp(self):
+        super().setUp()
+        # ((((1)s__A,(2)s__B)g__G)d__D,(s1__X)d__F)
+        self.tree = NCBITree()
+        d_d = self.tree.add_node(self.tree.ROOT, 'd__D', length=1.0)
+        g_g = self.tree.add_node(d_d, 'g__G', length=1.0)
+        s_a = self.tree.add_node(g_g, 's__A', length=1.0)
+        self.tree.add_node(s_a, '1', actual_tip=True)
+        d_f = self.tree.add_node(self.tree.ROOT, 'd__F', length=1.0)
+        s_b = self.tree.add_node(g_g, 's__B', length=1.0)
+        self.tree.add_node(s_b, '2', actual_tip=True)
+        self.tree.add_node(d_f, 's1__X')
+
+    def test_from_arrays(self):
+        obs = NCBITree.from_arrays(
+            parents=np.array(self.tree.parents),
+            names=self.tree.names,
+            lengths=np.array(self.tree.lengths),
+            actual_tips=np.array(self.tree.actual_tips, dtype=bool)
+        )
+
+        self.assertEqual(str(obs.to_skbio()), str(self.tree.to_skbio()))
+        self.assertListEqual(obs.actual_tip_names(), ['1', '2'])
+        self.assertEqual(obs.find('s__B'), self.tree.find('s__B'))
+
+    def test_preorder(self):
+        obs = [self.tree.names[node] for node in self.tree.preorder()]
+        exp = [None, 'd__D', 'g__G', 's__A', '1', 's__B', '2', 'd__F', 's1__X']
+        self.assertListEqual(obs, exp)
+
+    def test_tips(self):
+        obs = [self.tree.names[node] for node in self.tree.tips()]
+        self.assertListEqual(obs, ['1', '2', 's1__X'])
+
+    def test_actual_tip_names(self):
+        self.assertListEqual(self.tree.actual_tip_names(), ['1', '2'])
+
+    def test_find(self):
+        self.assertEqual(self.tree.names[self.tree.find('g__G')], 'g__G')
+        self.assertIsNone(self.tree.find('g__H'))
+
+    def test_ancestors(self):
+        obs = [self.tree.names[node]
+               for node in self.tree.ancestors(self.tree.find('2'))]
+        self.assertListEqual(obs, ['s__B', 'g__G', 'd__D'])
+
+    def test_to_taxonomy(self):
+        obs = list(self.tree.to_taxonomy())
+        exp = [
+            ('1', ['d__D', 'g__G', 's__A']),
+            ('2', ['d__D', 'g__G', 's__B']),
+            ('s1__X', ['d__F']),
+        ]
+        self.assertListEqual(obs, exp)
+
+    def test_to_taxonomy_same_as_skbio(self):
+        obs = list(self.tree.to_taxonomy())
+        exp = [(node.name, lineage)
+               for node, lineage in self.tree.to_skbio().to_taxonomy()]
+        self.assertListEqual(obs, exp)
+
+    def test_to_skbio(self):
+        obs = self.tree.to_skbio()
+        exp = skbio.TreeNode.read(
+            ['((((1:0.0)s__A:1.0,(2:0.0)s__B:1.0)g__G:1.0)d__D:1.0,'
+             '(s1__X:0.0)d__F:1.0);']
+        )
+        self.assertEqual(str(obs), str(exp))
+        self.assertTrue(obs.find('1').is_actual_tip)
+        self.assertFalse(hasattr(obs.find('s1__X'), 'is_actual_tip'))
+
+    def test_merge(self):
+        other = NCBITree()
+        d_d = other.add_node(other.ROOT, 'd__D', length=1.0)
+        g_g = other.add_node(d_d, 'g__G', length=1.0)
+        s_c = other.add_node(g_g, 's__C', length=1.0)
+        other.add_node(s_c, '3', actual_tip=True)
+        s_b = other.add_node(g_g, 's__B', length=1.0)
+        other.add_node(s_b, '2', actual_tip=True)
+
+        self.tree.merge(other)
+
+        obs = [self.tree.names[node] for node in self.tree.preorder()]
+        exp = [
+            None, 'd__D', 'g__G', 's__A', '1', 's__B', '2', 's__C', '3',
+            'd__F', 's1__X'
+        ]
+        self.assertListEqual(obs, exp)
+        self.assertListEqual(self.tree.actual_tip_names(), ['1', '2', '3'])
+
+    def test_pickle(self):
+        obs = pickle.loads(pickle.dumps(self.tree))
+        self.assertListEqual(
+            list(obs.to_taxonomy()), list(self.tree.to_taxonomy())
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,11 +7,13 @@
 # ----------------------------------------------------------------------------
 import unittest
 
+import numpy as np
 import pandas as pd
 from qiime2.plugin.testing import TestPluginBase
 
 from q2_moshpit.kraken2.utils import (
-    _process_kraken2_arg, _find_lca, _join_ranks
+    _process_kraken2_arg, _find_lca, _join_ranks, _find_group_lcas,
+    _counts_to_table
 )
 
 
@@ -98,6 +100,32 @@ class TestKraken2Utils(TestPluginBase):
         ]
         self.assertListEqual(obs, exp)
 
+    def test_find_group_lcas(self):
+        ranks = pd.DataFrame(
+            [*self.taxa.tolist(), *self.taxa_mixed.tolist(), *self.m_flor],
+            index=[
+                *['mag1'] * len(self.taxa), *['mag2'] * len(self.taxa_mixed),
+                *['mag3'] * len(self.m_flor)
+            ]
+        )
+
+        obs = _find_group_lcas(ranks)
+
+        self.assertListEqual(list(obs.index), ['mag1', 'mag2', 'mag3'])
+        self.assertListEqual(obs['mag1'], list(_find_lca(self.taxa)))
+        self.assertListEqual(obs['mag2'], list(_find_lca(self.taxa_mixed)))
+        self.assertListEqual(obs['mag3'], self.m_flor[0])
+
+    def test_find_group_lcas_missing_ranks(self):
+        # LCA cannot be deeper than the shortest taxonomy in the group
+        ranks = pd.DataFrame(
+            [self.c_glu_r[0], self.c_glu_r[0][:-2]], index=['mag1', 'mag1']
+        )
+
+        obs = _find_group_lcas(ranks)
+
+        self.assertListEqual(obs['mag1'], self.c_glu_r[0][:-2])
+
     # def test_find_lca_majority_1(self):
     #     obs = list(_find_lca_majority(self.taxa))
     #     exp = [
@@ -158,6 +186,25 @@ class TestKraken2Utils(TestPluginBase):
         exp = 'd__Bacteria;k__Bacteria;p__;c__Actinomycetes'
         self.assertEqual(obs, exp)
 
+    def test_counts_to_table(self):
+        obs = _counts_to_table(
+            ['s2', 's1', 's2', 's1'], [562, 1280, 1280, 100], [3, 5, 0, 2]
+        )
+
+        self.assertListEqual(list(obs.ids(axis='sample')), ['s1', 's2'])
+        self.assertListEqual(
+            list(obs.ids(axis='observation')), ['100', '1280', '562']
+        )
+        self.assertEqual(obs.matrix_data.nnz, 3)
+        self.assertEqual(obs.matrix_data.dtype, np.float64)
+        pd.testing.assert_frame_equal(
+            obs.to_dataframe(dense=True),
+            pd.DataFrame(
+                {'s1': [2.0, 5.0, 0.0], 's2': [0.0, 0.0, 3.0]},
+                index=['100', '1280', '562']
+            )
+        )
+
 
 if __name__ == '__main__':
     unittest.main()
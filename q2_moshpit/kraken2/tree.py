@@ -0,0 +1,242 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+from array import array
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import skbio
+
+
+class NCBITree:
+    """Compact, array-backed representation of an NCBI taxonomy tree.
+
+    Instead of one Python object per node, all the nodes are stored in
+    flat arrays (parent indices, branch lengths, tip flags) and a table
+    of node names. Node 0 is always the (unnamed) root and every node is
+    stored after its parent. Children of a node keep the order in which
+    they were added, which is equivalent to appending children to an
+    skbio.TreeNode.
+
+    Nodes can only be added, never removed, so that node indices remain
+    valid for the whole lifetime of the tree.
+    """
+    ROOT = 0
+
+    def __init__(self):
+        self.parents = array('l', [-1])
+        self.lengths = array('d', [np.nan])
+        self.actual_tips = bytearray(1)
+        self.names: List[Optional[str]] = [None]
+        self._index = {}
+        self._children = None
+
+    @classmethod
+    def from_arrays(
+            cls, parents: np.ndarray, names: List[Optional[str]],
+            lengths: np.ndarray, actual_tips: np.ndarray
+    ) -> 'NCBITree':
+        """Create a tree from arrays describing all of its nodes.
+
+        Args:
+            parents (np.ndarray): Index of the parent of every node. The
+                first node is the root and has no parent (-1).
+            names (list): Name of every node.
+            lengths (np.ndarray): Length of the branch leading to every node.
+            actual_tips (np.ndarray): Boolean flag for every node denoting
+                whether it was a leaf of the Kraken 2 report.
+
+        Returns:
+            NCBITree: The tree.
+        """
+        tree = cls()
+        tree.parents = array('l')
+        tree.parents.frombytes(np.asarray(parents, dtype='l').tobytes())
+        tree.lengths = array('d')
+        tree.lengths.frombytes(np.asarray(lengths, dtype='d').tobytes())
+        tree.actual_tips = bytearray(
+            np.asarray(actual_tips, dtype=np.uint8).tobytes()
+        )
+        tree.names = list(names)
+        # iterate backwards so that the first node with a given name wins
+        tree._index = {
+            name: node for node, name in
+            zip(range(len(names) - 1, 0, -1), tree.names[:0:-1])
+        }
+        return tree
+
+    def __len__(self):
+        return len(self.names)
+
+    def add_node(
+            self, parent: int, name: str, length: float = 0.0,
+            actual_tip: bool = False
+    ) -> int:
+        """Append a new node as the last child of the given parent.
+
+        Args:
+            parent (int): Index of the parent node.
+            name (str): Name of the new node.
+            length (float): Length of the branch leading to the node.
+            actual_tip (bool): Whether the node represents a taxon which
+                was a leaf of the Kraken 2 report.
+
+        Returns:
+            int: Index of the new node.
+        """
+        node = len(self.names)
+        self.parents.append(parent)
+        self.lengths.append(length)
+        self.actual_tips.append(actual_tip)
+        self.names.append(name)
+        self._index.setdefault(name, node)
+        self._children = None
+        return node
+
+    def mark_actual_tip(self, node: int):
+        self.actual_tips[node] = True
+
+    def find(self, name: str) -> Optional[int]:
+        """Find the first node added under the given name.
+
+        Args:
+            name (str): Name of the node.
+
+        Returns:
+            int: Index of the node or None, if there is no such node.
+        """
+        return self._index.get(name)
+
+    def children(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Find children of all the nodes.
+
+        Returns:
+            (np.ndarray, np.ndarray): Children of all the nodes in the CSR
+                layout: children of node i are stored in
+                children[indptr[i]:indptr[i + 1]], in order of addition.
+        """
+        if self._children is None:
+            parents = np.frombuffer(
+                self.parents, dtype=self.parents.typecode
+            )
+            # stable sort keeps the children in order of their addition
+            children = np.argsort(parents[1:], kind='stable') + 1
+            counts = np.bincount(parents[1:], minlength=len(self))
+            indptr = np.concatenate([[0], np.cumsum(counts)])
+            self._children = (indptr, children)
+        return self._children
+
+    def preorder(self, start: int = ROOT) -> Iterator[int]:
+        """Traverse the (sub)tree, visiting nodes before their children.
+
+        Args:
+            start (int): Index of the node where the traversal starts.
+
+        Yields:
+            int: Index of the visited node.
+        """
+        indptr, children = self.children()
+        stack = [start]
+        while stack:
+            node = stack.pop()
+            yield node
+            node_children = children[indptr[node]:indptr[node + 1]]
+            stack.extend(node_children[::-1].tolist())
+
+    def tips(self) -> Iterator[int]:
+        """Find all the tips of the tree, from left to right."""
+        indptr, _ = self.children()
+        return (
+            node for node in self.preorder()
+            if indptr[node] == indptr[node + 1] and node != self.ROOT
+        )
+
+    def ancestors(self, node: int) -> List[int]:
+        """Find ancestors of the node, excluding the root.
+
+        Args:
+            node (int): Index of the node.
+
+        Returns:
+            list: Indices of the ancestors, from the closest to the most
+                distant one.
+        """
+        ancestors = []
+        node = self.parents[node]
+        while node > self.ROOT:
+            ancestors.append(node)
+            node = self.parents[node]
+        return ancestors
+
+    def actual_tip_names(self) -> List[str]:
+        """Find names of all the tips representing leaves of the report."""
+        return [self.names[tip] for tip in self.tips()
+                if self.actual_tips[tip]]
+
+    def merge(self, other: 'NCBITree'):
+        """Add all the lineages of another tree missing in this tree.
+
+        For every tip of the other tree which is not present in this tree,
+        its ancestors are followed from the root down until the first one
+        which is missing here - that node, together with its whole
+        subtree, is then appended to the last matching node of this tree.
+
+        Args:
+            other (NCBITree): Tree to be merged into this tree.
+        """
+        for tip in other.tips():
+            if other.names[tip] in self._index:
+                continue  # taxid is already in this tree
+            parents = other.ancestors(tip)
+            matching = self.ROOT
+            while parents:
+                node = parents.pop()
+                found = self.find(other.names[node])
+                if found is None:
+                    self._append_subtree(other, node, matching)
+                    break
+                matching = found
+
+    def _append_subtree(self, other: 'NCBITree', start: int, parent: int):
+        new_nodes = {other.parents[start]: parent}
+        for node in other.preorder(start):
+            new_nodes[node] = self.add_node(
+                new_nodes[other.parents[node]], other.names[node],
+                other.lengths[node], bool(other.actual_tips[node])
+            )
+
+    def to_taxonomy(self) -> Iterator[Tuple[str, List[str]]]:
+        """Find lineages of all the tips of the tree.
+
+        Equivalent to skbio.TreeNode.to_taxonomy.
+
+        Yields:
+            (str, list): Name of the tip and the names of all its named
+                ancestors, starting from the one closest to the root.
+        """
+        for tip in self.tips():
+            lineage = [self.names[node] for node in self.ancestors(tip)
+                       if self.names[node]]
+            yield self.names[tip], lineage[::-1]
+
+    def to_skbio(self) -> skbio.TreeNode:
+        """Convert the tree into an skbio.TreeNode.
+
+        Tips representing leaves of the report will have an
+        `is_actual_tip` attribute set.
+        """
+        nodes = [skbio.TreeNode()]
+        for node in range(1, len(self)):
+            new_node = skbio.TreeNode(
+                name=self.names[node], length=self.lengths[node]
+            )
+            if self.actual_tips[node]:
+                new_node.is_actual_tip = True
+            # parents are always stored before their children
+            nodes[self.parents[node]].append(new_node)
+            nodes.append(new_node)
+        return nodes[0]
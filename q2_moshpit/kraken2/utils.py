@@ -9,6 +9,11 @@ from itertools import takewhile, dropwhile
 from re import sub
 from typing import List
 
+import biom
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+
 from q2_moshpit._utils import _construct_param
 
 
@@ -48,6 +53,42 @@ def _find_lca(taxa):
         lambda x: len(x) == 1, taxa_comparison))
 
 
+def _find_group_lcas(ranks: pd.DataFrame) -> pd.Series:
+    """Find least common ancestor of every group of taxonomies at once.
+
+    Every rank (column) is integer-encoded so that the LCA can be found
+    with a single groupby: a rank belongs to the LCA of a group if all
+    the group members share the same, non-missing label at that rank and
+    at all the ranks above it. This is equivalent to running `_find_lca`
+    on every group separately.
+
+    Args:
+        ranks (pd.DataFrame): Matrix of taxonomic labels with one row per
+            taxonomy and one column per rank, ordered from the highest to
+            the lowest rank. Index contains group IDs and missing ranks
+            are denoted by None/NaN.
+
+    Returns:
+        pd.Series: List of LCA labels (one per rank) for every group,
+            in order of their first appearance in the index.
+    """
+    # missing labels are encoded as -1
+    codes = pd.DataFrame(
+        {col: pd.factorize(ranks[col])[0] for col in ranks.columns},
+        index=ranks.index
+    )
+    grouped = codes.groupby(level=0, sort=False)
+    lowest, highest = grouped.min(), grouped.max()
+    shared = ((lowest == highest) & (lowest >= 0)).to_numpy()
+    depths = np.logical_and.accumulate(shared, axis=1).sum(axis=1)
+
+    labels = ranks.groupby(level=0, sort=False).first()
+    return pd.Series(
+        [row[:depth] for row, depth in zip(labels.values.tolist(), depths)],
+        index=labels.index, dtype=object
+    )
+
+
 # def _find_lca_majority(taxa):
 #     """Find least common ancestor by majority.
 #
@@ -82,3 +123,36 @@ def _join_ranks(taxonomy: List[str], ranks: List[str]) -> str:
     taxonomy = ['' if x is None else x for x in taxonomy[::-1]]
     taxonomy = ';'.join([''.join(t) for t in zip(ranks, taxonomy)])
     return taxonomy
+
+
+def _counts_to_table(sample_ids, taxids, counts) -> biom.Table:
+    """Assemble a sparse feature table from read counts of all samples.
+
+    Sample and taxon IDs are factorized into integer codes, so that every
+    distinct ID is only stored once. The table only stores the non-zero
+    counts - as floats, like in all the other frequency tables.
+
+    Args:
+        sample_ids: Sample ID of every count.
+        taxids: Taxid of every count.
+        counts: Number of reads of the taxon in the sample.
+
+    Returns:
+        biom.Table: Table of taxa (observations) in samples, both sorted
+            by their IDs.
+    """
+    sample_codes, samples = pd.factorize(
+        np.asarray(sample_ids, dtype=str), sort=True
+    )
+    taxon_codes, taxa = pd.factorize(np.asarray(taxids, dtype=str), sort=True)
+    data = coo_matrix(
+        (
+            np.asarray(counts, dtype=float),
+            (taxon_codes, sample_codes)
+        ),
+        shape=(len(taxa), len(samples))
+    ).tocsr()
+    data.eliminate_zeros()
+    return biom.Table(
+        data, observation_ids=list(taxa), sample_ids=list(samples)
+    )
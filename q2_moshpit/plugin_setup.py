@@ -16,9 +16,15 @@ from q2_types.per_sample_sequences import (
 from q2_types.sample_data import SampleData
 from qiime2.core.type import Bool, Range, Int, Str, Float, List, Choices
 from qiime2.core.type import (Properties, TypeMap)
-from qiime2.plugin import (Plugin, Citations)
+from qiime2.plugin import (Plugin, Citations, MetadataColumn, Numeric)
 
 import q2_moshpit
+from q2_moshpit.kraken2 import (
+    Kraken2Library, Kraken2LibraryDirectoryFormat, Kraken2LibraryFileFormat,
+    Kraken2LibraryManifestFormat, Kraken2LibrarySequencesFormat,
+    Kraken2TaxonomyDumpFormat, Kraken2CompressedOutputs,
+    Kraken2CompressedOutputFormat, Kraken2CompressedOutputDirectoryFormat
+)
 from q2_types_genomics.feature_data import NOG, MAG
 from q2_types_genomics.feature_map import FeatureMap, MAGtoContigs
 from q2_types_genomics.genome_data import BLAST6
@@ -54,6 +60,53 @@ kraken2_param_descriptions = {
                              ' unique read-minimizers per-taxon in the repot.'
 }
 
+kraken2_build_params = {
+    'threads': Int % Range(1, None),
+    'kmer_len': Int % Range(1, None),
+    'minimizer_len': Int % Range(1, None),
+    'minimizer_spaces': Int % Range(1, None),
+    'no_masking': Bool,
+    'max_db_size': Int % Range(0, None),
+    'use_ftp': Bool,
+    'load_factor': Float % Range(0, 1),
+    'fast_build': Bool,
+    'read_len': List[Int % Range(1, None)],
+    'libraries': List[Str % Choices(
+        ['archaea', 'bacteria', 'plasmid', 'viral', 'human', 'fungi',
+         'plant', 'protozoa', 'nt', 'UniVec', 'UniVec_Core']
+    )],
+    'library_exists': Str % Choices(['skip', 'refetch']),
+    'n_jobs': Int % Range(1, None)
+}
+kraken2_build_param_descriptions = {
+    'threads': 'Number of threads.',
+    'kmer_len': 'K-mer length in bp/aa.',
+    'minimizer_len': 'Minimizer length in bp/aa.',
+    'minimizer_spaces': 'Number of characters in minimizer that are '
+                        'ignored in comparisons.',
+    'no_masking': 'Avoid masking low-complexity sequences prior to '
+                  'building; masking requires dustmasker or segmasker '
+                  'to be installed in PATH',
+    'max_db_size': 'Maximum number of bytes for Kraken 2 hash table; '
+                   'if the estimator determines more would normally be '
+                   'needed, the reference library will be downsampled '
+                   'to fit.',
+    'use_ftp': 'Use FTP for downloading instead of RSYNC.',
+    'load_factor': 'Proportion of the hash table to be populated.',
+    'fast_build': 'Do not require database to be deterministically '
+                  'built when using multiple threads. This is faster, '
+                  'but does introduce variability in minimizer/LCA pairs.',
+    'read_len': 'Ideal read lengths to be used while building the Bracken '
+                'database.',
+    'libraries': 'Reference libraries to be downloaded and added to the '
+                 'database, next to the provided sequences.',
+    'library_exists': 'What to do with libraries which are already present '
+                      '(e.g., in the library of a previous build): skip '
+                      'their download or download them again.',
+    'n_jobs': 'Number of libraries downloaded concurrently, each into its '
+              'own staging directory.'
+}
+
 plugin = Plugin(
     name='moshpit',
     version=q2_moshpit.__version__,
@@ -69,6 +122,25 @@ plugin = Plugin(
 importlib.import_module('q2_moshpit.eggnog')
 importlib.import_module('q2_moshpit.metabat2')
 
+plugin.register_formats(
+    Kraken2LibraryManifestFormat, Kraken2LibraryFileFormat,
+    Kraken2LibrarySequencesFormat, Kraken2TaxonomyDumpFormat,
+    Kraken2LibraryDirectoryFormat, Kraken2CompressedOutputFormat,
+    Kraken2CompressedOutputDirectoryFormat
+)
+plugin.register_semantic_types(Kraken2Library, Kraken2CompressedOutputs)
+plugin.register_semantic_type_to_format(
+    Kraken2Library, artifact_format=Kraken2LibraryDirectoryFormat
+)
+plugin.register_semantic_type_to_format(
+    SampleData[Kraken2CompressedOutputs],
+    artifact_format=Kraken2CompressedOutputDirectoryFormat
+)
+plugin.register_semantic_type_to_format(
+    FeatureData[Kraken2CompressedOutputs],
+    artifact_format=Kraken2CompressedOutputDirectoryFormat
+)
+
 plugin.methods.register_function(
     function=q2_moshpit.metabat2.bin_contigs_metabat,
     inputs={
@@ -151,7 +223,11 @@ plugin.methods.register_function(
         "seqs": T_kraken_in,
         "kraken2_db": Kraken2DB,
     },
-    parameters=kraken2_params,
+    parameters={
+        **kraken2_params,
+        'n_jobs': Int % Range(1, None),
+        'preload_db': Bool,
+    },
     outputs=[
         ('reports', T_kraken_out_rep),
         ('hits', T_kraken_out_hits),
@@ -161,7 +237,18 @@ plugin.methods.register_function(
                 "and assembled MAGs, can be provided.",
         "kraken2_db": "Kraken 2 database.",
     },
-    parameter_descriptions=kraken2_param_descriptions,
+    parameter_descriptions={
+        **kraken2_param_descriptions,
+        'n_jobs': 'Number of samples to be classified concurrently. When '
+                  'larger than 1, the number of threads is split evenly '
+                  'between the concurrent Kraken 2 processes and the '
+                  'database is memory-mapped, so that it is only kept in '
+                  'memory once.',
+        'preload_db': 'Read the database into memory only once, before '
+                      'classifying any of the samples, and memory-map it '
+                      'in every Kraken 2 process. This avoids loading the '
+                      'database separately for each sample.',
+    },
     output_descriptions={
         'reports': 'Reports produced by Kraken2.',
         'hits': 'Output files produced by Kraken2.',
@@ -172,6 +259,64 @@ plugin.methods.register_function(
     citations=[citations["wood2019"]]
 )
 
+T_kraken_gz_in, T_kraken_gz_out_rep, T_kraken_gz_out_hits = TypeMap({
+    SampleData[SequencesWithQuality |
+               PairedEndSequencesWithQuality]: (
+        SampleData[Kraken2Reports % Properties('reads')],
+        SampleData[Kraken2CompressedOutputs % Properties('reads')]
+    ),
+    FeatureData[MAG]: (
+        FeatureData[Kraken2Reports % Properties('mags')],
+        FeatureData[Kraken2CompressedOutputs % Properties('mags')]
+    ),
+})
+
+plugin.methods.register_function(
+    function=q2_moshpit.kraken2.classification.classify_kraken2_compressed,
+    inputs={
+        "seqs": T_kraken_gz_in,
+        "kraken2_db": Kraken2DB,
+    },
+    parameters={
+        **kraken2_params,
+        'n_jobs': Int % Range(1, None),
+        'preload_db': Bool,
+    },
+    outputs=[
+        ('reports', T_kraken_gz_out_rep),
+        ('hits', T_kraken_gz_out_hits),
+    ],
+    input_descriptions={
+        "seqs": "Sequences to be classified. Both, single-/paired-end reads"
+                "and assembled MAGs, can be provided.",
+        "kraken2_db": "Kraken 2 database.",
+    },
+    parameter_descriptions={
+        **kraken2_param_descriptions,
+        'n_jobs': 'Number of samples to be classified concurrently. When '
+                  'larger than 1, the number of threads is split evenly '
+                  'between the concurrent Kraken 2 processes and the '
+                  'database is memory-mapped, so that it is only kept in '
+                  'memory once.',
+        'preload_db': 'Read the database into memory only once, before '
+                      'classifying any of the samples, and memory-map it '
+                      'in every Kraken 2 process. This avoids loading the '
+                      'database separately for each sample.',
+    },
+    output_descriptions={
+        'reports': 'Reports produced by Kraken2.',
+        'hits': 'Output files produced by Kraken2, compressed with gzip.',
+    },
+    name='Perform taxonomic classification of reads or MAGs using Kraken 2 '
+         'and compress the per-read results.',
+    description='This method uses Kraken 2 to classify provided NGS reads '
+                'or MAGs into taxonomic groups. Unlike classify-kraken2, '
+                'the per-read classification results are piped from '
+                'Kraken 2 directly into gzip, so that they are never '
+                'written to disk uncompressed.',
+    citations=[citations["wood2019"]]
+)
+
 plugin.methods.register_function(
     function=q2_moshpit.kraken2.bracken.estimate_bracken,
     inputs={
@@ -181,7 +326,10 @@ plugin.methods.register_function(
     parameters={
         'threshold': Int % Range(0, None),
         'read_len': Int % Range(0, None),
-        'level': Str % Choices(['D', 'P', 'C', 'O', 'F', 'G', 'S'])
+        'level': Str % Choices(['D', 'P', 'C', 'O', 'F', 'G', 'S']),
+        'n_jobs': Int % Range(1, None),
+        'backend': Str % Choices(['bracken', 'python']),
+        'read_lens': MetadataColumn[Numeric]
     },
     outputs=[
         ('reports', SampleData[Kraken2Reports % Properties('bracken')]),
@@ -196,7 +344,28 @@ plugin.methods.register_function(
         'threshold': 'Bracken: number of reads required PRIOR to abundance '
                      'estimation to perform re-estimation.',
         'read_len': 'Bracken: read length to get all classifications for.',
-        'level': 'Bracken: taxonomic level to estimate abundance at.'
+        'level': 'Bracken: taxonomic level to estimate abundance at.',
+        'n_jobs': 'Number of samples processed concurrently: by Bracken '
+                  '(only with the "bracken" backend) and while building '
+                  'the taxonomy of the re-estimated reports (with both '
+                  'backends).',
+        'backend': 'Implementation used to re-estimate the abundances: '
+                   '"bracken" runs Bracken separately for every sample, '
+                   '"python" re-estimates abundances of all the samples '
+                   'at once, without re-reading the Bracken database for '
+                   'every sample. The "python" backend reimplements the '
+                   'estimation of Bracken and is experimental: its '
+                   'results are not guaranteed to match those of '
+                   'Bracken. Binary indices of the Bracken k-mer '
+                   'distributions used by the "python" backend can be '
+                   'cached in a directory set using the '
+                   'Q2_MOSHPIT_BRACKEN_CACHE_DIR environment variable '
+                   '(limited to 8 GB, unless set using the '
+                   'Q2_MOSHPIT_BRACKEN_CACHE_GB environment variable), so '
+                   'that they are not parsed again in the following runs.',
+        'read_lens': 'Read length of every sample, used to select the '
+                     'matching Bracken k-mer distribution. Samples which '
+                     'are not listed use "read-len".'
     },
     output_descriptions={
         'reports': 'Reports modified by Bracken.',
@@ -217,16 +386,8 @@ plugin.methods.register_function(
              'standard16', 'pluspf', 'pluspf8', 'pluspf16',
              'pluspfp', 'pluspfp8', 'pluspfp16', 'eupathdb'],
         ),
-        'threads': Int % Range(1, None),
-        'kmer_len': Int % Range(1, None),
-        'minimizer_len': Int % Range(1, None),
-        'minimizer_spaces': Int % Range(1, None),
-        'no_masking': Bool,
-        'max_db_size': Int % Range(0, None),
-        'use_ftp': Bool,
-        'load_factor': Float % Range(0, 1),
-        'fast_build': Bool,
-        'read_len': List[Int % Range(1, None)],
+        'n_connections': Int % Range(1, None),
+        **kraken2_build_params
     },
     outputs=[
         ('kraken2_database', Kraken2DB),
@@ -239,27 +400,19 @@ plugin.methods.register_function(
         'collection': 'Name of the database collection to be fetched. '
                       'Please check https://benlangmead.github.io/aws-'
                       'indexes/k2 for the description of the available '
-                      'options.',
-        'threads': 'Number of threads. Only applicable when building a '
-                   'custom database.',
-        'kmer_len': 'K-mer length in bp/aa.',
-        'minimizer_len': 'Minimizer length in bp/aa.',
-        'minimizer_spaces': 'Number of characters in minimizer that are '
-                            'ignored in comparisons.',
-        'no_masking': 'Avoid masking low-complexity sequences prior to '
-                      'building; masking requires dustmasker or segmasker '
-                      'to be installed in PATH',
-        'max_db_size': 'Maximum number of bytes for Kraken 2 hash table; '
-                       'if the estimator determines more would normally be '
-                       'needed, the reference library will be downsampled '
-                       'to fit.',
-        'use_ftp': 'Use FTP for downloading instead of RSYNC.',
-        'load_factor': 'Proportion of the hash table to be populated.',
-        'fast_build': 'Do not require database to be deterministically '
-                      'built when using multiple threads. This is faster, '
-                      'but does introduce variability in minimizer/LCA pairs.',
-        'read_len': 'Ideal read lengths to be used while building the Bracken '
-                    'database.'
+                      'options. Fetched collections can be cached in the '
+                      'directory set using the Q2_MOSHPIT_KRAKEN2_CACHE_DIR '
+                      'environment variable (up to 256 GB, which can be '
+                      'changed using the Q2_MOSHPIT_KRAKEN2_CACHE_GB '
+                      'environment variable). The cache needs to be located '
+                      'on the same file system as the QIIME 2 temporary '
+                      'directory, otherwise collections are not cached.',
+        'n_connections': 'Number of concurrent connections used to '
+                         'download a pre-built database. The download is '
+                         'split into parts and at most 256 MB of parts '
+                         'are held in memory at once, regardless of the '
+                         'number of connections.',
+        **kraken2_build_param_descriptions
     },
     output_descriptions={
         'kraken2_database': 'Kraken2 database.',
@@ -272,6 +425,50 @@ plugin.methods.register_function(
     citations=[citations["wood2019"], citations["lu2017"]]
 )
 
+plugin.methods.register_function(
+    function=q2_moshpit.kraken2.update_kraken_db,
+    inputs={
+        "seqs": List[FeatureData[Sequence]],
+        "library": Kraken2Library
+    },
+    parameters=kraken2_build_params,
+    outputs=[
+        ('kraken2_database', Kraken2DB),
+        ('bracken_database', BrackenDB),
+        ('updated_library', Kraken2Library),
+    ],
+    input_descriptions={
+        "seqs": "Sequences to be added to the Kraken 2 database.",
+        "library": "Taxonomy and sequence library of a previous build. "
+                   "When provided, the taxonomy is reused and only the "
+                   "sequences which are not in the library yet are "
+                   "masked and added to it. All the sequences of the "
+                   "library remain in the database."
+    },
+    parameter_descriptions=kraken2_build_param_descriptions,
+    output_descriptions={
+        'kraken2_database': 'Kraken2 database.',
+        'bracken_database': 'Bracken database.',
+        'updated_library': 'Taxonomy and sequence library of the database, '
+                           'to be used for its future updates.'
+    },
+    name='Build or update a custom Kraken 2 database.',
+    description='This method builds Kraken 2/Bracken databases from '
+                'provided DNA sequences and a library of sequences added '
+                'previously. Only the new sequences are masked and added '
+                'to the library, while the Kraken 2 hash table and the '
+                'Bracken k-mer distributions are always rebuilt from the '
+                'whole library, so an update takes about as long as the '
+                'indexing step of a full build. The library output '
+                'contains all the (masked) sequences and the complete '
+                'taxonomy, including the accession to taxid maps needed '
+                'to assign sequences without a "kraken:taxid" header, '
+                'and is therefore typically larger than the Kraken 2 '
+                'database itself. Every update creates a new library '
+                'artifact of that size.',
+    citations=[citations["wood2019"], citations["lu2017"]]
+)
+
 plugin.methods.register_function(
     function=q2_moshpit.dereplication.dereplicate_mags,
     inputs={
@@ -311,7 +508,8 @@ plugin.methods.register_function(
         'reports': SampleData[Kraken2Reports]
     },
     parameters={
-        'coverage_threshold': Float % Range(0, 100, inclusive_end=True)
+        'coverage_threshold': Float % Range(0, 100, inclusive_end=True),
+        'n_jobs': Int % Range(1, None)
     },
     outputs=[
         ('table', FeatureTable[PresenceAbsence]),
@@ -322,7 +520,8 @@ plugin.methods.register_function(
     },
     parameter_descriptions={
         'coverage_threshold': 'The minimum percent coverage required to'
-                              ' produce a feature.'
+                              ' produce a feature.',
+        'n_jobs': 'Number of processes used to parse the reports.'
     },
     output_descriptions={
         'table': 'A presence/absence table of selected features. The features'
@@ -344,7 +543,10 @@ plugin.methods.register_function(
     function=q2_moshpit.kraken2.kraken2_to_mag_features,
     inputs={
         'reports': FeatureData[Kraken2Reports % Properties('mags')],
-        'hits': FeatureData[Kraken2Outputs % Properties('mags')],
+        'hits': FeatureData[
+            Kraken2Outputs % Properties('mags') |
+            Kraken2CompressedOutputs % Properties('mags')
+        ],
     },
     parameters={
         'coverage_threshold': Float % Range(0, 100, inclusive_end=True),
@@ -353,7 +555,8 @@ plugin.methods.register_function(
     outputs=[('taxonomy', FeatureData[Taxonomy])],
     input_descriptions={
         'reports': 'Per-sample Kraken 2 reports.',
-        'hits': 'Per-sample Kraken 2 output files.',
+        'hits': 'Per-sample Kraken 2 output files, either plain or '
+                'compressed with gzip.',
     },
     parameter_descriptions={
         'coverage_threshold': 'The minimum percent coverage required to '
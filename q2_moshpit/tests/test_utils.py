@@ -6,11 +6,22 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import os
+import tempfile
 import unittest
+from unittest.mock import patch
 
 from qiime2.plugin.testing import TestPluginBase
 
-from .._utils import _construct_param, _process_common_input_params
+from .._utils import (
+    _construct_param, _process_common_input_params, _run_concurrently,
+    _get_cache_dir, _get_cache_size, _hash_file, _get_file_digest,
+    _evict_cache_entries
+)
+
+
+def square(x):
+    return x ** 2
 
 
 def fake_processing_func(key, val):
@@ -61,6 +72,141 @@ class TestUtils(TestPluginBase):
         exp = ['--arg2', 'some-value', '--arg4']
         self.assertListEqual(obs, exp)
 
+    def test_run_concurrently_sequential(self):
+        kwargs_list = [{'x': 1, 'y': 2}, {'x': 3, 'y': 4}]
+        obs = _run_concurrently(lambda x, y: x + y, kwargs_list, n_jobs=1)
+        self.assertListEqual(obs, [3, 7])
+
+    def test_run_concurrently_keeps_order(self):
+        kwargs_list = [{'x': x} for x in range(20)]
+        obs = _run_concurrently(lambda x: x ** 2, kwargs_list, n_jobs=4)
+        self.assertListEqual(obs, [x ** 2 for x in range(20)])
+
+    def test_run_concurrently_processes(self):
+        kwargs_list = [{'x': x} for x in range(10)]
+        obs = _run_concurrently(
+            square, kwargs_list, n_jobs=2, use_processes=True
+        )
+        self.assertListEqual(obs, [x ** 2 for x in range(10)])
+
+    def test_run_concurrently_error(self):
+        def func(x):
+            if x == 3:
+                raise ValueError('Failed on 3.')
+            return x
+
+        kwargs_list = [{'x': x} for x in range(5)]
+        with self.assertRaisesRegex(ValueError, 'Failed on 3'):
+            _run_concurrently(func, kwargs_list, n_jobs=2)
+
+    def test_run_concurrently_return_exceptions(self):
+        def func(x):
+            if x % 2:
+                raise ValueError(f'Failed on {x}.')
+            return x
+
+        kwargs_list = [{'x': x} for x in range(5)]
+        for n_jobs in (1, 2):
+            obs = _run_concurrently(
+                func, kwargs_list, n_jobs=n_jobs, return_exceptions=True
+            )
+            self.assertListEqual(obs[::2], [0, 2, 4])
+            self.assertListEqual(
+                [str(e) for e in obs[1::2]], ['Failed on 1.', 'Failed on 3.']
+            )
+
+    def test_get_cache_dir(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            exp = os.path.join(tmp, 'abc', 'def')
+            with patch.dict(os.environ, {'CACHE_DIR': exp}):
+                obs = _get_cache_dir('CACHE_DIR', 'CACHE_GB', 100)
+
+            self.assertEqual(obs, exp)
+            self.assertTrue(os.path.isdir(exp))
+
+    def test_get_cache_dir_disabled(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with patch.dict(os.environ, clear=True):
+                obs = _get_cache_dir('CACHE_DIR', 'CACHE_GB', 100)
+            self.assertIsNone(obs)
+
+            with patch.dict(
+                    os.environ, {'CACHE_DIR': tmp, 'CACHE_GB': '0'}
+            ):
+                obs = _get_cache_dir('CACHE_DIR', 'CACHE_GB', 100)
+            self.assertIsNone(obs)
+
+    def test_get_cache_size(self):
+        with patch.dict(os.environ, clear=True):
+            self.assertEqual(_get_cache_size('CACHE_GB', 100), 100)
+        with patch.dict(os.environ, {'CACHE_GB': '0.5'}):
+            self.assertEqual(_get_cache_size('CACHE_GB', 100), 2**29)
+        with patch.dict(os.environ, {'CACHE_GB': '10GB'}), \
+                self.assertRaisesRegex(ValueError, r'CACHE_GB .+"10GB"'):
+            _get_cache_size('CACHE_GB', 100)
+
+    def test_hash_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fps = [os.path.join(tmp, fn) for fn in ('a.txt', 'b.txt')]
+            for fp, content in zip(fps, ('ACGT', 'ACGA')):
+                with open(fp, 'w') as fh:
+                    fh.write(content)
+
+            obs = _hash_file(fps[0], chunk_size=3)
+
+            self.assertEqual(obs, _hash_file(fps[0]))
+            self.assertNotEqual(obs, _hash_file(fps[1]))
+
+    def test_get_file_digest(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fps = [os.path.join(tmp, fn) for fn in 'abc']
+            # the files only differ in the middle of their contents
+            contents = [b'A' * 2**20, b'A' * 2**20,
+                        b'A' * 2**19 + b'C' + b'A' * (2**19 - 1)]
+            for fp, content in zip(fps, contents):
+                with open(fp, 'wb') as fh:
+                    fh.write(content)
+
+            obs = [_get_file_digest(fp, tmp) for fp in fps]
+
+            self.assertEqual(obs[0], obs[1])
+            self.assertNotEqual(obs[0], obs[2])
+            self.assertEqual(obs[0], _hash_file(fps[0]))
+
+    def test_get_file_digest_hashed_once(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, 'a.txt')
+            with open(fp, 'w') as fh:
+                fh.write('ACGT')
+            exp = _get_file_digest(fp, tmp)
+
+            with patch('q2_moshpit._utils._hash_file') as p:
+                obs = _get_file_digest(fp, tmp)
+                p.assert_not_called()
+            self.assertEqual(obs, exp)
+
+            # the file is hashed again once it changes
+            with open(fp, 'w') as fh:
+                fh.write('ACGA')
+            os.utime(fp, ns=(0, 0))
+            self.assertNotEqual(_get_file_digest(fp, tmp), exp)
+
+    def test_evict_cache_entries(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for i, name in enumerate(['old', 'new', 'kept', '.tmp']):
+                os.makedirs(os.path.join(tmp, name))
+                with open(os.path.join(tmp, name, 'data'), 'wb') as fh:
+                    fh.write(b'x' * 10)
+                os.utime(os.path.join(tmp, name), (i, i))
+
+            _evict_cache_entries(
+                tmp, max_size=25, keep=os.path.join(tmp, 'old')
+            )
+
+            self.assertListEqual(
+                sorted(os.listdir(tmp)), ['.tmp', 'kept', 'old']
+            )
+
 
 if __name__ == '__main__':
     unittest.main()
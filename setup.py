@@ -58,6 +58,7 @@ setup(
             'data/kraken2-reports-select/*/*',
             'data/kraken-to-ncbi-tree/*',
             'data/kraken-to-ncbi-tree/*/*/*',
+            'data/bracken-python/*/*',
         ],
         'q2_moshpit.dereplication.tests': [
             'data/*', 'data/mags/*', 'data/mags/*/*',